@@ -1,8 +1,13 @@
+import copy
 import json
 import os
+import threading
+from functools import lru_cache
 from pathlib import Path
 from typing import Dict, List, Optional, Any
 
+import orjson
+
 # 创建必要的目录
 BASE_DIR = Path(__file__).parent
 DATA_DIR = BASE_DIR / "data"
@@ -16,6 +21,9 @@ SYSTEM_TEMPLATES_DIR = DATA_DIR / "system_templates"  # 新增：系统提示词
 for directory in [DATA_DIR, TEMPLATES_DIR, TEST_SETS_DIR, RESULTS_DIR, PROVIDERS_DIR, SYSTEM_TEMPLATES_DIR]:
     directory.mkdir(exist_ok=True, parents=True)
 
+# 测试结果文件的orjson序列化选项
+RESULT_DUMP_OPTIONS = orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
 # 默认提供商配置
 DEFAULT_PROVIDER_CONFIG = {
     "name": "",
@@ -298,19 +306,57 @@ DEFAULT_SYSTEM_TEMPLATES = {
     }
 }
 
+# 配置、模板、测试集等JSON文件的读取缓存：路径 -> ((修改时间, 文件大小), 内容)
+# 以文件修改时间和大小为键，任何途径写入文件后都会自动失效；不依赖Streamlit运行上下文，
+# 执行器线程和后台事件循环线程中也可以安全调用
+_JSON_FILE_CACHE = {}
+_JSON_FILE_CACHE_LOCK = threading.Lock()
+
+def _file_signature(path: Path):
+    """文件的(修改时间, 大小)，文件不存在时返回None"""
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def _read_json_file(path: Path) -> Any:
+    """读取JSON文件，文件未变化时直接返回缓存内容的副本（调用方可以安全修改返回值）"""
+    signature = _file_signature(path)
+    if signature is None:
+        raise FileNotFoundError(str(path))
+    with _JSON_FILE_CACHE_LOCK:
+        cached = _JSON_FILE_CACHE.get(path)
+    if cached is None or cached[0] != signature:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        cached = (signature, data)
+        with _JSON_FILE_CACHE_LOCK:
+            _JSON_FILE_CACHE[path] = cached
+    return copy.deepcopy(cached[1])
+
+def _invalidate_json_files(directory: Optional[Path] = None) -> None:
+    """丢弃读取缓存；指定目录时只丢弃该目录下的文件"""
+    with _JSON_FILE_CACHE_LOCK:
+        if directory is None:
+            _JSON_FILE_CACHE.clear()
+        else:
+            for path in [p for p in _JSON_FILE_CACHE if p.parent == directory]:
+                del _JSON_FILE_CACHE[path]
+
 def load_config() -> Dict:
     """加载配置文件，如不存在则创建默认配置"""
     if not CONFIG_FILE.exists():
         save_config(DEFAULT_CONFIG)
-        return DEFAULT_CONFIG
+        return copy.deepcopy(DEFAULT_CONFIG)
     
-    with open(CONFIG_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return _read_json_file(CONFIG_FILE)
 
 def save_config(config: Dict) -> None:
     """保存配置到文件"""
     with open(CONFIG_FILE, "w", encoding="utf-8") as f:
         json.dump(config, f, indent=2, ensure_ascii=False)
+    _invalidate_json_files(DATA_DIR)
 
 def update_api_key(provider: str, key: str) -> None:
     """更新指定提供商的API密钥"""
@@ -370,6 +416,23 @@ def get_available_models() -> Dict[str, List[str]]:
     
     return models
 
+def _model_files_signature():
+    """配置文件和所有提供商配置文件的修改时间，任一文件变化时模型索引随之重建"""
+    paths = [CONFIG_FILE] + sorted(PROVIDERS_DIR.glob("*.json"))
+    return tuple((path.name, _file_signature(path)) for path in paths)
+
+@lru_cache(maxsize=1)
+def _build_model_provider_index(signature) -> Dict[str, str]:
+    index = {}
+    for provider, models in get_available_models().items():
+        for model in models:
+            index.setdefault(model, provider)
+    return index
+
+def get_model_provider_index() -> Dict[str, str]:
+    """模型 -> 提供商 的反向索引，同一模型出现在多个提供商时以先出现的为准（返回的字典为共享缓存，只读）"""
+    return _build_model_provider_index(_model_files_signature())
+
 def get_template_list() -> List[str]:
     """获取所有提示词模板列表，按修改时间倒序排序"""
     files = list(TEMPLATES_DIR.glob("*.json"))
@@ -409,20 +472,24 @@ def save_template(name: str, template: Dict) -> None:
 
     with open(file_path, "w", encoding="utf-8") as f:
         json.dump(template, f, indent=2, ensure_ascii=False)
+    clear_template_cache()
+
+def clear_template_cache() -> None:
+    """清除模板内容的读取缓存，在模板文件增删改后调用"""
+    _invalidate_json_files(TEMPLATES_DIR)
+    _invalidate_json_files(SYSTEM_TEMPLATES_DIR)
 
 def load_template(name: str) -> Dict:
     """加载提示词模板"""
     # 先检查普通模板
     template_path = TEMPLATES_DIR / f"{name}.json"
     if template_path.exists():
-        with open(template_path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return _read_json_file(template_path)
     
     # 再检查系统模板
     system_template_path = SYSTEM_TEMPLATES_DIR / f"{name}.json"
     if system_template_path.exists():
-        with open(system_template_path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return _read_json_file(system_template_path)
     
     # 如果都不存在，抛出错误
     raise FileNotFoundError(f"模板 '{name}' 不存在")
@@ -440,6 +507,23 @@ def initialize_system_templates():
         config["system_templates"] = DEFAULT_CONFIG["system_templates"]
         save_config(config)
 
+def get_settings_signature():
+    """
+    评估/优化相关设置的文件签名：配置文件、提供商配置和系统提示词模板的(修改时间, 大小)
+
+    任一文件变化（修改评估模型、API密钥、本地评估开关或编辑系统模板）时签名随之改变，
+    供按配置复用的对象判断是否需要重建
+    """
+    template_names = {
+        name for name in {**DEFAULT_CONFIG["system_templates"], **load_config().get("system_templates", {})}.values()
+        if name
+    }
+    template_paths = sorted(TEMPLATES_DIR / f"{name}.json" for name in template_names)
+    system_paths = sorted(SYSTEM_TEMPLATES_DIR.glob("*.json"))
+    return _model_files_signature() + tuple(
+        (str(path.relative_to(DATA_DIR)), _file_signature(path)) for path in template_paths + system_paths
+    )
+
 def get_system_template(template_type: str) -> Dict:
     """根据类型获取系统提示词模板"""
     config = load_config()
@@ -460,21 +544,54 @@ def save_test_set(name: str, test_set: Dict) -> None:
     """保存测试集"""
     with open(TEST_SETS_DIR / f"{name}.json", "w", encoding="utf-8") as f:
         json.dump(test_set, f, indent=2, ensure_ascii=False)
+    clear_test_set_cache()
+
+def clear_test_set_cache() -> None:
+    """清除测试集内容的读取缓存，在测试集文件增删改后调用"""
+    _invalidate_json_files(TEST_SETS_DIR)
 
 def load_test_set(name: str) -> Dict:
     """加载测试集"""
-    with open(TEST_SETS_DIR / f"{name}.json", "r", encoding="utf-8") as f:
-        return json.load(f)
+    return _read_json_file(TEST_SETS_DIR / f"{name}.json")
 
 def save_result(name: str, result: Dict) -> None:
-    """保存测试结果"""
-    with open(RESULTS_DIR / f"{name}.json", "w", encoding="utf-8") as f:
-        json.dump(result, f, indent=2, ensure_ascii=False)
+    """保存测试结果，并清理运行过程中增量写入的临时记录"""
+    # 结果中包含大量长文本响应，使用orjson序列化（原生UTF-8输出，速度明显快于json.dump）
+    with open(RESULTS_DIR / f"{name}.json", "wb") as f:
+        f.write(orjson.dumps(result, option=RESULT_DUMP_OPTIONS))
+    
+    partial_path = RESULTS_DIR / f"{name}.partial.jsonl"
+    if partial_path.exists():
+        partial_path.unlink()
+
+def save_result_append(name: str, record: Dict) -> None:
+    """测试运行过程中以JSONL格式增量追加单条结果，运行中断时已完成的结果不会丢失"""
+    with open(RESULTS_DIR / f"{name}.partial.jsonl", "ab") as f:
+        f.write(orjson.dumps(record, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS) + b"\n")
+
+def load_partial_result(name: str) -> List[Dict]:
+    """读取运行中断时增量写入的结果记录，末尾未写完整的行会被忽略；没有临时记录时返回空列表"""
+    partial_path = RESULTS_DIR / f"{name}.partial.jsonl"
+    if not partial_path.exists():
+        return []
+    records = []
+    with open(partial_path, "rb") as f:
+        for line in f:
+            try:
+                records.append(orjson.loads(line))
+            except orjson.JSONDecodeError:
+                continue
+    return records
 
 def load_result(name: str) -> Dict:
     """加载测试结果"""
-    with open(RESULTS_DIR / f"{name}.json", "r", encoding="utf-8") as f:
-        return json.load(f)
+    with open(RESULTS_DIR / f"{name}.json", "rb") as f:
+        raw = f.read()
+    try:
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        # 旧版本用 json.dump 写入的结果可能包含 NaN/Infinity，orjson 不接受
+        return json.loads(raw)
 
 def get_result_list() -> List[str]:
     """获取所有测试结果列表，按修改时间从新到旧排序"""
@@ -500,6 +617,7 @@ def delete_test_set(name: str) -> bool:
     file_path = TEST_SETS_DIR / f"{name}.json"
     if file_path.exists():
         file_path.unlink()
+        clear_test_set_cache()
         return True
     return False
 
@@ -508,6 +626,7 @@ def save_provider_config(provider_name: str, config: Dict) -> None:
     config_path = PROVIDERS_DIR / f"{provider_name}.json"
     with open(config_path, "w", encoding="utf-8") as f:
         json.dump(config, f, indent=2, ensure_ascii=False)
+    _invalidate_json_files(PROVIDERS_DIR)
 
 def load_provider_config(provider_name: str) -> Dict:
     """加载提供商配置"""
@@ -515,8 +634,7 @@ def load_provider_config(provider_name: str) -> Dict:
     if not config_path.exists():
         return dict(DEFAULT_PROVIDER_CONFIG)
     
-    with open(config_path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    return _read_json_file(config_path)
 
 def get_provider_list() -> List[str]:
     """获取所有提供商列表，包括内置和自定义提供商"""
@@ -590,6 +708,7 @@ def remove_custom_provider(provider_name: str) -> None:
     config_path = PROVIDERS_DIR / f"{provider_name}.json"
     if config_path.exists():
         config_path.unlink()
+    _invalidate_json_files(PROVIDERS_DIR)
 
 def get_concurrency_limit(provider: str = None, model: str = None) -> int:
     """获取并发限制，优先级：model > provider > global default"""
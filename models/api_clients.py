@@ -2,16 +2,57 @@ import os
 import openai
 import anthropic
 import google.generativeai as genai
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import asyncio
+import threading
+import orjson
 from typing import Dict, List, Optional, Any
 
-from config import get_api_key, load_provider_config, load_config
+from config import get_api_key, load_provider_config, load_config, get_model_provider_index
+
+# 每个客户端HTTP连接池的大小，应不小于单个提供商的最大并发数
+HTTP_POOL_MAXSIZE = 64
+
+# OpenAI异步客户端的连接池限制
+OPENAI_HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32, max_connections=HTTP_POOL_MAXSIZE)
+
+# 可重试的HTTP状态码：限流和服务端临时故障
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+def is_retryable_exception(e: Exception) -> bool:
+    """
+    按异常类型和HTTP状态码判断调用失败是否属于可重试的临时错误（限流、服务端故障、连接失败）
+
+    SDK自身的请求超时不视为可重试：一次完整的超时已经等待了很久，重试只会成倍延长阻塞时间
+    """
+    if isinstance(e, (openai.APITimeoutError, anthropic.APITimeoutError, requests.Timeout, httpx.TimeoutException)):
+        return False
+    if isinstance(e, (openai.RateLimitError, anthropic.RateLimitError)):
+        return True
+    if isinstance(e, (openai.APIConnectionError, anthropic.APIConnectionError, requests.ConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(e, (openai.APIStatusError, anthropic.APIStatusError)):
+        return e.status_code in RETRYABLE_STATUS_CODES
+    if isinstance(e, (requests.HTTPError, httpx.HTTPStatusError)) and e.response is not None:
+        return e.response.status_code in RETRYABLE_STATUS_CODES
+    # google-api-core 等其他SDK的异常通过 code 属性携带状态码
+    return getattr(e, "code", None) in RETRYABLE_STATUS_CODES
+
+def _make_pooled_session() -> requests.Session:
+    """创建带连接池的会话，同一客户端的请求复用已建立的TCP/TLS连接"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
 
 class BaseAPIClient:
     """API客户端基类"""
     def __init__(self):
+        self.session = _make_pooled_session()
         self.setup_credentials()
     
     def setup_credentials(self):
@@ -39,6 +80,7 @@ class BaseAPIClient:
         except Exception as e:
             return {
                 "error": str(e),
+                "retryable": is_retryable_exception(e),
                 "model": model
             }
     
@@ -50,6 +92,7 @@ class BaseAPIClient:
         except Exception as e:
             return {
                 "error": str(e),
+                "retryable": is_retryable_exception(e),
                 "model": model
             }
     
@@ -71,14 +114,57 @@ class BaseAPIClient:
         # 子类需要重写此方法，提供实际实现
         raise NotImplementedError("API客户端必须实现_execute_generate_with_messages_sync方法")
 
+def _openai_optional_kwargs(params: Dict) -> Dict:
+    """
+    OpenAI请求的可选参数：
+    - prompt_cache_key: OpenAI对相同前缀的请求自动启用提示词缓存，传入后共享同一系统提示词的请求路由到同一缓存
+    - response_format: 如 {"type": "json_object"}，要求模型只输出合法JSON
+    """
+    kwargs = {}
+    if params.get("prompt_cache_key"):
+        kwargs["extra_body"] = {"prompt_cache_key": params["prompt_cache_key"]}
+    if params.get("response_format"):
+        kwargs["response_format"] = params["response_format"]
+    return kwargs
+
+def _to_anthropic_messages(messages: List[Dict]):
+    """
+    将消息列表转换为Anthropic请求格式：system消息单独作为system参数，
+    并标记为可缓存，多个请求共享同一系统提示词时只需计费一次完整前缀
+    """
+    system_blocks = [
+        {"type": "text", "text": message.get("content", "")}
+        for message in messages if message.get("role") == "system"
+    ]
+    if system_blocks:
+        system_blocks[-1]["cache_control"] = {"type": "ephemeral"}
+    chat_messages = [message for message in messages if message.get("role") != "system"]
+    return system_blocks, chat_messages
+
 class OpenAIClient(BaseAPIClient):
     """OpenAI API客户端"""
     def setup_credentials(self):
         openai.api_key = get_api_key("openai")
+        # 事件循环 -> 异步客户端；httpx 连接池绑定创建时的事件循环，每个事件循环各用一个客户端
+        self._async_clients = {}
+    
+    def _async_client(self) -> openai.AsyncOpenAI:
+        """获取当前事件循环的异步客户端，同一事件循环内的请求复用连接池"""
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            # 丢弃已关闭事件循环的客户端
+            self._async_clients = {l: c for l, c in self._async_clients.items() if not l.is_closed()}
+            client = openai.AsyncOpenAI(
+                api_key=openai.api_key,
+                http_client=httpx.AsyncClient(limits=OPENAI_HTTP_LIMITS)
+            )
+            self._async_clients[loop] = client
+        return client
     
     async def generate(self, prompt: str, model: str, params: Dict) -> Dict:
         try:
-            response = await openai.chat.completions.create(
+            response = await self._async_client().chat.completions.create(
                 model=model,
                 messages=[
                     {"role": "system", "content": "You are a helpful assistant."},
@@ -86,7 +172,8 @@ class OpenAIClient(BaseAPIClient):
                 ],
                 temperature=params.get("temperature", 0.7),
                 max_tokens=params.get("max_tokens", 1000),
-                top_p=params.get("top_p", 1.0)
+                top_p=params.get("top_p", 1.0),
+                **_openai_optional_kwargs(params)
             )
             
             return {
@@ -101,21 +188,25 @@ class OpenAIClient(BaseAPIClient):
         except Exception as e:
             return {
                 "error": str(e),
+                "retryable": is_retryable_exception(e),
                 "model": model
             }
 
     async def generate_with_messages(self, messages: List[Dict], model: str, params: Dict) -> Dict:
         try:
-            response = await openai.chat.completions.create(
+            response = await self._async_client().chat.completions.create(
                 model=model,
                 messages=messages,
                 temperature=params.get("temperature", 0.7),
                 max_tokens=params.get("max_tokens", 1000),
-                top_p=params.get("top_p", 1.0)
+                top_p=params.get("top_p", 1.0),
+                n=params.get("n", 1),
+                **_openai_optional_kwargs(params)
             )
             
             return {
                 "text": response.choices[0].message.content,
+                "texts": [choice.message.content for choice in response.choices],
                 "model": model,
                 "usage": {
                     "prompt_tokens": response.usage.prompt_tokens,
@@ -126,6 +217,7 @@ class OpenAIClient(BaseAPIClient):
         except Exception as e:
             return {
                 "error": str(e),
+                "retryable": is_retryable_exception(e),
                 "model": model
             }
 
@@ -137,7 +229,8 @@ class OpenAIClient(BaseAPIClient):
                 messages=messages,
                 temperature=params.get("temperature", 0.7),
                 max_tokens=params.get("max_tokens", 1000),
-                top_p=params.get("top_p", 1.0)
+                top_p=params.get("top_p", 1.0),
+                **_openai_optional_kwargs(params)
             )
             
             return {
@@ -152,6 +245,7 @@ class OpenAIClient(BaseAPIClient):
         except Exception as e:
             return {
                 "error": str(e),
+                "retryable": is_retryable_exception(e),
                 "model": model
             }
     
@@ -194,20 +288,31 @@ class AnthropicClient(BaseAPIClient):
         except Exception as e:
             return {
                 "error": str(e),
+                "retryable": is_retryable_exception(e),
                 "model": model
             }
+    
+    async def generate_with_messages(self, messages: List[Dict], model: str, params: Dict) -> Dict:
+        """保留system消息结构以便启用提示词缓存，使用线程池执行同步请求"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None,
+            lambda: self.generate_with_messages_sync(messages, model, params)
+        )
             
     def _execute_generate_with_messages_sync(self, messages: List[Dict], model: str, params: Dict) -> Dict:
         """同步版本的消息生成方法"""
         try:
             # 转换为anthropic消息格式
-            anthropic_messages = messages
+            system_blocks, anthropic_messages = _to_anthropic_messages(messages)
+            extra_kwargs = {"system": system_blocks} if system_blocks else {}
             
             response = self.client.messages.create(
                 model=model,
                 messages=anthropic_messages,
                 max_tokens=params.get("max_tokens", 1000),
                 temperature=params.get("temperature", 0.7),
+                **extra_kwargs
             )
             
             return {
@@ -222,6 +327,7 @@ class AnthropicClient(BaseAPIClient):
         except Exception as e:
             return {
                 "error": str(e),
+                "retryable": is_retryable_exception(e),
                 "model": model
             }
     
@@ -270,6 +376,7 @@ class GoogleClient(BaseAPIClient):
         except Exception as e:
             return {
                 "error": str(e),
+                "retryable": is_retryable_exception(e),
                 "model": model
             }
             
@@ -304,6 +411,7 @@ class GoogleClient(BaseAPIClient):
         except Exception as e:
             return {
                 "error": str(e),
+                "retryable": is_retryable_exception(e),
                 "model": model
             }
 
@@ -336,7 +444,7 @@ class GenericHTTPClient(BaseAPIClient):
         
         try:
             # 创建请求会话
-            session = requests.Session()
+            session = self.session
             
             # 准备请求数据 - 使用参数映射
             mapping = self.config.get("params_mapping", {})
@@ -423,6 +531,7 @@ class GenericHTTPClient(BaseAPIClient):
         except Exception as e:
             return {
                 "error": str(e),
+                "retryable": is_retryable_exception(e),
                 "model": model
             }
     
@@ -440,7 +549,7 @@ class GenericHTTPClient(BaseAPIClient):
         
         try:
             # 创建请求会话
-            session = requests.Session()
+            session = self.session
             
             # 准备请求数据 - 使用参数映射
             mapping = self.config.get("params_mapping", {})
@@ -521,6 +630,7 @@ class GenericHTTPClient(BaseAPIClient):
         except Exception as e:
             return {
                 "error": str(e),
+                "retryable": is_retryable_exception(e),
                 "model": model
             }
     
@@ -535,7 +645,7 @@ class GenericHTTPClient(BaseAPIClient):
         
         try:
             # 创建请求会话
-            session = requests.Session()
+            session = self.session
             
             # 准备请求数据 - 使用参数映射
             mapping = self.config.get("params_mapping", {})
@@ -618,6 +728,7 @@ class GenericHTTPClient(BaseAPIClient):
         except Exception as e:
             return {
                 "error": str(e),
+                "retryable": is_retryable_exception(e),
                 "model": model
             }
     
@@ -635,7 +746,7 @@ class GenericHTTPClient(BaseAPIClient):
         
         try:
             # 创建请求会话
-            session = requests.Session()
+            session = self.session
             
             # 准备请求数据 - 使用参数映射
             mapping = self.config.get("params_mapping", {})
@@ -712,6 +823,7 @@ class GenericHTTPClient(BaseAPIClient):
         except Exception as e:
             return {
                 "error": str(e),
+                "retryable": is_retryable_exception(e),
                 "model": model
             }
 
@@ -720,12 +832,12 @@ class XAIClient(BaseAPIClient):
     def setup_credentials(self):
         self.api_key = get_api_key("xai")
         self.base_url = "https://api.x.ai/v1"
+        self.session.proxies = {}  # 禁用代理
     
     async def generate(self, prompt: str, model: str, params: Dict) -> Dict:
         try:
             # 创建请求会话
-            session = requests.Session()
-            session.proxies = {}  # 禁用代理
+            session = self.session
             
             # 准备请求数据
             data = {
@@ -770,14 +882,14 @@ class XAIClient(BaseAPIClient):
         except Exception as e:
             return {
                 "error": str(e),
+                "retryable": is_retryable_exception(e),
                 "model": model
             }
 
     async def generate_with_messages(self, messages: List[Dict], model: str, params: Dict) -> Dict:
         try:
             # 使用线程池执行同步请求
-            session = requests.Session()
-            session.proxies = {}  # 禁用代理
+            session = self.session
             
             # 准备请求数据
             data = {
@@ -819,6 +931,7 @@ class XAIClient(BaseAPIClient):
         except Exception as e:
             return {
                 "error": str(e),
+                "retryable": is_retryable_exception(e),
                 "model": model
             }
     
@@ -826,8 +939,7 @@ class XAIClient(BaseAPIClient):
         """同步版本的消息生成方法"""
         try:
             # 创建请求会话
-            session = requests.Session()
-            session.proxies = {}  # 禁用代理
+            session = self.session
             
             # 准备请求数据
             data = {
@@ -865,6 +977,7 @@ class XAIClient(BaseAPIClient):
         except Exception as e:
             return {
                 "error": str(e),
+                "retryable": is_retryable_exception(e),
                 "model": model
             }
     
@@ -918,9 +1031,11 @@ class AzureClient(BaseAPIClient):
                 "max_tokens": params.get("max_tokens", 1000),
                 "top_p": params.get("top_p", 1.0)
             }
+            if params.get("n", 1) > 1:
+                data["n"] = params["n"]
             
             # 使用线程池执行同步请求
-            session = requests.Session()
+            session = self.session
             loop = asyncio.get_running_loop()
             response = await loop.run_in_executor(
                 None,
@@ -938,6 +1053,7 @@ class AzureClient(BaseAPIClient):
             # 构造结果格式 (遵循OpenAI格式)
             return {
                 "text": result["choices"][0]["message"]["content"],
+                "texts": [choice["message"]["content"] for choice in result["choices"]],
                 "model": model,
                 "usage": result.get("usage", {
                     "prompt_tokens": 0,
@@ -948,6 +1064,7 @@ class AzureClient(BaseAPIClient):
         except Exception as e:
             return {
                 "error": str(e),
+                "retryable": is_retryable_exception(e),
                 "model": model
             }
     
@@ -986,7 +1103,7 @@ class AzureClient(BaseAPIClient):
             }
             
             # 执行同步请求
-            session = requests.Session()
+            session = self.session
             response = session.post(
                 url,
                 json=data,
@@ -1010,6 +1127,7 @@ class AzureClient(BaseAPIClient):
         except Exception as e:
             return {
                 "error": str(e),
+                "retryable": is_retryable_exception(e),
                 "model": model
             }
     
@@ -1021,8 +1139,27 @@ class AzureClient(BaseAPIClient):
         ]
         return self._execute_generate_with_messages_sync(messages, model, params)
 
+# 支持通过 n 参数在单次请求中返回多个采样结果的提供商
+N_SAMPLING_PROVIDERS = {"openai", "azure"}
+
+def supports_n_sampling(provider: str) -> bool:
+    """判断提供商是否支持 n 参数（单次请求返回多个候选结果）"""
+    return provider in N_SAMPLING_PROVIDERS
+
+# 已创建的客户端：提供商 -> (凭据指纹, 客户端)，所有调用共用客户端及其连接池
+_CLIENT_CACHE: Dict[str, tuple] = {}
+_CLIENT_CACHE_LOCK = threading.Lock()
+
+def _credentials_fingerprint(provider: str, config: Dict) -> str:
+    """客户端创建时读取的凭据和端点配置，变化后需要重新创建客户端"""
+    fingerprint = config["api_keys"].get(provider, "")
+    if provider not in ("openai", "anthropic", "google", "xai"):
+        # Azure 和自定义提供商的端点等配置保存在提供商配置文件中
+        fingerprint += orjson.dumps(load_provider_config(provider), option=orjson.OPT_SORT_KEYS).decode()
+    return fingerprint
+
 def get_client(provider: str) -> BaseAPIClient:
-    """获取指定提供商的API客户端"""
+    """获取指定提供商的API客户端，凭据未变化时复用已创建的客户端"""
     config = load_config()
     
     # 内置提供商
@@ -1036,28 +1173,28 @@ def get_client(provider: str) -> BaseAPIClient:
     
     # 检查是否为内置提供商
     if provider in built_in_clients:
-        return built_in_clients[provider]()
-    
+        factory = built_in_clients[provider]
     # 检查是否为自定义提供商
-    if provider in config.get("custom_providers", []):
-        return GenericHTTPClient(provider)
+    elif provider in config.get("custom_providers", []):
+        factory = lambda: GenericHTTPClient(provider)
+    else:
+        raise ValueError(f"不支持的API提供商: {provider}")
     
-    raise ValueError(f"不支持的API提供商: {provider}")
+    fingerprint = _credentials_fingerprint(provider, config)
+    with _CLIENT_CACHE_LOCK:
+        cached = _CLIENT_CACHE.get(provider)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+        client = factory()
+        _CLIENT_CACHE[provider] = (fingerprint, client)
+        return client
 
 def get_provider_from_model(model: str) -> str:
     """根据模型名称获取提供商"""
-    config = load_config()
-    
-    # 检查内置提供商的模型
-    for provider, models in config["models"].items():
-        if model in models:
-            return provider
-    
-    # 检查自定义提供商的模型
-    for provider_name in config.get("custom_providers", []):
-        provider_config = load_provider_config(provider_name)
-        if model in provider_config.get("models", []):
-            return provider_name
+    # 内置和自定义提供商的模型统一查缓存的反向索引
+    provider = get_model_provider_index().get(model)
+    if provider:
+        return provider
     
     # 如果找不到模型，尝试从模型名称推断提供商
     if model.startswith("gpt-"):
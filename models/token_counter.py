@@ -1,61 +1,75 @@
 import tiktoken
+from functools import lru_cache
 from typing import Dict, List, Optional, Any
 
-def count_tokens(text: str, model: str = "gpt-4") -> int:
-    """计算文本的token数量"""
-    model_map = {
-        # OpenAI models
-        "gpt-3.5-turbo": "cl100k_base",
-        "gpt-4": "cl100k_base",
-        "gpt-4o": "cl100k_base",
-        
-        # Anthropic models (approximation)
-        "claude-3-opus-20240229": "cl100k_base",
-        "claude-3-sonnet-20240229": "cl100k_base",
-        "claude-3-haiku-20240307": "cl100k_base",
-        
-        # Google models (approximation)
-        "gemini-1.0-pro": "cl100k_base",
-        "gemini-1.5-pro": "cl100k_base",
+# 模型到tiktoken编码器的映射
+MODEL_ENCODER_MAP = {
+    # OpenAI models
+    "gpt-3.5-turbo": "cl100k_base",
+    "gpt-4": "cl100k_base",
+    "gpt-4o": "cl100k_base",
+    
+    # Anthropic models (approximation)
+    "claude-3-opus-20240229": "cl100k_base",
+    "claude-3-sonnet-20240229": "cl100k_base",
+    "claude-3-haiku-20240307": "cl100k_base",
+    
+    # Google models (approximation)
+    "gemini-1.0-pro": "cl100k_base",
+    "gemini-1.5-pro": "cl100k_base",
+
 
+    "grok-3": "cl100k_base",
+}
 
-        "grok-3": "cl100k_base",
-    }
+# 价格表（每1000个token的价格，分输入和输出）
+# 数据来源: https://openai.com/pricing 等官方价格，可能需要更新
+PRICE_MAP = {
+    # OpenAI models - [input_price, output_price] per 1K tokens
+    "gpt-3.5-turbo": [0.0005, 0.0015],
+    "gpt-4": [0.03, 0.06],
+    "gpt-4o": [0.01, 0.03],
     
+    # Anthropic models
+    "claude-3-opus-20240229": [0.015, 0.075],
+    "claude-3-sonnet-20240229": [0.003, 0.015],
+    "claude-3-haiku-20240307": [0.00025, 0.00125],
+    
+    # Google models (approximation)
+    "gemini-1.0-pro": [0.0025, 0.0025],  # 单一价格
+    "gemini-1.5-pro": [0.0025, 0.0025],  # 单一价格
+
+
+    "grok-3": [0.003, 0.015],  # 单一价格
+}
+
+# 默认使用GPT-3.5价格
+DEFAULT_PRICE = [0.0005, 0.0015]
+
+@lru_cache(maxsize=None)
+def _get_encoder(encoder_name: str):
+    """获取tiktoken编码器，每种编码只初始化一次"""
+    return tiktoken.get_encoding(encoder_name)
+
+@lru_cache(maxsize=1024)
+def count_tokens(text: str, model: str = "gpt-4") -> int:
+    """计算文本的token数量"""
     # 默认使用cl100k_base编码器
-    encoder_name = model_map.get(model, "cl100k_base")
-    encoder = tiktoken.get_encoding(encoder_name)
+    encoder = _get_encoder(MODEL_ENCODER_MAP.get(model, "cl100k_base"))
     
-    # 编码并计数
-    token_count = len(encoder.encode(text))
+    # 编码并计数（encode_ordinary 跳过特殊token检查，且文本中出现特殊token时不会报错）
+    token_count = len(encoder.encode_ordinary(text))
     return token_count
 
+def count_tokens_batch(texts: List[str], model: str = "gpt-4") -> List[int]:
+    """批量计算多段文本的token数量，由tiktoken在原生线程池中并行编码"""
+    encoder = _get_encoder(MODEL_ENCODER_MAP.get(model, "cl100k_base"))
+    return [len(tokens) for tokens in encoder.encode_ordinary_batch(texts)]
+
+@lru_cache(maxsize=1024)
 def estimate_cost(token_count: int, model: str) -> float:
     """估算API调用成本（美元）"""
-    # 价格表（每1000个token的价格，分输入和输出）
-    # 数据来源: https://openai.com/pricing 等官方价格，可能需要更新
-    price_map = {
-        # OpenAI models - [input_price, output_price] per 1K tokens
-        "gpt-3.5-turbo": [0.0005, 0.0015],
-        "gpt-4": [0.03, 0.06],
-        "gpt-4o": [0.01, 0.03],
-        
-        # Anthropic models
-        "claude-3-opus-20240229": [0.015, 0.075],
-        "claude-3-sonnet-20240229": [0.003, 0.015],
-        "claude-3-haiku-20240307": [0.00025, 0.00125],
-        
-        # Google models (approximation)
-        "gemini-1.0-pro": [0.0025, 0.0025],  # 单一价格
-        "gemini-1.5-pro": [0.0025, 0.0025],  # 单一价格
-
-
-        "grok-3": [0.003, 0.015],  # 单一价格
-    }
-    
-    # 默认使用GPT-3.5价格
-    default_price = [0.0005, 0.0015]
-    input_price, output_price = price_map.get(model, default_price)
+    input_price, output_price = PRICE_MAP.get(model, DEFAULT_PRICE)
     
     # 简单估算 (假设输入输出token相等)
     input_tokens = token_count // 2
@@ -63,4 +77,4 @@ def estimate_cost(token_count: int, model: str) -> float:
     
     total_cost = (input_tokens / 1000 * input_price) + (output_tokens / 1000 * output_price)
     
-    return total_cost
\ No newline at end of file
+    return total_cost
@@ -1,3 +1,4 @@
+import time
 import streamlit as st
 from config import get_available_models
 from models.api_clients import get_provider_from_model
@@ -7,11 +8,34 @@ import plotly.express as px
 import matplotlib.pyplot as plt
 
 from utils.common import (
-    calculate_average_score, 
-    get_dimension_scores, 
+    compute_all_metrics,
     create_dimension_radar_chart
 )
 
+# 进度条和状态文字的最小刷新间隔（秒）
+PROGRESS_UPDATE_INTERVAL = 0.2
+
+def make_throttled_progress(progress_bar, status_text, format_status, min_interval=PROGRESS_UPDATE_INTERVAL):
+    """创建节流的进度回调
+    
+    回调参数为(已完成数, 总数)。每次更新进度条和状态文字都会向前端发送消息，
+    最多每 min_interval 秒刷新一次，完成时总是刷新
+    
+    返回: 进度回调函数
+    """
+    last_update_ts = 0.0
+    
+    def update(current, total):
+        nonlocal last_update_ts
+        now = time.monotonic()
+        if now - last_update_ts < min_interval and current < total:
+            return
+        last_update_ts = now
+        progress_bar.progress(min(current / total, 1.0) if total > 0 else 0)
+        status_text.text(format_status(current, total))
+    
+    return update
+
 def select_single_model(key_prefix="model", help_text=None):
     """单模型选择器组件
     
@@ -81,11 +105,10 @@ def display_test_summary(results, template, model):
     """显示测试结果摘要"""
     st.subheader("测试结果摘要")
     
-    # 计算平均分数
-    avg_score = calculate_average_score(results)
-    
-    # 获取维度评分
-    dimension_scores = get_dimension_scores(results)
+    # 一次遍历同时计算平均分数和维度评分
+    metrics = compute_all_metrics(results)
+    avg_score = metrics["average_score"]
+    dimension_scores = metrics["dimension_scores"]
     
     # 显示测试结果摘要
     col1, col2 = st.columns(2)
@@ -154,6 +154,10 @@ def render_prompt_auto_optimization():
         with col2:
             temperature = st.slider("温度 (Temperature)", 0.0, 2.0, 0.7, 0.1)
             auto_save_best = st.checkbox("自动保存每轮最佳提示词", value=True)
+            early_stop_patience = st.number_input(
+                "提前停止轮数 (0表示不启用)", min_value=0, max_value=100, value=0, step=1,
+                help="最佳分数连续多少轮未提升，或最近这么多轮平均分已收敛时，提前结束优化"
+            )
             log_detail_level = st.selectbox(
                 "日志详细程度",
                 ["简洁", "标准", "详细"],
@@ -179,6 +183,11 @@ def render_prompt_auto_optimization():
                     st.error("请先选择提示词模板和模型")
                     return
                 
+                # 上一次运行的迭代历史文件不再需要
+                if "auto_optimizer" in st.session_state:
+                    st.session_state.auto_optimizer.mark_completed()
+                    st.session_state.auto_optimizer.discard_history()
+                
                 # 重置优化结果以开始新的优化过程
                 st.session_state.auto_optimization_results = {"iterations": [], "current_best": None, "logs": []}
                 st.session_state.auto_optimization_running = True
@@ -202,6 +211,7 @@ def render_prompt_auto_optimization():
                     "auto_save_best": auto_save_best,
                     "optimization_retries": optimization_retries, # Add optimization_retries to config
                     "log_detail_level": log_detail_level,
+                    "early_stop_patience": early_stop_patience,
                     "start_time": time.time()
                 }
                 
@@ -219,7 +229,10 @@ def render_prompt_auto_optimization():
                     optimization_strategy=optimization_strategy,
                     temperature=temperature,
                     target_score=target_score,
-                    optimization_retries=optimization_retries # Pass optimization_retries to optimizer
+                    optimization_retries=optimization_retries, # Pass optimization_retries to optimizer
+                    patience=early_stop_patience,
+                    plateau_window=early_stop_patience,
+                    debug_logs=log_detail_level != "简洁"
                 )
                 
                 # 重新加载页面以显示优化过程界面
@@ -227,6 +240,10 @@ def render_prompt_auto_optimization():
         
         with col2:
             if st.button("清除历史记录"):
+                if "auto_optimizer" in st.session_state:
+                    st.session_state.auto_optimizer.mark_completed()
+                    st.session_state.auto_optimizer.discard_history()
+                    del st.session_state.auto_optimizer
                 if "auto_optimization_results" in st.session_state:
                     del st.session_state.auto_optimization_results
                 if "auto_optimization_config" in st.session_state:
@@ -274,7 +291,10 @@ def display_running_optimization():
             optimization_strategy=config['optimization_strategy'],
             temperature=config['temperature'],
             target_score=config['target_score'],
-            optimization_retries=config.get('optimization_retries', 3) # Pass optimization_retries, with a default
+            optimization_retries=config.get('optimization_retries', 3), # Pass optimization_retries, with a default
+            patience=config.get('early_stop_patience', 0),
+            plateau_window=config.get('early_stop_patience', 0),
+            debug_logs=config.get('log_detail_level', "标准") != "简洁"
         )
     
     # 进度条和控制按钮
@@ -298,6 +318,9 @@ def display_running_optimization():
         if st.button("🛑 终止优化"):
             st.session_state.auto_optimization_running = False
             if "auto_optimizer" in st.session_state:
+                # 标记完成后后台预取不再发起新的模型调用
+                st.session_state.auto_optimizer.mark_completed()
+                st.session_state.auto_optimizer.discard_history()
                 del st.session_state.auto_optimizer
             st.success("优化已终止")
             time.sleep(1)
@@ -365,8 +388,15 @@ def run_optimization_step(progress_bar, status_text, log_container, iterations_c
         elapsed_time = time.time() - config['start_time']
         status_text.info(f"正在执行第 {current_iter + 1}/{config['max_iterations']} 轮优化... 已用时间: {elapsed_time:.1f}秒")
         
-        # 执行一步优化，收集结果
-        result = auto_optimizer.run_single_iteration()
+        # 逐阶段执行一步优化，每个阶段完成后立即更新状态，收集最终结果
+        result = None
+        for phase in auto_optimizer.run_single_iteration_streaming():
+            if phase["phase"] == "cases":
+                status_text.info(f"第 {current_iter + 1} 轮: 已生成 {len(phase['data'])} 个测试用例，正在运行测试...")
+            elif phase["phase"] == "tests":
+                status_text.info(f"第 {current_iter + 1} 轮: 测试平均得分 {phase['data']['score']:.2f}，正在优化提示词...")
+            elif phase["phase"] == "done":
+                result = phase["data"]
         
         # 记录日志
         if "auto_optimization_logs" not in st.session_state:
@@ -11,6 +11,10 @@ from config import (
     DEFAULT_SYSTEM_TEMPLATES
 )
 from models.token_counter import count_tokens
+from utils.common import static_prompt_prefix
+
+# 模板第一个变量之前的固定文本占比低于该值时提示调整变量位置
+PREFIX_CACHE_MIN_RATIO = 0.6
 
 def render_prompt_editor():
     st.title("📝 提示词编辑器")
@@ -67,11 +71,12 @@ def render_user_templates():
                     if st.button("🗑️", key=f"del_{template_name}"):
                         if st.session_state.get("delete_confirm", None) == template_name:
                             # 真正删除
-                            from config import TEMPLATES_DIR
+                            from config import TEMPLATES_DIR, clear_template_cache
                             import os
                             file_path = TEMPLATES_DIR / f"{template_name}.json"
                             if file_path.exists():
                                 os.remove(file_path)
+                                clear_template_cache()
                                 st.success(f"模板 '{template_name}' 已删除")
                                 st.session_state.current_prompt_template = None
                                 st.session_state.is_new_template = None
@@ -178,7 +183,7 @@ def render_template_editor(template):
         st.metric("Token数量", token_count)
         
         for model in ["gpt-3.5-turbo", "gpt-4"]:
-            cost = format(count_tokens(template["template"]) / 1000 * 0.01, '.4f')
+            cost = format(token_count / 1000 * 0.01, '.4f')
             st.write(f"{model}: 约${cost}美元/次")
     
     st.subheader("提示词模板")
@@ -189,6 +194,11 @@ def render_template_editor(template):
         help="使用{{变量名}}格式插入变量"
     )
     
+    # 变量出现在模板靠前位置时，各用例共享的固定前缀很短，提供商的前缀缓存难以命中
+    prefix_len = len(static_prompt_prefix(template))
+    if prefix_len < len(template["template"]) * PREFIX_CACHE_MIN_RATIO:
+        st.caption("💡 变量位于模板靠前位置：将固定的说明放在前面、变量放在末尾，可提高提供商前缀缓存的命中率，降低延迟和输入费用")
+    
     st.subheader("变量设置")
     
     # 提取模板中的变量
@@ -22,6 +22,7 @@ from utils.common import (
     save_optimized_template
 )
 from ui.components import (
+    make_throttled_progress,
     display_test_summary,
     display_response_tabs,
     display_evaluation_results,
@@ -136,13 +137,15 @@ def render_prompt_optimization():
                 status_text = st.empty()
                 status_text.text(f"准备开始... 总共 {total_attempts} 次模型调用")
 
+                refresh_progress = make_throttled_progress(
+                    progress_bar, status_text,
+                    lambda current, total: f"运行中... 已完成 {current}/{total} 次模型调用"
+                )
+
                 def update_progress():
                     nonlocal completed_attempts
                     completed_attempts += 1
-                    progress = completed_attempts / total_attempts if total_attempts > 0 else 0
-                    progress = min(progress, 1.0)
-                    progress_bar.progress(progress)
-                    status_text.text(f"运行中... 已完成 {completed_attempts}/{total_attempts} 次模型调用")
+                    refresh_progress(completed_attempts, total_attempts)
                 # --- End Progress Bar Setup ---
 
                 # 开始测试
@@ -399,10 +402,10 @@ def render_iterative_optimization():
                         }
                         
                         # 定义进度回调函数
-                        def update_generation_progress(current, total):
-                            progress = min(current / total, 1.0) if total > 0 else 0
-                            generation_progress_bar.progress(progress)
-                            generation_status_text.text(f"正在生成测试用例... 已完成: {current}/{total}")
+                        update_generation_progress = make_throttled_progress(
+                            generation_progress_bar, generation_status_text,
+                            lambda current, total: f"正在生成测试用例... 已完成: {current}/{total}"
+                        )
                         
                         # 批量生成测试用例，传入进度回调函数
                         batch_result = evaluator.generate_test_cases_batch(
@@ -432,10 +435,10 @@ def render_iterative_optimization():
                     generation_status_text.text("正在生成通用测试集...")
                     
                     # 定义进度回调函数
-                    def update_generation_progress(current, total):
-                        progress = min(current / total, 1.0) if total > 0 else 0
-                        generation_progress_bar.progress(progress)
-                        generation_status_text.text(f"正在生成测试用例... 已完成: {current}/{total}")
+                    update_generation_progress = make_throttled_progress(
+                        generation_progress_bar, generation_status_text,
+                        lambda current, total: f"正在生成测试用例... 已完成: {current}/{total}"
+                    )
                     
                     result = evaluator.generate_complete_test_set(
                         name=test_set_name,
@@ -35,8 +35,11 @@ def render_results_viewer():
     if not selected_result:
         return
     
-    # 加载选择的结果
-    results = load_result(selected_result)
+    # 加载选择的结果（刚运行完的测试直接使用内存中的结果，避免重新读取磁盘）
+    if selected_result == st.session_state.get("last_result") and "last_result_data" in st.session_state:
+        results = st.session_state.last_result_data
+    else:
+        results = load_result(selected_result)
     
     # 展示结果概览
     st.subheader("测试概览")
@@ -90,7 +93,8 @@ def render_results_viewer():
     st.subheader("📝 提示词优化")
     
     # 找出最好和最差的提示词
-    avg_scores = {name: calculate_average_score(data) for name, data in results.items()}
+    # 概览表中已为每个提示词计算过平均分，直接复用
+    avg_scores = {name: row["平均分数"] for name, row in overview.items()}
     
     if avg_scores:
         best_prompt = max(avg_scores.items(), key=lambda x: x[1])
@@ -10,6 +10,7 @@ from utils.test_set_manager import (
     generate_unique_id, filter_test_cases, sort_test_cases, ensure_unique_id
 )
 from utils.test_case_generator import batch_generate_expected_outputs
+from utils.common import generate_evaluation_criteria_batch
 from utils.evaluator import PromptEvaluator
 from ui.test_case_view import (
     display_test_case_list, display_test_case_editor,
@@ -327,12 +328,9 @@ def render_batch_operations():
                     try:
                         evaluator = PromptEvaluator()
                         
-                        # 创建事件循环并运行异步函数
-                        import asyncio
-                        loop = asyncio.new_event_loop()
-                        asyncio.set_event_loop(loop)
-                        result = loop.run_until_complete(evaluator.generate_user_inputs(test_set_desc, gen_inputs_count))
-                        loop.close()
+                        # 在共享的后台事件循环上运行异步函数
+                        from utils.parallel_executor import run_coro_sync
+                        result = run_coro_sync(evaluator.generate_user_inputs(test_set_desc, gen_inputs_count))
                         
                         if "error" in result:
                             st.error(f"生成用户输入失败: {result['error']}")
@@ -423,10 +421,11 @@ def render_batch_operations():
                         status_text = st.empty()
                         
                         # 定义进度回调函数
-                        def update_progress(current, total):
-                            progress = current / total if total > 0 else 0
-                            progress_bar.progress(progress)
-                            status_text.text(f"正在处理: {current}/{total}")
+                        from ui.components import make_throttled_progress
+                        update_progress = make_throttled_progress(
+                            progress_bar, status_text,
+                            lambda current, total: f"正在处理: {current}/{total}"
+                        )
                         
                         # 调用批量生成函数
                         result = batch_generate_expected_outputs(
@@ -468,26 +467,23 @@ def render_batch_operations():
                         progress_bar = st.progress(0)
                         status_text = st.empty()
                         
-                        for i, case in enumerate(cases_to_fill):
-                            status_text.text(f"正在处理测试用例 {i+1}/{len(cases_to_fill)}: {case.get('description', 'Case '+str(i+1))}")
-                            try:
-                                result = generate_evaluation_criteria(
-                                    case.get("description", ""),
-                                    case.get("user_input", ""),
-                                    case.get("expected_output", "")
-                                )
-                                
-                                if "error" in result:
-                                    st.error(f"为测试用例 '{case.get('description', 'Case '+str(i+1))}' 生成评估标准失败: {result['error']}")
-                                else:
-                                    for test_case in test_set["cases"]:
-                                        if test_case.get("id") == case.get("id"):
-                                            test_case["evaluation_criteria"] = result["criteria"]
-                                            break
-                            except Exception as e:
-                                st.error(f"生成评估标准时出错: {str(e)}")
-                            
-                            progress_bar.progress((i + 1) / len(cases_to_fill))
+                        from ui.components import make_throttled_progress
+                        update_progress = make_throttled_progress(
+                            progress_bar, status_text,
+                            lambda current, total: f"正在生成评估标准: {current}/{total}"
+                        )
+                        
+                        # 所有用例的评估标准并发生成
+                        results = generate_evaluation_criteria_batch(cases_to_fill, progress_callback=update_progress)
+                        
+                        for i, (case, result) in enumerate(zip(cases_to_fill, results)):
+                            if "error" in result:
+                                st.error(f"为测试用例 '{case.get('description', 'Case '+str(i+1))}' 生成评估标准失败: {result['error']}")
+                            else:
+                                for test_case in test_set["cases"]:
+                                    if test_case.get("id") == case.get("id"):
+                                        test_case["evaluation_criteria"] = result["criteria"]
+                                        break
                         
                         status_text.text("✅ 批量生成评估标准完成!")
                         save_test_set(test_set["name"], test_set)
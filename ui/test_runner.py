@@ -1,19 +1,29 @@
 import streamlit as st
 import json
-import pandas as pd
 import asyncio
+import functools
+import threading
+from collections import defaultdict
 from datetime import datetime
 import time
 # 修改导入方式
-from config import get_template_list, load_template, get_test_set_list, load_test_set, save_result, get_available_models, load_config
+from config import get_template_list, load_template, get_test_set_list, load_test_set, save_result, save_result_append, load_partial_result, get_available_models, load_config
 from models.api_clients import get_client, get_provider_from_model
-from models.token_counter import count_tokens, estimate_cost
+from models.token_counter import count_tokens, count_tokens_batch, estimate_cost
 from utils.evaluator import PromptEvaluator
-from utils.common import render_prompt_template, run_test
+from utils.common import make_prompt_renderer, run_test, resolve_model_provider, new_running_stats, update_running_stats, summarize_running_stats, SCORE_DIMENSIONS, CACHEABLE_TEMPERATURE, MIN_RESPONSE_TOKENS
+from utils.batch_runner import supports_batch_api, submit_test_batch, collect_test_batch, BATCH_COST_FACTOR
+from utils.llm_cache import clear_llm_cache
+from ui.components import make_throttled_progress, PROGRESS_UPDATE_INTERVAL
 
 def render_test_runner():
     st.title("🧪 测试运行")
     
+    # 已提交、尚未收取结果的Batch任务
+    render_pending_batch_jobs()
+    # 上次被停止或打断的测试运行，保存其已完成的结果
+    recover_interrupted_test_run()
+    
     # 选择要测试的提示词模板和测试集
     col1, col2 = st.columns(2)
     
@@ -112,6 +122,38 @@ def render_test_runner():
         temperature = st.slider("Temperature", 0.0, 2.0, 0.7, 0.1)
         max_tokens = st.slider("最大输出Token", 100, 4000, 1000, 100)
         repeat_count = st.slider("每个测试重复次数", 1, 5, 2, 1)
+        # 只有选中了支持Batch API的模型时才提供该选项
+        batch_capable_models = [m for m in selected_models if supports_batch_api(st.session_state.model_provider_map.get(m))]
+        use_batch_api = bool(batch_capable_models) and st.checkbox(
+            "使用Batch API (24小时内完成，费用减半)",
+            value=False,
+            help=f"仅对支持Batch API的模型生效（{', '.join(batch_capable_models)}），其他模型仍使用实时调用。"
+                 "任务提交后立即返回，稍后在本页顶部收取结果"
+        )
+        batch_size = st.number_input(
+            "批处理大小", 1, 10, 1,
+            help="将共享同一提示词的多个测试用例合并到一次请求中，按JSON列表返回各自的回答，可大幅减少提示词token消耗。"
+                 "同一请求中的所有回答共享最大输出Token"
+        )
+        if batch_size > 1 and max_tokens // batch_size < MIN_RESPONSE_TOKENS:
+            st.warning(
+                f"批处理大小为 {batch_size} 时每个用例平均只有约 {max_tokens // batch_size} 个输出Token，回答可能被截断。"
+                "请提高最大输出Token或减小批处理大小"
+            )
+        adaptive_max_tokens = st.checkbox(
+            "按期望输出长度收紧Token上限",
+            value=False,
+            help="勾选后有期望输出的用例按其长度的若干倍设置回答上限（不超过最大输出Token），短答案更早停止生成；"
+                 "期望输出明显短于合理回答时可能截断回答"
+        )
+        force_rerun = st.checkbox(
+            "强制重跑（忽略缓存）",
+            value=False,
+            help=f"温度低于{CACHEABLE_TEMPERATURE}时，相同模型、参数和提示词的响应会从本地缓存读取；勾选后重新调用模型并刷新缓存。较高温度下始终重新调用"
+        )
+        if st.button("清空响应缓存", help="删除本地缓存的全部模型响应"):
+            clear_llm_cache()
+            st.success("响应缓存已清空")
     
     # 显示当前的评估器设置（而不是允许更改）
     config = load_config()
@@ -131,13 +173,11 @@ def render_test_runner():
     st.subheader("测试预览")
     
     # 获取模型显示信息
-    model_display_info = []
-    for model in selected_models:
-        provider = st.session_state.model_provider_map.get(model, "未知提供商")
-        model_display_info.append(f"{model} ({provider})")
+    model_provider_map = st.session_state.model_provider_map
+    model_display_info = "、".join(f"{model} ({model_provider_map.get(model, '未知提供商')})" for model in selected_models)
     
     preview_data = {
-        "提示词模板": [t["name"] for t in templates],
+        "提示词模板": "、".join(t["name"] for t in templates),
         "测试集": test_set["name"],
         "测试用例数": len(test_set["cases"]),
         "选择的模型": model_display_info,
@@ -145,26 +185,46 @@ def render_test_runner():
         "评估器模型": current_evaluator
     }
     
-    st.json(preview_data)
+    st.table([{"项": k, "值": str(v)} for k, v in preview_data.items()])
     
-    # 估算测试成本和时间
-    total_calls = len(templates) * len(test_set["cases"]) * len(selected_models) * repeat_count
-    avg_token_count = 1000  # 假设平均每次调用1000个token
-    total_tokens = total_calls * avg_token_count
+    # 测试估算需要渲染全部提示词并计数token，放在勾选框后，避免每次调整参数都重新计算
+    # 未计算时 unique_prompts 为 None，run_tests 会自行渲染
+    unique_prompts = None
+    if st.checkbox("显示测试估算", value=False):
+        # (模板, 用例)的渲染结果与模型无关：只渲染、计数一次，估算和运行测试时所有模型共用
+        renderers = {t["name"]: make_prompt_renderer(t, test_set) for t in templates}
+        unique_prompts = {
+            (name, case.get("id", "")): render(case)
+            for name, render in renderers.items() for case in test_set["cases"]
+        }
+        case_inputs = {case.get("id", ""): case.get("user_input", "") for case in test_set["cases"]}
+        input_texts = [f"{prompt}\n{case_inputs[case_id]}" for (_, case_id), prompt in unique_prompts.items()]
+        input_tokens = sum(count_tokens_batch(input_texts)) if input_texts else 0
     
-    # 估算成本（非常粗略）
-    estimated_cost = sum([estimate_cost(avg_token_count, model) * len(test_set["cases"]) * repeat_count for model in selected_models])
+        # 估算测试成本和时间
+        total_calls = len(unique_prompts) * len(selected_models) * repeat_count
+        # 按实际输入token数估算，假设输出token数与输入相当
+        avg_token_count = 2 * input_tokens // len(unique_prompts) if unique_prompts else 0
+        total_tokens = total_calls * avg_token_count
     
-    # 估算时间（假设每次调用平均2秒）
-    estimated_time = total_calls * 2
+        # 估算成本（非常粗略）
+        # Batch API 的折扣只适用于走批处理的模型
+        cost_per_call = {
+            model: estimate_cost(avg_token_count, model) * (BATCH_COST_FACTOR if use_batch_api and model in batch_capable_models else 1)
+            for model in selected_models
+        }
+        estimated_cost = sum(cost_per_call.values()) * len(unique_prompts) * repeat_count
     
-    st.info(f"""
-    ### 测试估算
-    - 总API调用次数: {total_calls}
-    - 预估Token数量: {total_tokens}
-    - 预估成本: ${estimated_cost:.2f}
-    - 预估完成时间: {estimated_time} 秒 (约 {estimated_time//60}分{estimated_time%60}秒)
-    """)
+        # 估算时间（假设每次调用平均2秒）
+        estimated_time = total_calls * 2
+    
+        st.info(f"""
+        ### 测试估算
+        - 总API调用次数: {total_calls}
+        - 预估Token数量: {total_tokens}
+        - 预估成本: ${estimated_cost:.2f}
+        - 预估完成时间: {estimated_time} 秒 (约 {estimated_time//60}分{estimated_time%60}秒)
+        """)
     
     # 运行测试
     if st.button("▶️ 运行测试", type="primary"):
@@ -175,53 +235,267 @@ def render_test_runner():
             temperature=temperature,
             max_tokens=max_tokens,
             repeat_count=repeat_count,
-            test_mode=test_mode
+            test_mode=test_mode,
+            use_batch_api=use_batch_api,
+            batch_size=batch_size,
+            use_cache=not force_rerun,
+            adaptive_max_tokens=adaptive_max_tokens,
+            model_provider_map=model_provider_map,
+            rendered_prompts=unique_prompts
         )
 
-def run_tests(templates, test_set, selected_models, temperature, max_tokens, repeat_count, test_mode):
+def build_template_result(template, test_set, models, temperature, max_tokens, model_results):
+    """将同一模板下各模型的 run_test 结果合并为按模板保存的结果结构"""
+    # Flatten into a single list; add model info to each case if not already present
+    for res in model_results:
+        for case in res.get("test_cases", []):
+            case.setdefault("model", res.get("model"))
+    return {
+        "template": template,
+        "test_set": test_set["name"],
+        "models": models, # List all models tested with this template
+        "params": {
+            "temperature": temperature,
+            "max_tokens": max_tokens
+        },
+        "test_cases": [case for res in model_results for case in res.get("test_cases", [])] # Combined cases from all models for this template
+    }
+
+def render_pending_batch_jobs():
+    """展示已提交的Batch任务，按需查询状态并在任务结束后收取、评估和保存结果"""
+    jobs = st.session_state.get("pending_batch_jobs", [])
+    if not jobs:
+        return
+    
+    st.subheader("⏳ 进行中的Batch任务")
+    for job in list(jobs):
+        batch_id = job["batch_id"]
+        submitted = datetime.fromtimestamp(job["submitted_at"]).strftime("%Y-%m-%d %H:%M:%S")
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            st.write(f"**{batch_id}** | 模板: {', '.join(t['name'] for t in job['templates'])} | "
+                     f"模型: {', '.join(job['models'])} | 提交于 {submitted}")
+        with col2:
+            if not st.button("查询/收取结果", key=f"collect_batch_{batch_id}"):
+                continue
+        
+        with st.spinner("正在查询Batch任务..."):
+            try:
+                status, batch_results = collect_test_batch(job)
+            except Exception as e:
+                st.error(f"查询Batch任务失败: {str(e)}")
+                continue
+        
+        if batch_results is None:
+            st.info(f"Batch任务 {batch_id} 尚未完成，当前状态: {status}")
+            continue
+        
+        results = {}
+        for template in job["templates"]:
+            model_results = [batch_results[(template["name"], model)] for model in job["models"] if (template["name"], model) in batch_results]
+            if model_results:
+                results[template["name"]] = build_template_result(
+                    template, job["test_set"], job["models"], job["temperature"], job["max_tokens"], model_results
+                )
+        result_name = f"batch_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        save_result(result_name, results)
+        jobs.remove(job)
+        st.success(f"Batch任务 {batch_id} 已结束（{status}），结果已保存: {result_name}")
+
+def request_test_stop():
+    """停止按钮的回调：通知仍在后台执行的请求和评估不再继续"""
+    stop_event = st.session_state.get("test_stop_event")
+    if stop_event:
+        stop_event.set()
+
+def recover_interrupted_test_run():
+    """
+    按增量写入的临时记录重建并保存被中断的测试运行的结果
+
+    点击停止按钮（或运行中操作其他控件）会触发页面重新运行，原运行在下一次调用 st.* 时被打断，
+    来不及执行末尾的保存；已完成用例的记录已逐条追加到临时文件，在这里合并为正式结果
+    """
+    run = st.session_state.pop("active_test_run", None)
+    if not run:
+        return
+    
+    records = load_partial_result(run["result_name"])
+    if not records:
+        st.info("上次测试运行已停止，没有已完成的用例结果")
+        return
+    
+    cases_by_template = defaultdict(lambda: defaultdict(list))
+    for record in records:
+        template_name = record.pop("template", None)
+        cases_by_template[template_name][record.get("model")].append(record)
+    
+    results = {}
+    for template in run["templates"]:
+        model_cases = cases_by_template.get(template["name"])
+        if model_cases:
+            results[template["name"]] = build_template_result(
+                template, run["test_set"], run["models"], run["temperature"], run["max_tokens"],
+                [{"model": model, "test_cases": cases} for model, cases in model_cases.items()]
+            )
+    save_result(run["result_name"], results)
+    st.session_state.last_result = run["result_name"]
+    st.warning(f"⏹ 上次测试运行已停止，已保存 {len(records)} 个已完成用例的结果: {run['result_name']}")
+
+def run_tests(templates, test_set, selected_models, temperature, max_tokens, repeat_count, test_mode, use_batch_api=False, batch_size=1, use_cache=True, model_provider_map=None, rendered_prompts=None, adaptive_max_tokens=False):
     """运行测试并显示进度（并发重构版）"""
+    # 循环外取一次模型-提供商映射，避免在循环中反复访问 st.session_state
+    model_provider_map = dict(model_provider_map if model_provider_map is not None else st.session_state.get("model_provider_map", {}))
     st.subheader("测试运行中...")
     progress_bar = st.progress(0)
     status_text = st.empty()
     result_area = st.empty() # Keep this for potential future detailed status
+    # 运行中的实时指标；明显不理想时可以停止，尚未发出的请求不再调用模型
+    metrics_area = st.empty()
+    # 停止按钮会触发页面重新运行，本次运行随即被打断；停止标记放在会话状态中，回调在新一轮运行中也能找到它，
+    # 已完成的结果由 recover_interrupted_test_run 根据增量记录保存
+    stop_event = threading.Event()
+    st.session_state.test_stop_event = stop_event
+    st.button("⏹ 停止测试", key="stop_test_run", on_click=request_test_stop)
     
     # Calculate total attempts based on cases and repeats
     total_cases = len(test_set.get("cases", []))
     total_attempts = len(templates) * len(selected_models) * total_cases * repeat_count
     completed_attempts = 0
+    # 节流刷新进度条和状态文字，最后一次总是刷新
+    refresh_progress = make_throttled_progress(
+        progress_bar, status_text,
+        lambda current, total: f"运行中... 已完成 {current}/{total} 次模型调用"
+    )
     
     # Define the progress callback function
     def update_progress():
         nonlocal completed_attempts
         completed_attempts += 1
-        progress = completed_attempts / total_attempts if total_attempts > 0 else 0
-        # Ensure progress doesn't exceed 1.0 due to potential floating point issues
-        progress = min(progress, 1.0)
-        progress_bar.progress(progress)
-        status_text.text(f"运行中... 已完成 {completed_attempts}/{total_attempts} 次模型调用")
+        refresh_progress(completed_attempts, total_attempts)
 
     results = {}
     all_test_results = [] # Store results from run_test calls
+    result_name = f"test_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+
+    # 实时结果区域：每个用例完成后立即展示并追加写入磁盘
+    st.subheader("实时结果")
+    live_containers = {template["name"]: st.container() for template in templates}
+
+    # 每个(模板, 模型)的得分增量统计，随用例完成更新，节流刷新展示
+    running_stats = {}
+    last_metrics_ts = 0.0
+
+    def refresh_metrics(force=False):
+        nonlocal last_metrics_ts
+        now = time.monotonic()
+        if not force and now - last_metrics_ts < PROGRESS_UPDATE_INTERVAL:
+            return
+        last_metrics_ts = now
+        rows = []
+        for (template_name, model), stats in running_stats.items():
+            summary = summarize_running_stats(stats)
+            rows.append({
+                "模板": template_name,
+                "模型": model,
+                "已评估响应": summary["overall"]["count"],
+                "平均分": round(summary["overall"]["mean"], 1),
+                "标准差": round(summary["overall"]["std"], 1),
+                **{dim: round(summary[dim]["mean"], 1) for dim in SCORE_DIMENSIONS}
+            })
+        if rows:
+            metrics_area.dataframe(rows, hide_index=True)
+
+    def make_result_callback(template_name, model):
+        stats = running_stats.setdefault((template_name, model), new_running_stats())
+
+        def on_case_done(case_result):
+            record = {"template": template_name, "model": model, **case_result}
+            save_result_append(result_name, record)
+            update_running_stats(stats, case_result)
+            refresh_metrics()
+            container = live_containers[template_name]
+            for resp in case_result.get("responses", []):
+                score = (resp.get("evaluation") or {}).get("overall_score")
+                score_text = f" | 得分: {score}" if score is not None else ""
+                if resp.get("error"):
+                    container.markdown(f"❌ **{case_result.get('case_id', '')}** [{model} #{resp.get('attempt')}] {resp['error']}")
+                else:
+                    container.markdown(f"✅ **{case_result.get('case_id', '')}** [{model} #{resp.get('attempt')}{score_text}] {resp.get('response', '')[:200]}")
+        return on_case_done
+
+    # --- Batch API --- 
+    # 支持Batch API的模型统一提交批处理任务后立即返回，作业保存在会话状态中，稍后在页面顶部收取；其余模型走实时调用
+    batch_models = []
+    if use_batch_api:
+        batch_models = [m for m in selected_models if supports_batch_api(model_provider_map.get(m))]
+        if batch_models:
+            status_text.text(f"正在提交Batch任务: {', '.join(batch_models)}...")
+            job = submit_test_batch(
+                templates=templates,
+                models=batch_models,
+                test_set=test_set,
+                model_provider_map=model_provider_map,
+                repeat_count=repeat_count,
+                temperature=temperature,
+                max_tokens=max_tokens
+            )
+            if job:
+                st.session_state.setdefault("pending_batch_jobs", []).append(job)
+                st.info(f"已提交Batch任务 {job['batch_id']}（{', '.join(batch_models)}），完成后可在本页顶部收取结果")
+            # 批处理模型的调用不在本次运行中完成，不计入进度
+            total_attempts -= len(templates) * len(batch_models) * total_cases * repeat_count
+    realtime_models = [m for m in selected_models if m not in batch_models]
+
+    # 记录进行中的运行，运行被打断时下一轮页面运行据此从增量记录恢复结果
+    st.session_state.active_test_run = {
+        "result_name": result_name,
+        "templates": templates,
+        "test_set": test_set,
+        "models": realtime_models,
+        "temperature": temperature,
+        "max_tokens": max_tokens
+    }
+
+    # 整个运行过程中不变的参数预先绑定；每个模型的提供商只在这里解析一次
+    base_runner = functools.partial(
+        run_test,
+        test_set=test_set,
+        repeat_count=repeat_count,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        progress_callback=update_progress,
+        batch_size=batch_size,
+        use_cache=use_cache,
+        stop_event=stop_event,
+        adaptive_max_tokens=adaptive_max_tokens
+    )
+    model_runners = {
+        model: functools.partial(base_runner, model=model, model_provider=model_provider_map.get(model) or resolve_model_provider(model))
+        for model in realtime_models
+    }
 
     # --- Main Test Loop --- 
     # Iterate through templates and models to call run_test
     for template in templates:
         template_name = template["name"]
         template_results_for_models = []
-        for model in selected_models:
-            provider = st.session_state.model_provider_map.get(model) if hasattr(st.session_state, 'model_provider_map') else None
+        # 渲染结果只与(模板, 用例)有关，所有模型共用；优先使用预览阶段已渲染的结果
+        render = make_prompt_renderer(template, test_set)
+        template_prompts = {
+            case.get("id", ""): (rendered_prompts or {}).get((template_name, case.get("id", ""))) or render(case)
+            for case in test_set.get("cases", [])
+        }
+        for model in realtime_models:
+            if stop_event.is_set():
+                break
             
             status_text.text(f"正在运行: 模板 '{template_name}' - 模型 '{model}'...")
             
-            # Call run_test with the progress callback
-            test_result = run_test(
+            # Call the pre-bound run_test for this model
+            test_result = model_runners[model](
                 template=template,
-                model=model,
-                test_set=test_set,
-                model_provider=provider,
-                repeat_count=repeat_count,
-                temperature=temperature,
-                progress_callback=update_progress # Pass the callback here
+                result_callback=make_result_callback(template_name, model),
+                pre_rendered_prompts=template_prompts
             )
             
             if test_result:
@@ -231,73 +505,35 @@ def run_tests(templates, test_set, selected_models, temperature, max_tokens, rep
         
         # Store results grouped by template after processing all models for it
         if template_results_for_models:
-             # Aggregate results for the current template from different models
-            aggregated_cases = []
-            for res in template_results_for_models:
-                for case in res.get("test_cases", []):
-                    # Add model info to each case if not already present (should be added by run_test)
-                    if "model" not in case:
-                         case["model"] = res.get("model")
-                    aggregated_cases.append(case)
-            
-            results[template_name] = {
-                "template": template,
-                "test_set": test_set["name"],
-                "models": selected_models, # List all models tested with this template
-                "params": {
-                    "temperature": temperature,
-                    "max_tokens": max_tokens # Assuming max_tokens was intended here, though not passed to run_test
-                },
-                "test_cases": aggregated_cases # Combined cases from all models for this template
-            }
+            # Aggregate results for the current template from different models
+            results[template_name] = build_template_result(
+                template, test_set, realtime_models, temperature, max_tokens, template_results_for_models
+            )
 
     # --- Post-Test Processing --- 
     # Ensure progress bar reaches 100% and update status
+    refresh_metrics(force=True)
     progress_bar.progress(1.0)
-    status_text.text(f"✅ 测试完成! 共执行 {completed_attempts}/{total_attempts} 次模型调用。")
+    if stop_event.is_set():
+        status_text.text(f"⏹ 测试已停止，已完成 {completed_attempts}/{total_attempts} 次模型调用。")
+    else:
+        status_text.text(f"✅ 测试完成! 共执行 {completed_attempts}/{total_attempts} 次模型调用。")
     result_area.empty() # Clear the intermediate status area
 
-    # Save results
-    result_name = f"test_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-    save_result(result_name, results)
-    st.success(f"测试结果已保存: {result_name}")
-
-    # Display results preview
-    from ui.components import display_test_case_details
-    st.subheader("测试结果预览")
-    # Check if results dictionary is empty
+    # Save results（全部模型都走Batch API时本次没有实时结果可保存）
+    st.session_state.pop("active_test_run", None)
     if not results:
         st.warning("没有生成任何测试结果。请检查模型选择和测试配置。")
         return
-        
-    for template_name, template_result in results.items():
-        st.markdown(f"#### 提示词模板: {template_name}")
-        if not template_result.get("test_cases"):
-            st.warning(f"模板 '{template_name}' 没有有效的测试用例结果。")
-            continue
-            
-        # Display results grouped by case ID first, then show different model responses/evals
-        cases_grouped = {}
-        for case in template_result["test_cases"]:
-            case_id = case.get("case_id", "unknown_case")
-            if case_id not in cases_grouped:
-                cases_grouped[case_id] = {
-                    "description": case.get("case_description", case_id),
-                    "details": []
-                }
-            cases_grouped[case_id]["details"].append(case)
-            
-        case_counter = 1
-        for case_id, group_data in cases_grouped.items():
-            st.markdown(f"**测试用例 {case_counter}: {group_data['description']}**")
-            # Display details for each model run for this case
-            for case_detail in group_data["details"]:
-                 st.markdown(f"*模型: {case_detail.get('model', '未知')}*", help=f"Prompt used:\n```\n{case_detail.get('prompt', 'N/A')}\n```")
-                 display_test_case_details(case_detail, show_system_prompt=False, inside_expander=True) # Use expander for cleaner look
-            case_counter += 1
-            st.divider()
+    save_result(result_name, results)
+    st.success(f"测试结果已保存: {result_name}")
 
-    # Navigate to results viewer
+    # Navigate to results viewer: render in place instead of st.rerun() to skip a full script run
+    # 各用例详情只由结果查看器展示一次，不再单独渲染预览
+    from ui.results_viewer import render_results_viewer
     st.session_state.last_result = result_name
+    st.session_state.last_result_data = results
     st.session_state.page = "results_viewer"
-    st.rerun()
\ No newline at end of file
+    st.divider()
+    render_results_viewer()
+    st.stop()
\ No newline at end of file
@@ -1,22 +1,222 @@
-import json
+import re
+import orjson
 import asyncio
+import logging
+import logging.handlers
+import queue
+import numpy as np
 import concurrent.futures
 import threading
+import time
+import traceback
+import weakref
+from collections import deque
+from functools import lru_cache
+from itertools import count
 from typing import Dict, List, Optional, Any, Tuple
 
 from models.api_clients import get_client, get_provider_from_model
-from config import load_config, get_system_template
+from config import get_system_template, get_settings_signature, DATA_DIR
 # 导入新的并行执行器
-from utils.parallel_executor import execute_model, execute_models, execute_model_sync, execute_models_sync
+from utils.parallel_executor import execute_model, execute_models, execute_model_sync, execute_models_sync, run_coro_sync, default_batcher
 from utils.optimizer import PromptOptimizer
-import time
+from utils.evaluator import PromptEvaluator
+from utils.llm_cache import make_request_cache_key, get_cached_response, set_cached_response
+from utils.helpers import parse_json_response
+from models.token_counter import count_tokens
+
+# 内存中保留的最近日志条数，UI 未及时取走时丢弃最旧的日志
+LOG_BUFFER_SIZE = 1000
+
+# 控制台日志：通过队列交给后台线程输出，避免在迭代热路径上同步写 stdout
+logger = logging.getLogger("AutoOptimizer")
+if not logger.handlers:
+    _log_queue = queue.SimpleQueue()
+    _console_handler = logging.StreamHandler()
+    _console_handler.setFormatter(logging.Formatter("[%(name)s] [%(levelname)s] %(message)s"))
+    _log_listener = logging.handlers.QueueListener(_log_queue, _console_handler)
+    _log_listener.start()
+    logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# 内存中保留的最近迭代记录数，完整历史追加写入磁盘
+HISTORY_IN_MEMORY = 3
+
+# 迭代历史临时文件目录，与测试结果分开存放，优化器释放时删除对应文件
+OPTIMIZATION_HISTORY_DIR = DATA_DIR / "optimization_history"
+OPTIMIZATION_HISTORY_DIR.mkdir(exist_ok=True)
+
+# 迭代结果序列化选项：每条记录一行，兼容numpy数值和非字符串键
+HISTORY_DUMP_OPTIONS = orjson.OPT_APPEND_NEWLINE | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+# 测试用例预取共用的后台线程池：所有优化器实例共享，不随每次启动优化新建线程池
+_PREFETCH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="auto-opt-prefetch")
+
+# 预编译的正则表达式
+# 匹配 "1. xxx" 形式的编号测试方向
+NUMBERED_DIRECTION_RE = re.compile(r'\d+\.\s*(.*?)(?=\n\d+\.|\Z)', re.DOTALL)
+# 匹配行首的序号前缀
+NUMBER_PREFIX_RE = re.compile(r'^\d+[\.\)]\s*')
+# 匹配模板变量 {{variable}}
+TEMPLATE_VAR_RE = re.compile(r'{{(.*?)}}')
+
+# 自动生成测试用例时使用的基础评估标准
+BASIC_EVALUATION_CRITERIA = {
+    "accuracy": "评估回答的准确性",
+    "completeness": "评估回答的完整性",
+    "relevance": "评估回答的相关性",
+    "clarity": "评估回答的清晰度"
+}
+
+# 为每个测试方向追加的用例生成指示，保持测试与原始目标的一致性
+EXPANDED_DIRECTION_TEMPLATE = "测试方向：{} - 请为此方向生成详细的测试用例，包含用户输入和期望输出，用于评估提示词的效果。确保测试用例严格对应原始提示词的预期目标和用途。"
+
+# 可通过重新尝试解决的瞬时优化错误
+# optimize_prompt 内部重试用尽时返回 "在 N 次总尝试后优化失败"，同样属于可以整体再试一次的失败
+RETRYABLE_OPTIMIZATION_ERRORS = ("空响应内容", "JSON解析失败", "未能生成优化提示词", "总尝试后优化失败")
+
+# 支持 response_format={"type": "json_object"} 的提供商
+JSON_MODE_PROVIDERS = {"openai"}
+
+# 合并生成（一次调用同时生成测试方向和测试用例）时请求的最大token数，超出时分两步生成
+COMBINED_GENERATION_MAX_TOKENS = 2000
+
+# 合并生成测试方向和测试用例的提示词
+COMBINED_GENERATION_TEMPLATE = """
+请分析以下提示词，先从基本功能、边界条件、特殊情况等不同角度确定测试方向，再为这些方向一共编写 {count} 个测试用例，用于全面评估提示词的效果。
+
+【原始提示词】:
+```
+{initial_prompt}
+```
+
+【当前优化版本】:
+```
+{target_prompt}
+```
+
+重要说明：测试方向和测试用例必须始终围绕原始提示词要解决的核心问题，无论提示词如何演变，都要保持对原始任务目标的一致性。
+
+请仅返回如下格式的JSON:
+{{
+  "directions": ["测试方向描述", ...],
+  "test_cases": [
+    {{
+      "direction_idx": 0,
+      "description": "测试用例描述",
+      "user_input": "用户输入",
+      "expected_output": "期望输出",
+      "evaluation_criteria": {{"accuracy": "评估标准描述", "completeness": "评估标准描述"}}
+    }}
+  ]
+}}
+"""
+
+# 生成测试用例时提供给生成模型的示例用例
+EXAMPLE_TEST_CASE = {
+    "id": "example_case",
+    "description": "示例测试用例",
+    "user_input": "这是一个测试用例的用户输入示例",
+    "expected_output": "期望的输出应该包含完整、准确的回答",
+    "evaluation_criteria": BASIC_EVALUATION_CRITERIA
+}
+
+# LLM生成测试方向失败时使用的默认测试方向
+DEFAULT_TEST_DIRECTIONS = (
+    "测试方向：基本功能测试 - 请生成测试用例检查提示词的基本功能是否正常工作，能否按照原始目标预期响应简单问题。",
+    "测试方向：格式遵循测试 - 请生成测试用例检查提示词是否能按照指定的格式要求输出内容，同时确保内容与原始任务目标一致。",
+    "测试方向：复杂度测试 - 请生成测试用例包含复杂问题或多个问题，检查提示词处理复杂信息的能力，但始终确保问题围绕原始提示词的核心目标。",
+    "测试方向：边界条件测试 - 请生成一些边界情况的测试用例，检查提示词在极端情况下的表现，同时保持对原始任务目标的专注。",
+    "测试方向：指令跟随测试 - 请生成测试用例，检查提示词是否能严格按照用户指令执行，同时与原始提示词的预期用途保持一致。"
+)
+
+# 自动生成测试用例失败时使用的默认测试用例（不含ID，使用时再分配）
+DEFAULT_TEST_CASE_TEMPLATES = (
+    {
+        "description": "基本功能测试 - 原始目标一致性",
+        "user_input": "请提供一个简单任务，测试提示词是否能够按照原始设计目标正常工作。",
+        "expected_output": "一个完整、准确的回应，满足提示词的基本要求，并且与原始提示词的核心目标保持一致：满足原始提示词的预期目标。",
+        "evaluation_criteria": {
+            "accuracy": "评估回答是否准确体现了原始提示词的意图",
+            "completeness": "评估回答是否完整覆盖了原始提示词的要求",
+            "relevance": "评估回答是否与原始提示词的目标相关",
+            "clarity": "评估回答的清晰度",
+            "goal_consistency": "评估回答是否始终保持对原始目标的专注"
+        }
+    },
+    {
+        "description": "边界条件测试 - 保持原始目标",
+        "user_input": "这是一个复杂的测试用例，包含多个需求和边界条件，但仍然需要围绕原始提示词的核心目标。",
+        "expected_output": "一个能全面处理复杂需求和边界条件的回答，同时不偏离原始提示词的预期用途。",
+        "evaluation_criteria": {
+            "accuracy": "评估回答在复杂情况下的准确性",
+            "completeness": "评估回答在边界条件下的完整性",
+            "relevance": "评估回答是否始终与原始提示词目标相关",
+            "clarity": "评估回答的清晰度",
+            "goal_adherence": "评估即使在复杂情况下是否仍然坚持原始目标"
+        }
+    },
+    {
+        "description": "指令遵循测试 - 原始目标框架内",
+        "user_input": "请严格按照以下格式回答，但确保内容仍然紧密围绕原始提示词的核心目标：1. 问题分析 2. 可能的解决方案 3. 建议的最佳方案。",
+        "expected_output": "一个严格按照指定格式的回答，同时确保内容始终聚焦于原始提示词要解决的核心问题。",
+        "evaluation_criteria": {
+            "accuracy": "评估回答的准确性",
+            "completeness": "评估回答的完整性",
+            "relevance": "评估回答对原始目标的相关性",
+            "clarity": "评估回答的清晰度",
+            "instruction_following": "评估是否遵循了格式要求同时保持对原始目标的专注"
+        }
+    }
+)
+
+
+# 进程内单调递增的ID序号
+_id_counter = count()
+
+
+def _fast_id(prefix):
+    """
+    生成带前缀的唯一ID
+    
+    进程内由递增序号保证不重复，跨进程由纳秒时间戳区分，无需每次读取系统随机数
+    """
+    return f"{prefix}_{time.time_ns():x}_{next(_id_counter):x}"
+
+
+def _remove_history_file(path):
+    """删除迭代历史临时文件，文件不存在时忽略"""
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+@lru_cache(maxsize=4)
+def _shared_evaluator(settings_signature):
+    """
+    按当前设置共享的评估器实例
+    
+    评估器创建后不再修改自身状态，可在多个优化器实例和线程间复用；
+    评估模型、API密钥、本地评估开关或系统模板变化时 settings_signature 改变，以新的签名为键创建新实例
+    """
+    return PromptEvaluator()
+
+
+@lru_cache(maxsize=4)
+def _shared_optimizer(settings_signature):
+    """按当前设置共享的优化器实例，优化器与评估器使用同一模型配置"""
+    return PromptOptimizer()
+
 
 class AutomaticPromptOptimizer:
     """全自动提示词优化器，支持自动测试用例生成、评估和持续迭代"""
     
     def __init__(self, initial_prompt, model, provider, eval_model=None, eval_provider=None,
                 iter_model=None, iter_provider=None, max_iterations=10, test_cases_per_iter=3, 
-                optimization_strategy="balanced", temperature=0.7, target_score=None, optimization_retries=3):
+                optimization_strategy="balanced", temperature=0.7, target_score=None, optimization_retries=3,
+                use_cache=True, patience=None, plateau_window=None, plateau_epsilon=1.0, debug_logs=True):
         """
         初始化全自动提示词优化器
         
@@ -34,12 +234,17 @@ class AutomaticPromptOptimizer:
         - temperature: 温度参数
         - target_score: 目标分数
         - optimization_retries: 优化重试次数
+        - use_cache: 是否使用持久化响应缓存，提示词未变化时复用之前的模型响应
+        - patience: 最佳分数连续多少轮未提升后提前停止，为0或None时不启用
+        - plateau_window: 判断分数收敛时参考的最近轮数，为0或None时不启用
+        - plateau_epsilon: 最近几轮平均分的线性趋势斜率（每轮分数变化）绝对值低于该值时视为收敛
+        - debug_logs: 是否记录DEBUG日志，关闭时直接丢弃DEBUG日志，也不再格式化异常堆栈
         """
-        from utils.evaluator import PromptEvaluator
-        
         # 初始化基本参数
         self.current_prompt = initial_prompt
         self.initial_prompt = initial_prompt
+        # 需要保留的模板变量以初始提示词为准，只扫描一次；某轮丢失的变量在后续轮次仍会被检查和恢复
+        self._required_template_vars = tuple(dict.fromkeys(TEMPLATE_VAR_RE.findall(initial_prompt)))
         self.model = model
         self.provider = provider
         self.eval_model = eval_model or model
@@ -52,21 +257,45 @@ class AutomaticPromptOptimizer:
         self.temperature = temperature
         self.target_score = target_score if target_score is not None and target_score > 0 else None
         self.optimization_retries = optimization_retries
+        self.use_cache = use_cache
+        self.patience = patience
+        self.plateau_window = plateau_window
+        self.plateau_epsilon = plateau_epsilon
+        self._debug_enabled = debug_logs
         
         # 初始化相关对象
-        self.evaluator = PromptEvaluator()
-        self.optimizer = PromptOptimizer()
+        # 评估器和优化器在设置未变化时共享，避免每个实例重复创建API客户端
+        settings_signature = get_settings_signature()
+        self.evaluator = _shared_evaluator(settings_signature)
+        self.optimizer = _shared_optimizer(settings_signature)
         
         # 初始化状态变量
         self.current_iteration = 0
         self.best_prompt = initial_prompt
         self.best_score = 0
-        self.iterations_history = []
-        self.logs = []
+        # 只在内存中保留最近几轮，完整历史逐轮追加到JSONL文件，按行偏移回读
+        self.iterations_history = deque(maxlen=HISTORY_IN_MEMORY)
+        self.history_path = OPTIMIZATION_HISTORY_DIR / f"{_fast_id('auto_optimization')}.jsonl"
+        # 优化器被回收或进程退出时删除历史文件，界面丢弃优化器时也可通过 discard_history 立即删除
+        self._history_cleanup = weakref.finalize(self, _remove_history_file, self.history_path)
+        self._history_offsets = []
+        self.iteration_scores = []  # 每轮测试的得分数组
+        self.average_scores = []  # 每轮测试的平均分
+        # 最近一次扫描过的提示词及其模板变量，变量检查和恢复后的复查可复用同一次扫描结果
+        self._vars_prompt = None
+        self._vars_cache = []
+        # 本次运行中各提示词对应的测试方向（初始提示词固定，只需以提示词为键）
+        self._directions_cache = {}
+        self._rounds_since_improvement = 0
+        self.logs = deque(maxlen=LOG_BUFFER_SIZE)
         self._completed = False
         
+        # 下一轮测试用例的预取：在本轮优化提示词的同时于共享的后台线程池中生成，(目标轮次, Future)
+        self._prefetch_lock = threading.Lock()
+        self._pending_test_cases = None
+        
         # 记录日志
-        self._log("INFO", f"初始化自动优化器，初始提示词长度: {len(initial_prompt)} 字符")
+        self._log("INFO", "初始化自动优化器，初始提示词长度: %d 字符", len(initial_prompt))
         self._log("INFO", f"对话模型: {model} ({provider})")
         self._log("INFO", f"评估模型: {eval_model} ({eval_provider})")
         self._log("INFO", f"迭代模型: {iter_model} ({iter_provider})")
@@ -78,38 +307,137 @@ class AutomaticPromptOptimizer:
             return True
         if self.target_score is not None and self.best_score >= self.target_score:
             self._log("INFO", f"已达到目标分数 {self.target_score:.2f} (当前最佳: {self.best_score:.2f})。优化完成。")
-            self._completed = True
+            self.mark_completed()
             return True
         if self.current_iteration >= self.max_iterations:
             self._log("INFO", f"已达到最大迭代次数 {self.max_iterations}。优化完成。")
-            self._completed = True
+            self.mark_completed()
             return True
         return False
     
     def mark_completed(self):
-        """标记优化已完成"""
+        """标记优化已完成，并取消尚未使用的测试用例预取"""
         self._completed = True
+        with self._prefetch_lock:
+            pending, self._pending_test_cases = self._pending_test_cases, None
+        if pending:
+            pending[1].cancel()
+    
+    def _prefetch_test_cases(self):
+        """
+        在后台线程中为下一轮生成测试方向和测试用例，与本轮的提示词优化并行执行
+        
+        测试方向基于本轮（优化前）的提示词和原始提示词生成，始终围绕原始任务目标
+        """
+        with self._prefetch_lock:
+            if self._pending_test_cases:
+                self._pending_test_cases[1].cancel()
+            self._pending_test_cases = (
+                self.current_iteration + 1,
+                _PREFETCH_EXECUTOR.submit(self._build_test_cases, self.current_prompt)
+            )
+    
+    def _take_prefetched_test_cases(self):
+        """取出为本轮预取的测试用例，没有可用的预取结果时返回None"""
+        with self._prefetch_lock:
+            pending, self._pending_test_cases = self._pending_test_cases, None
+        if not pending or pending[0] != self.current_iteration:
+            return None
+        try:
+            return pending[1].result()
+        except Exception as e:
+            self._log("WARNING", f"预取测试用例失败，将重新生成: {str(e)}")
+            return None
+    
+    def _append_history(self, iteration_result):
+        """将本轮结果追加写入历史文件，并记录该行的起始偏移"""
+        self.iterations_history.append(iteration_result)
+        offset = None
+        if not self._history_cleanup.alive:
+            # 历史文件已被丢弃，不再重新创建
+            self._history_offsets.append(offset)
+            return
+        try:
+            # 每次追加单独打开并关闭文件，提前停止等路径标记完成后仍会写入最后一轮，不会遗留打开的句柄
+            with open(self.history_path, "ab") as f:
+                offset = f.tell()
+                f.write(orjson.dumps(iteration_result, default=str, option=HISTORY_DUMP_OPTIONS))
+        except Exception as e:
+            offset = None
+            self._log("WARNING", f"写入迭代历史失败: {str(e)}")
+        self._history_offsets.append(offset)
+    
+    def discard_history(self):
+        """删除本次运行的迭代历史文件，之后只能读取内存中保留的最近几轮"""
+        self._history_cleanup()
+        self._history_offsets = [None] * len(self._history_offsets)
+    
+    def load_iteration(self, index):
+        """按序号读取某一轮的完整结果，最近几轮直接从内存返回"""
+        if index < 0 or index >= len(self._history_offsets):
+            return None
+        in_memory_start = len(self._history_offsets) - len(self.iterations_history)
+        if index >= in_memory_start:
+            return self.iterations_history[index - in_memory_start]
+        if self._history_offsets[index] is None:
+            return None
+        with open(self.history_path, "rb") as f:
+            f.seek(self._history_offsets[index])
+            return orjson.loads(f.readline())
     
     def get_latest_logs(self):
-        """获取最新日志并清空日志队列"""
-        logs = self.logs.copy()
-        self.logs = []
+        """获取最新日志并清空日志队列，日志消息在此时才格式化"""
+        logs = []
+        # deque 的 append/popleft 是原子操作；按取走时的长度出队，后台线程持续写入时也不会一直取下去
+        for _ in range(len(self.logs)):
+            entry = self.logs.popleft()
+            args = entry.pop("args")
+            if args:
+                entry["message"] = entry["message"] % args
+            logs.append(entry)
         return logs
     
-    def _log(self, level, message):
-        """记录日志"""
+    def _log(self, level, message, *args):
+        """
+        记录日志
+        
+        message 可使用 % 占位符并通过 args 传参，格式化推迟到读取日志或控制台输出时进行
+        """
+        if level == "DEBUG" and not self._debug_enabled:
+            return
         self.logs.append({
             "time": time.time(),
             "level": level,
-            "message": message
+            "message": message,
+            "args": args
         })
-        print(f"[AutoOptimizer] [{level}] {message}")
+        logger.log(logging.getLevelName(level), message, *args)
     
     def run_single_iteration(self):
         """运行单次优化迭代，包括生成测试、评估、优化"""
+        phase = None
+        for phase in self._iteration_phases():
+            pass
+        return phase["data"] if phase else None
+    
+    def run_single_iteration_streaming(self):
+        """
+        逐阶段运行单次优化迭代，返回生成器，供界面在每个阶段完成后立即展示
+        
+        依次产出 {"phase": 阶段名, "data": 阶段数据}：
+        - "cases": 本轮测试用例
+        - "tests": {"test_results": 测试结果, "score": 平均分}
+        - "optimize": {"prompt": 优化后的提示词，失败时为None}（仅在需要继续迭代时产出）
+        - "done": 本轮迭代结果，与 run_single_iteration 的返回值相同
+        """
+        return self._iteration_phases()
+    
+    def _iteration_phases(self):
+        """单次优化迭代的各个阶段，每个阶段完成后产出一次阶段结果"""
         if self.is_completed():
             self._log("WARNING", "优化已完成或达到停止条件，无法继续迭代。")
-            return None
+            yield {"phase": "done", "data": None}
+            return
         
         self._log("INFO", f"开始第 {self.current_iteration + 1}/{self.max_iterations} 轮优化 (当前最佳分数: {self.best_score:.2f}, 目标分数: {self.target_score or '未设置'})")
         
@@ -118,20 +446,26 @@ class AutomaticPromptOptimizer:
         if not test_cases:
             self._log("ERROR", "未能生成测试用例，跳过本轮优化")
             self.current_iteration += 1
-            return None
+            yield {"phase": "done", "data": None}
+            return
         
         self._log("INFO", f"成功生成 {len(test_cases)} 个测试用例")
+        yield {"phase": "cases", "data": test_cases}
         
         # 步骤2: 使用当前提示词对测试用例进行测试
         test_results = self._run_tests(test_cases)
         if not test_results:
             self._log("ERROR", "测试运行失败，跳过本轮优化")
             self.current_iteration += 1
-            return None
+            yield {"phase": "done", "data": None}
+            return
         
-        # 计算平均分数
-        avg_score = self._calculate_average_score(test_results)
+        # 计算平均分数，并保存本轮得分数组供后续趋势分析
+        scores = self._extract_scores(test_results)
+        self.iteration_scores.append(scores)
+        avg_score = self._mean_score(scores)
         self._log("INFO", f"本轮测试平均得分: {avg_score:.2f}")
+        yield {"phase": "tests", "data": {"test_results": test_results, "score": avg_score}}
         
         # 记录结果
         iteration_result = {
@@ -144,18 +478,24 @@ class AutomaticPromptOptimizer:
         }
         
         # 更新最佳提示词
+        self.average_scores.append(avg_score)
         if avg_score > self.best_score:
             self.best_prompt = self.current_prompt
             self.best_score = avg_score
+            self._rounds_since_improvement = 0
             self._log("INFO", f"发现新的最佳提示词 (基于当前轮测试)，得分: {self.best_score:.2f}")
+        else:
+            self._rounds_since_improvement += 1
         
         # 决定是否为下一轮优化提示词
         will_continue_next_iteration = False
         if (self.current_iteration + 1) < self.max_iterations:
             if self.target_score is None or self.best_score < self.target_score:
-                will_continue_next_iteration = True
+                will_continue_next_iteration = not self._should_stop_early()
 
         if will_continue_next_iteration:
+            # 下一轮的测试用例生成与本轮的提示词优化同时进行
+            self._prefetch_test_cases()
             self._log("INFO", f"准备为下一轮 (第 {self.current_iteration + 2} 轮) 优化提示词。")
             new_prompt = self._optimize_prompt(test_results)
             if new_prompt:
@@ -163,6 +503,7 @@ class AutomaticPromptOptimizer:
                 self._log("INFO", "提示词已优化。新提示词将在下一轮使用。")
             else:
                 self._log("WARNING", f"优化提示词在 {self.optimization_retries} 次尝试后失败，下一轮将继续使用此轮的提示词。")
+            yield {"phase": "optimize", "data": {"prompt": new_prompt}}
         else:
             self._log("INFO", "已达到停止条件 (最大迭代次数或目标分数已满足/即将满足)，不再为下一轮优化提示词。")
         
@@ -170,176 +511,253 @@ class AutomaticPromptOptimizer:
         self.current_iteration += 1
         
         # 添加到历史记录
-        self.iterations_history.append(iteration_result)
+        self._append_history(iteration_result)
+        
+        yield {"phase": "done", "data": iteration_result}
+    
+    def _should_stop_early(self):
+        """分数长时间未提升或最近几轮已收敛时提前停止，节省剩余迭代的调用开销"""
+        if self.patience and self._rounds_since_improvement >= self.patience:
+            self._log("INFO", f"最佳分数已连续 {self._rounds_since_improvement} 轮未提升，提前停止优化。")
+            self.mark_completed()
+            return True
+        
+        window = self.plateau_window or 0
+        if window >= 2 and len(self.average_scores) >= window:
+            recent = np.asarray(self.average_scores[-window:], dtype=np.float64)
+            slope = np.polyfit(np.arange(window), recent, 1)[0]
+            if abs(slope) < self.plateau_epsilon:
+                self._log("INFO", f"最近 {window} 轮平均分已收敛 (趋势斜率 {slope:.2f})，提前停止优化。")
+                self.mark_completed()
+                return True
         
-        return iteration_result
+        return False
     
     def _generate_test_cases(self):
-        """生成本轮测试用例"""
+        """生成本轮测试用例，优先使用上一轮优化提示词期间预取的结果"""
+        return self._take_prefetched_test_cases() or self._build_test_cases(self.current_prompt)
+    
+    def _build_test_cases(self, target_prompt):
+        """针对给定提示词生成测试方向和测试用例；优化已结束（如用户终止）时不再发起新的调用，返回空列表"""
         try:
-            self._log("DEBUG", f"开始生成测试用例，目标数量: {self.test_cases_per_iter}")
-            
-            # 生成测试用例的几个方向
-            directions = self._generate_test_directions()
-            if not directions:
-                self._log("ERROR", "未能生成测试方向")
+            if self._completed:
                 return []
+            self._log("DEBUG", "开始生成测试用例，目标数量: %d", self.test_cases_per_iter)
             
-            self._log("DEBUG", f"生成了 {len(directions)} 个测试方向")
+            # 优先用一次调用同时生成测试方向和测试用例，失败时回退到分两步生成
+            test_cases = self._generate_directions_and_cases(target_prompt)
+            if test_cases is None and self._completed:
+                return []
+            if test_cases is None:
+                test_cases = self._generate_cases_from_directions(target_prompt)
+                if test_cases is None:
+                    # 如果批量生成失败，返回一些默认测试用例
+                    return self._generate_default_test_cases()
             
-            # 创建一个简单的示例测试用例作为基础
-            example_case = {
-                "id": "example_case",
-                "description": "示例测试用例",
-                "user_input": "这是一个测试用例的用户输入示例",
-                "expected_output": "期望的输出应该包含完整、准确的回答",
-                "evaluation_criteria": {
-                    "accuracy": "评估回答的准确性",
-                    "completeness": "评估回答的完整性",
-                    "relevance": "评估回答的相关性",
-                    "clarity": "评估回答的清晰度"
-                }
-            }
+            # 确保测试用例有所有必要的字段
+            for tc in test_cases:
+                if "id" not in tc:
+                    tc["id"] = _fast_id("auto")
+                if "evaluation_criteria" not in tc or not tc["evaluation_criteria"]:
+                    # 评估标准只读，所有用例共享同一个字典
+                    tc["evaluation_criteria"] = BASIC_EVALUATION_CRITERIA
             
-            # 计算每个方向应生成的测试用例数量
-            cases_per_direction = max(1, self.test_cases_per_iter // len(directions))
+            # 如果没有生成足够的测试用例，生成一些默认测试用例补充
+            if not test_cases:
+                self._log("WARNING", "生成的测试用例数量不足，添加默认测试用例")
+                test_cases.extend(self._generate_default_test_cases())
             
-            try:
-                # 使用评估器生成测试用例，直接调用同步方法
-                # 注意：由于我们不在这里创建和关闭事件循环，所以不会遇到"Event loop is closed"的错误
-                batch_result = self.evaluator.generate_test_cases_batch(
-                    model=self.iter_model,
-                    test_purposes=directions,
-                    example_case=example_case,
-                    target_count_per_purpose=cases_per_direction
-                )
-                
-                if "error" in batch_result:
-                    self._log("ERROR", f"批量生成测试用例失败: {batch_result['error']}")
-                    # 如果批量生成失败，返回一些默认测试用例
-                    return self._generate_default_test_cases()
-                
-                if "errors" in batch_result and batch_result["errors"]:
-                    for error in batch_result["errors"]:
-                        self._log("WARNING", f"生成测试用例警告: {error}")
-                
-                test_cases = batch_result.get("test_cases", [])
-                
-                # 确保测试用例有所有必要的字段
-                for tc in test_cases:
-                    if "id" not in tc:
-                        import time, uuid
-                        tc["id"] = f"auto_{int(time.time())}_{uuid.uuid4().hex[:6]}"
-                    if "evaluation_criteria" not in tc or not tc["evaluation_criteria"]:
-                        tc["evaluation_criteria"] = {
-                            "accuracy": "评估回答的准确性",
-                            "completeness": "评估回答的完整性",
-                            "relevance": "评估回答的相关性",
-                            "clarity": "评估回答的清晰度"
-                        }
-                
-                # 如果没有生成足够的测试用例，生成一些默认测试用例补充
-                if not test_cases or len(test_cases) < 1:
-                    self._log("WARNING", "生成的测试用例数量不足，添加默认测试用例")
-                    test_cases.extend(self._generate_default_test_cases())
-                
-                return test_cases
-                
-            except Exception as e:
-                import traceback
-                self._log("ERROR", f"调用测试用例生成器时出错: {str(e)}")
-                self._log("DEBUG", traceback.format_exc())
-                # 如果生成失败，返回默认测试用例
-                return self._generate_default_test_cases()
+            return test_cases
             
         except Exception as e:
-            import traceback
             self._log("ERROR", f"生成测试用例失败: {str(e)}")
-            self._log("DEBUG", traceback.format_exc())
+            if self._debug_enabled:
+                self._log("DEBUG", traceback.format_exc())
             return self._generate_default_test_cases()
     
+    def _generate_directions_and_cases(self, target_prompt):
+        """
+        一次LLM调用同时生成测试方向和测试用例，省去先生成方向再生成用例的一次往返
+        
+        提示词过长或响应无法解析时返回None，由调用方回退到分两步生成
+        """
+        prompt = COMBINED_GENERATION_TEMPLATE.format(
+            initial_prompt=self.initial_prompt,
+            target_prompt=target_prompt,
+            count=self.test_cases_per_iter
+        )
+        # 合并请求只在提示词较短时使用，过长时分两步生成更稳定
+        if count_tokens(prompt, self.iter_model) > COMBINED_GENERATION_MAX_TOKENS:
+            self._log("DEBUG", "提示词较长，分两步生成测试方向和测试用例")
+            return None
+        
+        params = {
+            "temperature": 0.9,
+            "max_tokens": 4000
+        }
+        if self.iter_provider in JSON_MODE_PROVIDERS:
+            params["response_format"] = {"type": "json_object"}
+        
+        # 提示词未变化时复用缓存的生成结果
+        cache_key = make_request_cache_key(self.iter_model, self.iter_provider, prompt, params)
+        response_text = get_cached_response(cache_key) if self.use_cache else None
+        if response_text is None:
+            result = execute_model_sync(
+                model=self.iter_model,
+                prompt=prompt,
+                provider=self.iter_provider,
+                params=params
+            )
+            if "error" in result:
+                self._log("WARNING", f"合并生成测试用例失败，将分两步生成: {result['error']}")
+                return None
+            response_text = result.get("text", "")
+        
+        data, error = parse_json_response(response_text)
+        test_cases = data.get("test_cases") if isinstance(data, dict) else None
+        if error or not isinstance(test_cases, list):
+            self._log("WARNING", f"合并生成的测试用例无法解析，将分两步生成: {error or '缺少test_cases'}")
+            return None
+        
+        test_cases = [
+            tc for tc in test_cases
+            if isinstance(tc, dict) and tc.get("user_input") and tc.get("expected_output")
+        ]
+        if not test_cases:
+            return None
+        
+        if self.use_cache:
+            set_cached_response(cache_key, self.iter_model, response_text)
+        self._log("DEBUG", "合并生成了 %d 个测试方向和 %d 个测试用例", len(data.get("directions") or []), len(test_cases))
+        return test_cases
+    
+    def _generate_cases_from_directions(self, target_prompt):
+        """先生成测试方向，再按方向批量生成测试用例；失败时返回None"""
+        # 生成测试用例的几个方向
+        directions = self._generate_test_directions(target_prompt)
+        if not directions:
+            self._log("ERROR", "未能生成测试方向")
+            return []
+        
+        if self._completed:
+            return []
+        self._log("DEBUG", "生成了 %d 个测试方向", len(directions))
+        
+        # 计算每个方向应生成的测试用例数量
+        cases_per_direction = max(1, self.test_cases_per_iter // len(directions))
+        
+        try:
+            # 使用评估器生成测试用例，直接调用同步方法
+            batch_result = self.evaluator.generate_test_cases_batch(
+                model=self.iter_model,
+                test_purposes=directions,
+                example_case=EXAMPLE_TEST_CASE,
+                target_count_per_purpose=cases_per_direction
+            )
+        except Exception as e:
+            self._log("ERROR", f"调用测试用例生成器时出错: {str(e)}")
+            if self._debug_enabled:
+                self._log("DEBUG", traceback.format_exc())
+            return None
+        
+        if "error" in batch_result:
+            self._log("ERROR", f"批量生成测试用例失败: {batch_result['error']}")
+            return None
+        
+        if "errors" in batch_result and batch_result["errors"]:
+            for error in batch_result["errors"]:
+                self._log("WARNING", f"生成测试用例警告: {error}")
+        
+        return batch_result.get("test_cases", [])
+    
     def _run_tests(self, test_cases):
-        """执行测试用例并评估结果"""
+        """执行测试用例并评估结果（同步入口）"""
+        return run_coro_sync(self._run_tests_async(test_cases))
+    
+    async def _run_tests_async(self, test_cases):
+        """
+        执行测试用例并评估结果
+        
+        所有用例的模型调用并发执行，完成后将评估任务合并为 ⌈N/B⌉ 次评估请求，
+        共享的评估模板和提示词不再为每个用例重复发送
+        """
         try:
-            self._log("DEBUG", f"开始运行 {len(test_cases)} 个测试")
+            self._log("DEBUG", "开始运行 %d 个测试", len(test_cases))
             
-            from utils.parallel_executor import execute_models_sync
+            # 所有用例共享同一系统提示词，作为独立的system消息发送，便于提供商复用前缀缓存
+            system_message = {"role": "system", "content": self.current_prompt}
+            prompt_cache_key = make_request_cache_key(self.model, self.provider, self.current_prompt, {})
             
-            # 准备批量请求
-            requests = []
-            for idx, test_case in enumerate(test_cases):
+            async def run_case(test_case):
                 user_input = test_case.get("user_input", "")
-                expected_output = test_case.get("expected_output", "")
-                criteria = test_case.get("evaluation_criteria", {})
-                
-                # 准备请求
-                request = {
-                    "model": self.model,
-                    "provider": self.provider,
-                    "prompt": f"{self.current_prompt}\n\n{user_input}",
-                    "params": {
-                        "temperature": self.temperature,
-                        "max_tokens": 2000
-                    },
-                    "context": {
-                        "expected_output": expected_output,
-                        "criteria": criteria,
-                        "prompt": self.current_prompt,
-                        "user_input": user_input,
-                        "idx": idx
-                    }
+                messages = [system_message, {"role": "user", "content": user_input}]
+                params = {
+                    "temperature": self.temperature,
+                    "max_tokens": 2000,
+                    "prompt_cache_key": prompt_cache_key
                 }
-                requests.append(request)
-            
-            # 批量执行模型调用
-            responses = execute_models_sync(requests)
-            
-            # 准备评估任务
-            evaluation_tasks = []
-            for response in responses:
-                if response.get("error"):
-                    self._log("WARNING", f"测试调用错误: {response.get('error')}")
-                    continue
                 
-                context = response.get("context", {})
+                # 提示词和用户输入未变化时直接复用缓存的响应
+                # 系统提示词已由定长的 prompt_cache_key 摘要代表，缓存键只需拼接用户输入，无需为每个用例重新序列化整段提示词
+                cache_key = make_request_cache_key(self.model, self.provider, f"{prompt_cache_key}|{user_input}", params)
+                cached_text = get_cached_response(cache_key) if self.use_cache else None
+                if cached_text is not None:
+                    response = {"text": cached_text, "model": self.model}
+                else:
+                    # 经由合批器提交，与其他并发优化任务的请求合并调度，共享并发限制
+                    response = await default_batcher.submit({
+                        "model": self.model,
+                        "messages": messages,
+                        "provider": self.provider,
+                        "params": params
+                    })
+                    
+                    if response.get("error"):
+                        self._log("WARNING", f"测试调用错误: {response.get('error')}")
+                        return None
+                    if self.use_cache and response.get("text"):
+                        set_cached_response(cache_key, self.model, response["text"])
                 
-                evaluation_tasks.append({
+                return {
                     "model_response": response.get("text", ""),
-                    "expected_output": context.get("expected_output", ""),
-                    "criteria": context.get("criteria", {}),
-                    "prompt": context.get("prompt", ""),
-                    "user_input": context.get("user_input", "")
-                })
+                    "expected_output": test_case.get("expected_output", ""),
+                    "criteria": test_case.get("evaluation_criteria", {}),
+                    "prompt": self.current_prompt,
+                    "user_input": user_input
+                }
+            
+            # 所有用例并发执行，结果保持原始顺序
+            evaluation_tasks = await asyncio.gather(*(run_case(tc) for tc in test_cases))
+            evaluation_tasks = [task for task in evaluation_tasks if task is not None]
             
             if not evaluation_tasks:
                 self._log("ERROR", "所有测试调用均失败")
                 return []
             
-            # 执行评估
-            eval_results = self.evaluator.run_evaluation(evaluation_tasks)
-            
-            # 处理评估结果，添加用户输入等信息
-            processed_results = []
-            for i, result in enumerate(eval_results):
-                if i < len(evaluation_tasks):
-                    processed_result = dict(result)
-                    processed_result["user_input"] = evaluation_tasks[i].get("user_input", "")
-                    processed_result["model_response"] = evaluation_tasks[i].get("model_response", "")
-                    processed_results.append(processed_result)
+            eval_results = await self.evaluator.run_evaluation_batched_async(evaluation_tasks)
+            # 评估结果都是本次新建的字典，直接补充用户输入等信息，无需复制
+            for task, eval_result in zip(evaluation_tasks, eval_results):
+                eval_result["user_input"] = task["user_input"]
+                eval_result["model_response"] = task["model_response"]
+            processed_results = eval_results
             
             self._log("INFO", f"完成 {len(processed_results)} 个测试的评估")
             return processed_results
         except Exception as e:
-            import traceback
             self._log("ERROR", f"运行测试失败: {str(e)}")
-            self._log("DEBUG", traceback.format_exc())
+            if self._debug_enabled:
+                self._log("DEBUG", traceback.format_exc())
             return []
     
-    def _generate_test_directions(self):
-        """生成测试方向"""
+    def _generate_test_directions(self, target_prompt=None):
+        """生成测试方向，target_prompt 为空时针对当前提示词"""
+        target_prompt = target_prompt or self.current_prompt
+        # 提示词未变化（如上一轮优化失败）时直接复用本次运行中已生成的测试方向
+        if self.use_cache and target_prompt in self._directions_cache:
+            self._log("DEBUG", "提示词未变化，复用已生成的测试方向")
+            return list(self._directions_cache[target_prompt])
         try:
             # 尝试使用LLM生成针对当前提示词的测试方向
-            from utils.parallel_executor import execute_model_sync
             
             # 准备生成测试方向的提示词 - 使用初始提示词和当前提示词的组合，确保测试方向不会偏离原始目标
             prompt = f"""
@@ -353,55 +771,69 @@ class AutomaticPromptOptimizer:
 
 【当前优化版本】:
 ```
-{self.current_prompt}
+{target_prompt}
 ```
 
 重要说明：请确保生成的测试方向始终围绕原始提示词要解决的核心问题，无论提示词如何演变，测试方向都必须保持对原始任务目标的一致性。
 
-请返回5个测试方向，每个测试方向应该是一句话描述，格式如下:
-1. [测试方向描述]
-2. [测试方向描述]
-...
-5. [测试方向描述]
+请返回5个测试方向，每个测试方向应该是一句话描述。请仅返回如下格式的JSON，不要输出其他内容:
+{{"directions": ["测试方向描述", "测试方向描述", "测试方向描述", "测试方向描述", "测试方向描述"]}}
 """
             
-            # 调用模型
-            result = execute_model_sync(
-                model=self.iter_model,
-                prompt=prompt,
-                provider=self.iter_provider,
-                params={
-                    "temperature": 0.9,
-                    "max_tokens": 1000
-                }
-            )
+            params = {
+                "temperature": 0.9,
+                "max_tokens": 1000
+            }
+            if self.iter_provider in JSON_MODE_PROVIDERS:
+                params["response_format"] = {"type": "json_object"}
             
-            if "error" in result:
-                self._log("ERROR", f"生成测试方向时出错: {result['error']}")
-                return self._get_default_test_directions()
+            # 提示词未变化时复用缓存的测试方向
+            cache_key = make_request_cache_key(self.iter_model, self.iter_provider, prompt, params)
+            response_text = get_cached_response(cache_key) if self.use_cache else None
+            
+            if response_text is None:
+                # 调用模型
+                result = execute_model_sync(
+                    model=self.iter_model,
+                    prompt=prompt,
+                    provider=self.iter_provider,
+                    params=params
+                )
                 
-            response_text = result.get("text", "")
+                if "error" in result:
+                    self._log("ERROR", f"生成测试方向时出错: {result['error']}")
+                    return self._get_default_test_directions()
+                    
+                response_text = result.get("text", "")
+                if self.use_cache and response_text:
+                    set_cached_response(cache_key, self.iter_model, response_text)
             
-            # 解析响应文本，提取测试方向
-            import re
+            # 解析响应文本，提取测试方向：优先按JSON解析
             directions = []
+            data, error = parse_json_response(response_text)
+            if not error and isinstance(data, dict) and isinstance(data.get("directions"), list):
+                directions = [d.strip() for d in data["directions"] if isinstance(d, str) and d.strip()]
             
-            # 尝试匹配格式为 "1. xxx", "2. xxx" 的行
-            numbered_directions = re.findall(r'\d+\.\s*(.*?)(?=\n\d+\.|\Z)', response_text, re.DOTALL)
-            if numbered_directions:
-                directions.extend([d.strip() for d in numbered_directions if d.strip()])
+            # JSON解析失败时，尝试匹配格式为 "1. xxx", "2. xxx" 的行
+            if not directions:
+                numbered_directions = NUMBERED_DIRECTION_RE.findall(response_text)
+                if numbered_directions:
+                    directions.extend([d.strip() for d in numbered_directions if d.strip()])
             
             # 如果没有找到足够的方向，尝试按行分割
             if len(directions) < 3:
+                # 已有方向的每一行都记入集合，按行精确去重
+                seen = {part.strip() for d in directions for part in d.split('\n')}
                 lines = response_text.split('\n')
                 for line in lines:
                     line = line.strip()
                     # 跳过空行和已经添加的方向
-                    if not line or any(line in d for d in directions):
+                    if not line or line in seen:
                         continue
                     # 删除可能的序号前缀
-                    line = re.sub(r'^\d+[\.\)]\s*', '', line)
-                    if line:
+                    line = NUMBER_PREFIX_RE.sub('', line)
+                    if line and line not in seen:
+                        seen.add(line)
                         directions.append(line)
             
             # 如果仍然不够，添加默认方向
@@ -410,14 +842,11 @@ class AutomaticPromptOptimizer:
                 directions.extend(self._get_default_test_directions()[:missing])
             
             # 为每个方向添加具体的测试用例生成指示，添加提示保持测试与原始目标的一致性
-            expanded_directions = []
-            for d in directions[:5]:  # 最多取5个
-                expanded_directions.append(
-                    f"测试方向：{d} - 请为此方向生成详细的测试用例，包含用户输入和期望输出，用于评估提示词的效果。确保测试用例严格对应原始提示词的预期目标和用途。"
-                )
+            expanded_directions = [EXPANDED_DIRECTION_TEMPLATE.format(d) for d in directions[:5]]  # 最多取5个
             
-            self._log("DEBUG", f"生成了 {len(expanded_directions)} 个测试方向")
-            return expanded_directions
+            self._log("DEBUG", "生成了 %d 个测试方向", len(expanded_directions))
+            self._directions_cache[target_prompt] = expanded_directions
+            return list(expanded_directions)
             
         except Exception as e:
             self._log("ERROR", f"生成测试方向失败: {str(e)}")
@@ -425,201 +854,229 @@ class AutomaticPromptOptimizer:
     
     def _get_default_test_directions(self):
         """返回默认的测试方向"""
-        return [
-            "测试方向：基本功能测试 - 请生成测试用例检查提示词的基本功能是否正常工作，能否按照原始目标预期响应简单问题。",
-            "测试方向：格式遵循测试 - 请生成测试用例检查提示词是否能按照指定的格式要求输出内容，同时确保内容与原始任务目标一致。",
-            "测试方向：复杂度测试 - 请生成测试用例包含复杂问题或多个问题，检查提示词处理复杂信息的能力，但始终确保问题围绕原始提示词的核心目标。",
-            "测试方向：边界条件测试 - 请生成一些边界情况的测试用例，检查提示词在极端情况下的表现，同时保持对原始任务目标的专注。",
-            "测试方向：指令跟随测试 - 请生成测试用例，检查提示词是否能严格按照用户指令执行，同时与原始提示词的预期用途保持一致。"
-        ]
+        return list(DEFAULT_TEST_DIRECTIONS)
+    
+    def _template_vars(self, prompt):
+        """提取提示词中的模板变量，对同一提示词只扫描一次"""
+        if prompt != self._vars_prompt:
+            self._vars_cache = TEMPLATE_VAR_RE.findall(prompt)
+            self._vars_prompt = prompt
+        return self._vars_cache
+    
+    @staticmethod
+    def _locate_anchors(text, anchors):
+        """
+        定位每个锚点文本在 text 中首次和最后一次出现的起始位置，未出现时为 -1
+        
+        返回 {锚点: (首次位置, 最后位置)}；锚点只有少数几个变量的上下文，逐个 find/rfind 即可
+        """
+        return {anchor: (text.find(anchor), text.rfind(anchor)) for anchor in anchors}
+    
+    @staticmethod
+    def _extract_var_contexts(prompt, width=30):
+        """
+        一次扫描提取每个模板变量首次出现处前后同一行内最多 width 个字符的上下文
+        
+        返回 {变量名: (前文, 后文)}
+        """
+        contexts = {}
+        for match in TEMPLATE_VAR_RE.finditer(prompt):
+            var = match.group(1)
+            if var in contexts:
+                continue
+            start, end = match.span()
+            line_start = prompt.rfind("\n", 0, start) + 1
+            line_end = prompt.find("\n", end)
+            if line_end == -1:
+                line_end = len(prompt)
+            contexts[var] = (prompt[max(line_start, start - width):start], prompt[end:min(end + width, line_end)])
+        return contexts
+    
+    def _extract_scores(self, results):
+        """提取评估结果中的有效总分，返回float数组"""
+        return np.fromiter(
+            (r["overall_score"] for r in results if isinstance(r.get("overall_score"), (int, float))),
+            dtype=np.float64
+        )
+    
+    @staticmethod
+    def _mean_score(scores):
+        """得分数组的平均值，没有有效得分时为0.0"""
+        return float(scores.mean()) if scores.size else 0.0
     
     def _calculate_average_score(self, results):
         """计算评估结果的平均分数"""
-        if not results:
-            return 0
-            
-        scores = []
-        for result in results:
-            if "overall_score" in result and isinstance(result["overall_score"], (int, float)):
-                scores.append(result["overall_score"])
-                
-        return sum(scores) / len(scores) if scores else 0
+        return self._mean_score(self._extract_scores(results))
     
     def _optimize_prompt(self, test_results):
         """基于测试结果优化提示词"""
         try:
             self._log("DEBUG", "开始基于测试结果优化提示词")
             
-            # 检测原始提示词中的变量结构 - 使用正则表达式匹配 {{variable}}
-            import re
-            template_vars = re.findall(r'{{(.*?)}}', self.current_prompt)
-            self._log("DEBUG", f"检测到原始提示词中包含 {len(template_vars)} 个模板变量: {', '.join(template_vars)}")
+            # 原始提示词中的变量结构（初始化时已提取）
+            template_vars = self._required_template_vars
+            self._log("DEBUG", "检测到原始提示词中包含 %d 个模板变量: %s", len(template_vars), ', '.join(template_vars))
             
-            # 添加重试机制
+            # 每次尝试内部已并发推测生成，失败后才依次发起下一次尝试，最多尝试 optimization_retries 次
             max_retries = self.optimization_retries
-            retry_count = 0
-            optimization_result = None
-            new_prompt = None
             
-            while retry_count < max_retries:
-                self._log("DEBUG", f"优化提示词尝试 {retry_count + 1}/{max_retries}...")
-                # 使用优化器优化提示词
-                current_optimization_result = self.optimizer.optimize_prompt_sync(
-                    original_prompt=self.current_prompt,
-                    test_results=test_results,
-                    optimization_strategy=self.optimization_strategy
-                )
-                
-                # 检查结果是否有错误
-                if "error" in current_optimization_result:
-                    error_msg = current_optimization_result["error"]
-                    if "空响应内容" in error_msg or "JSON解析失败" in error_msg or "未能生成优化提示词" in error_msg:
-                        retry_count += 1
-                        self._log("WARNING", f"优化尝试 {retry_count}/{max_retries} 失败: {error_msg}，准备重试...")
-                        if retry_count < max_retries:
-                            time.sleep(1)
-                        continue
-                    else:
-                        # 如果是其他错误，不重试
-                        self._log("ERROR", f"优化提示词时发生不可重试错误: {error_msg}")
-                        return None
-                
-                # 获取优化结果
-                optimized_prompts = current_optimization_result.get("optimized_prompts", [])
-                if not optimized_prompts:
-                    retry_count += 1
-                    self._log("WARNING", f"优化尝试 {retry_count}/{max_retries} 未生成优化提示词，准备重试...")
-                    if retry_count < max_retries:
-                        time.sleep(1)
-                    continue
+            # 相同提示词、相同测试结果和策略下复用之前成功的优化结果
+            cache_key = make_request_cache_key(
+                self.iter_model, self.iter_provider, self.current_prompt,
+                {"strategy": self.optimization_strategy, "test_results": orjson.dumps(test_results, default=str, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode()}
+            )
+            cached_result = get_cached_response(cache_key) if self.use_cache else None
+            
+            if cached_result is not None:
+                optimization_result = orjson.loads(cached_result)
+            else:
+                self._log("DEBUG", "开始优化提示词，最多尝试 %d 次...", max_retries)
+                optimization_result, failures = run_coro_sync(self._optimize_with_retries(test_results, max_retries))
                 
-                # 选择第一个优化提示词
-                best_opt = optimized_prompts[0]
-                new_prompt_candidate = best_opt.get("prompt", "")
+                for attempt, failure in enumerate(failures, 1):
+                    self._log("WARNING", "优化尝试 %d/%d 失败: %s", attempt, max_retries, failure.get("error", "未生成优化提示词"))
                 
-                if not new_prompt_candidate:
-                    retry_count += 1
-                    self._log("WARNING", f"优化尝试 {retry_count}/{max_retries} 生成了空提示词，准备重试...")
-                    if retry_count < max_retries:
-                        time.sleep(1)
-                    continue
+                if optimization_result is None:
+                    # 存在非瞬时错误时按不可重试错误记录
+                    fatal_errors = [
+                        failure["error"] for failure in failures
+                        if "error" in failure and not any(marker in failure["error"] for marker in RETRYABLE_OPTIMIZATION_ERRORS)
+                    ]
+                    if fatal_errors:
+                        self._log("ERROR", f"优化提示词时发生不可重试错误: {fatal_errors[0]}")
+                    else:
+                        self._log("ERROR", f"在 {max_retries} 次尝试后仍未能成功优化提示词")
+                    return None
                 
-                new_prompt = new_prompt_candidate
-                break
+                if self.use_cache:
+                    set_cached_response(cache_key, self.iter_model, orjson.dumps(optimization_result, default=str, option=orjson.OPT_NON_STR_KEYS).decode())
             
-            # 如果所有尝试都失败，记录错误并返回 None
-            if new_prompt is None:
-                self._log("ERROR", f"在 {max_retries} 次尝试后仍未能成功优化提示词")
+            # 选择第一个优化提示词
+            best_opt = self._first_optimized_prompt(optimization_result)
+            if best_opt is None:
+                self._log("ERROR", "缓存的优化结果无效")
                 return None
+            new_prompt = best_opt["prompt"]
                 
             # 检查优化后的提示词是否保留了所有原始变量
             if template_vars:
-                missing_vars = []
-                for var in template_vars:
-                    var_pattern = r'{{' + re.escape(var) + r'}}'
-                    if not re.search(var_pattern, new_prompt):
-                        missing_vars.append(var)
+                # 一次扫描取出优化后提示词中的全部变量，用集合差得到缺失变量
+                present_vars = set(self._template_vars(new_prompt))
+                missing_vars = [var for var in template_vars if var not in present_vars]
                 
                 if missing_vars:
                     self._log("WARNING", f"优化后提示词中缺少以下变量: {', '.join(missing_vars)}")
                     
                     # 尝试恢复丢失的变量 - 这是一个简化的修复方法
+                    # 所有插入位置都基于同一份提示词计算，最后一次性拼接，避免每恢复一个变量就复制整个字符串
+                    insertions = []
+                    suffixes = []
+                    # 当前提示词中已丢失的变量使用初始提示词中的上下文定位
+                    var_contexts = {**self._extract_var_contexts(self.initial_prompt), **self._extract_var_contexts(self.current_prompt)}
+                    # 所有变量的前后文锚点在优化后提示词中的位置一次性定位
+                    anchor_positions = self._locate_anchors(new_prompt, {
+                        context.strip()
+                        for var in missing_vars if var in var_contexts
+                        for context in var_contexts[var]
+                        if len(context.strip()) > 5
+                    })
                     for var in missing_vars:
-                        var_pattern = r'{{' + re.escape(var) + r'}}'
-                        var_match = re.search(r'(.{0,30})' + var_pattern + r'(.{0,30})', self.current_prompt)
-                        if var_match:
-                            before_context = var_match.group(1)
-                            after_context = var_match.group(2)
-                            
-                            if before_context and len(before_context.strip()) > 5:
-                                last_before = new_prompt.rfind(before_context.strip())
-                                if last_before != -1:
-                                    insert_pos = last_before + len(before_context)
-                                    new_prompt = new_prompt[:insert_pos] + f" {{{{{var}}}}} " + new_prompt[insert_pos:]
-                                    self._log("INFO", f"在位置 {insert_pos} 恢复了变量 {{{{{var}}}}}")
-                                    continue
-                            
-                            if after_context and len(after_context.strip()) > 5:
-                                first_after = new_prompt.find(after_context.strip())
-                                if first_after != -1:
-                                    insert_pos = first_after
-                                    new_prompt = new_prompt[:insert_pos] + f" {{{{{var}}}}} " + new_prompt[insert_pos:]
-                                    self._log("INFO", f"在位置 {insert_pos} 恢复了变量 {{{{{var}}}}}")
-                                    continue
-                            
-                            self._log("WARNING", f"无法找到合适位置恢复变量 {{{{{var}}}}}，将添加到提示词末尾")
-                            new_prompt = new_prompt + f"\n\n请使用 {{{{{var}}}}} 变量替换相应内容。"
-                
-                all_recovered = True
-                for var in template_vars:
-                    var_pattern = r'{{' + re.escape(var) + r'}}'
-                    if not re.search(var_pattern, new_prompt):
-                        all_recovered = False
-                        break
-                
-                if all_recovered:
-                    self._log("INFO", "成功恢复所有模板变量")
-                else:
-                    self._log("WARNING", "部分模板变量可能未正确恢复，请检查优化后的提示词")
+                        if var not in var_contexts:
+                            continue
+                        before_context, after_context = var_contexts[var]
+                        
+                        if before_context and len(before_context.strip()) > 5:
+                            last_before = anchor_positions[before_context.strip()][1]
+                            if last_before != -1:
+                                insertions.append((min(last_before + len(before_context), len(new_prompt)), var))
+                                continue
+                        
+                        if after_context and len(after_context.strip()) > 5:
+                            first_after = anchor_positions[after_context.strip()][0]
+                            if first_after != -1:
+                                insertions.append((first_after, var))
+                                continue
+                        
+                        self._log("WARNING", f"无法找到合适位置恢复变量 {{{{{var}}}}}，将添加到提示词末尾")
+                        suffixes.append(f"\n\n请使用 {{{{{var}}}}} 变量替换相应内容。")
+                    
+                    if insertions:
+                        insertions.sort(key=lambda item: item[0])
+                        parts = []
+                        prev_pos = 0
+                        for insert_pos, var in insertions:
+                            parts.append(new_prompt[prev_pos:insert_pos])
+                            parts.append(f" {{{{{var}}}}} ")
+                            prev_pos = insert_pos
+                            self._log("INFO", f"在位置 {insert_pos} 恢复了变量 {{{{{var}}}}}")
+                        parts.append(new_prompt[prev_pos:])
+                        new_prompt = "".join(parts)
+                    new_prompt += "".join(suffixes)
+                    
+                    # 对恢复后的提示词再做一次扫描，结果同时作为下一轮当前提示词的变量缓存
+                    all_recovered = set(missing_vars) <= set(self._template_vars(new_prompt))
+                    
+                    if all_recovered:
+                        self._log("INFO", "成功恢复所有模板变量")
+                    else:
+                        self._log("WARNING", "部分模板变量可能未正确恢复，请检查优化后的提示词")
                     
             self._log("INFO", f"提示词优化成功，新长度: {len(new_prompt)} 字符")
-            self._log("DEBUG", f"优化策略: {best_opt.get('strategy', '未指定')}")
-            self._log("DEBUG", f"解决的问题: {best_opt.get('problem_addressed', '未指定')}")
+            self._log("DEBUG", "优化策略: %s", best_opt.get('strategy', '未指定'))
+            self._log("DEBUG", "解决的问题: %s", best_opt.get('problem_addressed', '未指定'))
             
             return new_prompt
             
         except Exception as e:
-            import traceback
             self._log("ERROR", f"优化提示词失败: {str(e)}")
-            self._log("DEBUG", traceback.format_exc())
+            if self._debug_enabled:
+                self._log("DEBUG", traceback.format_exc())
             return None
         
-    def _generate_default_test_cases(self):
-        """生成默认测试用例，当自动生成失败时使用"""
-        import time, uuid
+    @staticmethod
+    def _first_optimized_prompt(result):
+        """取出优化结果中的第一个优化提示词，结果出错或提示词为空时返回None"""
+        if "error" in result:
+            return None
+        optimized_prompts = result.get("optimized_prompts") or []
+        if not optimized_prompts or not optimized_prompts[0].get("prompt"):
+            return None
+        return optimized_prompts[0]
+    
+    async def _optimize_with_retries(self, test_results, attempts):
+        """
+        依次发起优化尝试，返回第一个有效结果
         
-        original_goal = "满足原始提示词的预期目标"
+        speculative 模式下 optimize_prompt 内部已按 SPECULATIVE_TEMPERATURES 并发多次采样并取最先成功的结果，
+        这里只在整次尝试失败后再重试，不再叠加一层并发
         
+        Returns:
+            (有效结果或None, 在此之前完成的失败结果列表)
+        """
+        failures = []
+        for _ in range(max(1, attempts)):
+            try:
+                result = await self.optimizer.optimize_prompt(
+                    original_prompt=self.current_prompt,
+                    test_results=test_results,
+                    optimization_strategy=self.optimization_strategy,
+                    speculative=True
+                )
+            except Exception as e:
+                result = {"error": str(e)}
+            if self._first_optimized_prompt(result) is not None:
+                return result, failures
+            failures.append(result)
+            # 不可重试的错误直接放弃剩余尝试
+            if "error" in result and not any(marker in result["error"] for marker in RETRYABLE_OPTIMIZATION_ERRORS):
+                break
+        return None, failures
+    
+    def _generate_default_test_cases(self):
+        """生成默认测试用例，当自动生成失败时使用"""
         test_cases = [
-            {
-                "id": f"default_{int(time.time())}_{uuid.uuid4().hex[:6]}",
-                "description": "基本功能测试 - 原始目标一致性",
-                "user_input": f"请提供一个简单任务，测试提示词是否能够按照原始设计目标正常工作。",
-                "expected_output": f"一个完整、准确的回应，满足提示词的基本要求，并且与原始提示词的核心目标保持一致：{original_goal}。",
-                "evaluation_criteria": {
-                    "accuracy": "评估回答是否准确体现了原始提示词的意图",
-                    "completeness": "评估回答是否完整覆盖了原始提示词的要求",
-                    "relevance": "评估回答是否与原始提示词的目标相关",
-                    "clarity": "评估回答的清晰度",
-                    "goal_consistency": "评估回答是否始终保持对原始目标的专注"
-                }
-            },
-            {
-                "id": f"default_{int(time.time())+1}_{uuid.uuid4().hex[:6]}",
-                "description": "边界条件测试 - 保持原始目标",
-                "user_input": "这是一个复杂的测试用例，包含多个需求和边界条件，但仍然需要围绕原始提示词的核心目标。",
-                "expected_output": "一个能全面处理复杂需求和边界条件的回答，同时不偏离原始提示词的预期用途。",
-                "evaluation_criteria": {
-                    "accuracy": "评估回答在复杂情况下的准确性",
-                    "completeness": "评估回答在边界条件下的完整性",
-                    "relevance": "评估回答是否始终与原始提示词目标相关",
-                    "clarity": "评估回答的清晰度",
-                    "goal_adherence": "评估即使在复杂情况下是否仍然坚持原始目标"
-                }
-            },
-            {
-                "id": f"default_{int(time.time())+2}_{uuid.uuid4().hex[:6]}",
-                "description": "指令遵循测试 - 原始目标框架内",
-                "user_input": "请严格按照以下格式回答，但确保内容仍然紧密围绕原始提示词的核心目标：1. 问题分析 2. 可能的解决方案 3. 建议的最佳方案。",
-                "expected_output": "一个严格按照指定格式的回答，同时确保内容始终聚焦于原始提示词要解决的核心问题。",
-                "evaluation_criteria": {
-                    "accuracy": "评估回答的准确性",
-                    "completeness": "评估回答的完整性",
-                    "relevance": "评估回答对原始目标的相关性",
-                    "clarity": "评估回答的清晰度",
-                    "instruction_following": "评估是否遵循了格式要求同时保持对原始目标的专注"
-                }
-            }
+            {**template, "id": _fast_id("default")}
+            for template in DEFAULT_TEST_CASE_TEMPLATES
         ]
         
         self._log("INFO", f"已生成 {len(test_cases)} 个默认测试用例，确保与原始提示词目标保持一致")
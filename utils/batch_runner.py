@@ -0,0 +1,283 @@
+"""
+Batch API 执行模块，用于大规模测试运行
+
+通过OpenAI Batch API异步提交所有请求（24小时内完成，费用为实时调用的50%）。
+提交后立即返回作业信息，由调用方保存并在之后的页面运行中查询状态，
+任务结束后下载结果并整理为与 run_test 相同的结构
+"""
+
+import json
+import time
+from typing import Dict, List, Optional, Callable, Tuple
+
+import openai
+
+from config import get_api_key
+from utils.common import make_prompt_renderer, needs_evaluation
+from utils.evaluator import PromptEvaluator
+
+# 支持Batch API的提供商
+BATCH_SUPPORTED_PROVIDERS = {"openai"}
+
+# Batch API 相对实时调用的费用系数
+BATCH_COST_FACTOR = 0.5
+
+# 批处理任务的终止状态
+BATCH_FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def supports_batch_api(provider: str) -> bool:
+    """判断提供商是否支持Batch API"""
+    return provider in BATCH_SUPPORTED_PROVIDERS
+
+
+def submit_batch(requests: List[Dict]) -> str:
+    """
+    将请求列表上传为JSONL文件并创建批处理任务
+
+    Args:
+        requests: 请求列表，每个请求包含custom_id、model、messages、params
+
+    Returns:
+        str: 批处理任务ID
+    """
+    openai.api_key = get_api_key("openai")
+
+    lines = []
+    for req in requests:
+        params = req.get("params", {})
+        lines.append(json.dumps({
+            "custom_id": req["custom_id"],
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": req["model"],
+                "messages": req["messages"],
+                "temperature": params.get("temperature", 0.7),
+                "max_tokens": params.get("max_tokens", 1000)
+            }
+        }, ensure_ascii=False))
+
+    batch_file = openai.files.create(
+        file=("batch_requests.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch"
+    )
+    batch = openai.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    return batch.id
+
+
+def check_batch(batch_id: str):
+    """
+    查询一次批处理任务状态，不阻塞等待
+
+    Returns:
+        批处理任务对象
+    """
+    openai.api_key = get_api_key("openai")
+    return openai.batches.retrieve(batch_id)
+
+
+def is_batch_finished(batch) -> bool:
+    """判断批处理任务是否已结束"""
+    return batch.status in BATCH_FINAL_STATUSES
+
+
+def collect_batch_results(batch) -> Dict[str, Dict]:
+    """
+    下载批处理任务的输出文件并按custom_id整理结果
+
+    Returns:
+        Dict[str, Dict]: custom_id -> {"text", "usage"} 或 {"error"}
+    """
+    results = {}
+
+    if batch.output_file_id:
+        content = openai.files.content(batch.output_file_id).text
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get("response") or {}
+            body = response.get("body") or {}
+            if response.get("status_code") == 200 and body.get("choices"):
+                results[item["custom_id"]] = {
+                    "text": body["choices"][0]["message"]["content"],
+                    "usage": body.get("usage", {})
+                }
+            else:
+                error = item.get("error") or body.get("error") or "Batch请求失败"
+                results[item["custom_id"]] = {"error": str(error)}
+
+    if batch.error_file_id:
+        content = openai.files.content(batch.error_file_id).text
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            results.setdefault(item["custom_id"], {"error": str(item.get("error") or "Batch请求失败")})
+
+    return results
+
+
+def _render_prompts(templates: List[Dict], test_set: Dict) -> Dict[Tuple[int, int], str]:
+    """渲染结果只与(模板, 用例)有关，提交请求和整理结果时共用"""
+    cases = test_set.get("cases", [])
+    renderers = [make_prompt_renderer(template, test_set) for template in templates]
+    return {
+        (ti, ci): render(case)
+        for ti, render in enumerate(renderers)
+        for ci, case in enumerate(cases)
+    }
+
+
+def submit_test_batch(templates: List[Dict],
+                      models: List[str],
+                      test_set: Dict,
+                      model_provider_map: Dict[str, str],
+                      repeat_count: int = 1,
+                      temperature: float = 0.7,
+                      max_tokens: int = 1000) -> Optional[Dict]:
+    """
+    将所有(模板, 用例, 模型, 重复)组合提交为一个批处理任务，立即返回，不等待任务完成
+
+    Args:
+        templates: 提示词模板列表
+        models: 模型列表（需均为支持Batch API的提供商）
+        test_set: 测试集
+        model_provider_map: 模型到提供商的映射
+        repeat_count: 每个用例的重复次数
+        temperature: 温度参数
+        max_tokens: 最大输出token
+
+    Returns:
+        Dict: 批处理作业信息（含batch_id和整理结果所需的全部参数），调用方保存后由 collect_test_batch 收取；
+        没有请求时返回None
+    """
+    cases = test_set.get("cases", [])
+    rendered = _render_prompts(templates, test_set)
+
+    # 每个(模板, 用例, 模型, 重复)组合对应一行请求，custom_id 用于结果回填
+    requests = []
+    for ti, template in enumerate(templates):
+        for ci, case in enumerate(cases):
+            messages = [
+                {"role": "system", "content": rendered[(ti, ci)]},
+                {"role": "user", "content": case.get("user_input", "")}
+            ]
+            for mi, model in enumerate(models):
+                for ri in range(repeat_count):
+                    requests.append({
+                        "custom_id": f"t{ti}_c{ci}_m{mi}_r{ri}",
+                        "model": model,
+                        "messages": messages,
+                        "params": {"temperature": temperature, "max_tokens": max_tokens}
+                    })
+
+    if not requests:
+        return None
+
+    return {
+        "batch_id": submit_batch(requests),
+        "submitted_at": time.time(),
+        "templates": templates,
+        "models": models,
+        "test_set": test_set,
+        "model_provider_map": {model: model_provider_map.get(model) for model in models},
+        "repeat_count": repeat_count,
+        "temperature": temperature,
+        "max_tokens": max_tokens
+    }
+
+
+def collect_test_batch(job: Dict,
+                       progress_callback: Optional[Callable] = None) -> Tuple[str, Optional[Dict[Tuple[str, str], Dict]]]:
+    """
+    查询批处理作业，已结束时下载结果、评估并整理为 run_test 的结果结构
+
+    Args:
+        job: submit_test_batch 返回的作业信息
+        progress_callback: 每整理完一个响应调用一次，与 run_test 一致
+
+    Returns:
+        (任务状态, 结果)：任务未结束时结果为None；
+        结果为 Dict[(模板名称, 模型), Dict]，与 run_test 返回结构一致
+    """
+    batch = check_batch(job["batch_id"])
+    if not is_batch_finished(batch):
+        return batch.status, None
+
+    templates = job["templates"]
+    models = job["models"]
+    test_set = job["test_set"]
+    repeat_count = job["repeat_count"]
+    cases = test_set.get("cases", [])
+    rendered = _render_prompts(templates, test_set)
+    batch_outputs = collect_batch_results(batch)
+
+    # 整理为 run_test 的结果结构
+    results = {}
+    eval_inputs = []
+    eval_response_refs = []
+    for ti, template in enumerate(templates):
+        for mi, model in enumerate(models):
+            test_cases = []
+            for ci, case in enumerate(cases):
+                prompt_template = rendered[(ti, ci)]
+                case_result = {
+                    "case_id": case.get("id", ""),
+                    "case_description": case.get("description", ""),
+                    "prompt": prompt_template,
+                    "user_input": case.get("user_input", ""),
+                    "expected_output": case.get("expected_output", ""),
+                    "model": model,
+                    "responses": []
+                }
+                for ri in range(repeat_count):
+                    output = batch_outputs.get(f"t{ti}_c{ci}_m{mi}_r{ri}", {"error": f"Batch任务状态: {batch.status}"})
+                    error = output.get("error")
+                    if not error and not output.get("text"):
+                        error = "模型未返回内容"
+                    response_data = {
+                        "attempt": ri + 1,
+                        "response": output.get("text", ""),
+                        "error": error,
+                        "usage": output.get("usage", {}),
+                        "evaluation": None
+                    }
+                    case_result["responses"].append(response_data)
+                    if not response_data["error"] and needs_evaluation(case):
+                        eval_inputs.append({
+                            "model_response": response_data["response"],
+                            "expected_output": case_result["expected_output"],
+                            "criteria": case.get("evaluation_criteria", {}),
+                            "prompt": prompt_template
+                        })
+                        eval_response_refs.append(response_data)
+                    if progress_callback:
+                        progress_callback()
+                test_cases.append(case_result)
+
+            results[(template["name"], model)] = {
+                "template": template,
+                "model": model,
+                "model_provider": job["model_provider_map"].get(model),
+                "test_params": {
+                    "repeat_count": repeat_count,
+                    "temperature": job["temperature"],
+                    "batch_id": job["batch_id"]
+                },
+                "test_cases": test_cases
+            }
+
+    # 统一评估所有成功的响应
+    if eval_inputs:
+        evaluator = PromptEvaluator()
+        eval_results = evaluator.run_evaluation(evaluation_tasks=eval_inputs)
+        for resp, eval_result in zip(eval_response_refs, eval_results):
+            resp["evaluation"] = eval_result
+
+    return batch.status, results
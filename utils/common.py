@@ -2,77 +2,157 @@
 
 import streamlit as st
 import json
+import re
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 from typing import Dict, List, Any, Optional, Tuple, Callable
 import asyncio
+import threading
 import time
 
 from models.token_counter import count_tokens
-from models.api_clients import get_client, get_provider_from_model
+from models.api_clients import get_client, get_provider_from_model, supports_n_sampling
 from utils.evaluator import PromptEvaluator
+from utils.helpers import parse_json_response
+from utils.constants import DEFAULT_EVALUATION_CRITERIA
 from config import load_config
 # Import the new parallel executor
-from utils.parallel_executor import execute_model, execute_models, execute_model_sync, execute_models_sync
+from utils.parallel_executor import execute_model, execute_models, execute_model_sync, execute_models_sync, run_coro_sync, close_private_loop
+from utils.llm_cache import make_cache_key, make_request_cache_key, get_cached_response, get_cached_responses, set_cached_response, flush_llm_cache
 
-def calculate_average_score(results):
-    """计算平均得分"""
-    total_score = 0
-    count = 0
+# 提示词模板中的 {{变量}} 占位符
+TEMPLATE_VAR_PATTERN = re.compile(r"\{\{([^{}]*)\}\}")
+
+# 温度低于该值时模型输出基本确定，单次调用的响应可以直接缓存复用
+CACHEABLE_TEMPERATURE = 0.2
+
+# 参与维度平均分统计的评估维度
+SCORE_DIMENSIONS = ("accuracy", "completeness", "relevance", "clarity")
+
+# 缓存的图表数量上限
+CHART_CACHE_ENTRIES = 64
+
+# 按期望输出估算回答长度时的放大倍数和下限token数
+EXPECTED_OUTPUT_TOKEN_FACTOR = 3
+MIN_RESPONSE_TOKENS = 256
+
+def _flatten_scores(results):
+    """
+    一次遍历测试结果，将评估分数展开为NumPy数组，缺失的分数记为NaN
+
+    Returns:
+        Dict: overall 为每个评估的总体分；dims 为 (评估数, 维度数) 的维度分矩阵；
+        from_response 标记评估是否来自 responses（旧格式的用例级评估为False）；
+        success 为每个响应是否成功
+    """
+    overall = []
+    dims = []
+    from_response = []
+    success = []
     
-    # 遍历所有测试用例
     for case in results.get("test_cases", []):
         responses = case.get("responses", [])
         
         if responses:
-            # 处理每个响应的评估
+            evaluations = []
             for resp in responses:
-                eval_result = resp.get("evaluation")
-                if eval_result and "overall_score" in eval_result:
-                    total_score += eval_result["overall_score"]
-                    count += 1
-        elif case.get("evaluation") and "overall_score" in case["evaluation"]:
+                success.append(not resp.get("error") and bool(resp.get("response")))
+                evaluations.append(resp.get("evaluation"))
+        else:
             # 兼容旧格式
-            total_score += case["evaluation"]["overall_score"]
-            count += 1
+            evaluations = [case.get("evaluation")]
+        
+        for eval_result in evaluations:
+            if not eval_result:
+                continue
+            scores = eval_result.get("scores") or {}
+            overall.append(eval_result.get("overall_score", np.nan))
+            dims.append([scores.get(dim, np.nan) for dim in SCORE_DIMENSIONS])
+            from_response.append(bool(responses))
     
-    return total_score / count if count > 0 else 0
+    return {
+        "overall": np.array(overall, dtype=np.float64),
+        "dims": np.array(dims, dtype=np.float64).reshape(-1, len(SCORE_DIMENSIONS)),
+        "from_response": np.array(from_response, dtype=bool),
+        "success": np.array(success, dtype=bool)
+    }
+
+def _average_score(flat):
+    overall = flat["overall"]
+    overall = overall[~np.isnan(overall)]
+    return float(overall.mean()) if overall.size else 0
+
+def calculate_average_score(results):
+    """计算平均得分"""
+    return _average_score(_flatten_scores(results))
+
+def _dimension_scores(flat):
+    dims = flat["dims"]
+    counts = (~np.isnan(dims)).sum(axis=0)
+    sums = np.nansum(dims, axis=0)
+    means = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+    return {dim: float(mean) for dim, mean in zip(SCORE_DIMENSIONS, means)}
 
 def get_dimension_scores(results):
     """获取各维度的平均分数"""
-    dimensions = {"accuracy": 0, "completeness": 0, "relevance": 0, "clarity": 0}
-    counts = {"accuracy": 0, "completeness": 0, "relevance": 0, "clarity": 0}
-    
-    # 遍历所有测试用例
-    for case in results.get("test_cases", []):
-        responses = case.get("responses", [])
-        
-        if responses:
-            # 处理每个响应的评估
-            for resp in responses:
-                eval_result = resp.get("evaluation")
-                if eval_result and "scores" in eval_result:
-                    for dim, score in eval_result["scores"].items():
-                        if dim in dimensions:
-                            dimensions[dim] += score
-                            counts[dim] += 1
-        elif case.get("evaluation") and "scores" in case["evaluation"]:
-            # 兼容旧格式
-            for dim, score in case["evaluation"]["scores"].items():
-                if dim in dimensions:
-                    dimensions[dim] += score
-                    counts[dim] += 1
-    
-    # 计算平均值
-    for dim in dimensions:
-        if counts[dim] > 0:
-            dimensions[dim] /= counts[dim]
-    
-    return dimensions
+    return _dimension_scores(_flatten_scores(results))
+
+def new_running_stats() -> Dict:
+    """创建运行中增量统计的初始状态：总体分和各维度分分别维护 (计数, 均值, 平方差累计)"""
+    return {key: {"count": 0, "mean": 0.0, "m2": 0.0} for key in ("overall",) + SCORE_DIMENSIONS}
+
+def update_running_stats(stats: Dict, case_result: Dict) -> None:
+    """用一个已完成用例的评估分数更新增量统计（Welford在线算法，数值稳定，无需保留全部分数）"""
+    for resp in case_result.get("responses", []):
+        eval_result = resp.get("evaluation")
+        if not eval_result:
+            continue
+        scores = eval_result.get("scores") or {}
+        values = {"overall": eval_result.get("overall_score")}
+        values.update({dim: scores.get(dim) for dim in SCORE_DIMENSIONS})
+        for key, value in values.items():
+            if value is None:
+                continue
+            acc = stats[key]
+            acc["count"] += 1
+            delta = value - acc["mean"]
+            acc["mean"] += delta / acc["count"]
+            acc["m2"] += delta * (value - acc["mean"])
+
+def summarize_running_stats(stats: Dict) -> Dict:
+    """将增量统计整理为 指标 -> {count, mean, std} 的摘要"""
+    return {
+        key: {
+            "count": acc["count"],
+            "mean": acc["mean"],
+            "std": (acc["m2"] / acc["count"]) ** 0.5 if acc["count"] else 0.0
+        }
+        for key, acc in stats.items()
+    }
 
 def analyze_response_stability(results):
     """分析响应的稳定性"""
+    return _response_stability(_flatten_scores(results))
+
+def compute_all_metrics(results):
+    """
+    一次遍历测试结果，同时计算平均分、维度分和稳定性指标
+
+    需要多项指标时使用，避免各函数分别遍历同一份结果
+
+    Returns:
+        Dict: average_score、dimension_scores、stability
+    """
+    flat = _flatten_scores(results)
+    return {
+        "average_score": _average_score(flat),
+        "dimension_scores": _dimension_scores(flat),
+        "stability": _response_stability(flat)
+    }
+
+def _response_stability(flat):
     stability_metrics = {
         "平均分": 0.0,
         "分数方差": 0.0,
@@ -82,40 +162,23 @@ def analyze_response_stability(results):
         "稳定性指数": 0.0
     }
     
-    total_responses = 0
-    successful_responses = 0
-    all_scores = []
-    
-    # 遍历所有测试用例
-    for case in results.get("test_cases", []):
-        responses = case.get("responses", [])
-        
-        for resp in responses:
-            total_responses += 1
-            
-            # 检查是否成功
-            if not resp.get("error") and resp.get("response"):
-                successful_responses += 1
-            
-            # 获取分数
-            eval_result = resp.get("evaluation")
-            if eval_result and "overall_score" in eval_result:
-                all_scores.append(eval_result["overall_score"])
+    success = flat["success"]
+    # 只统计各响应的评估分数，不含旧格式的用例级评估
+    all_scores = flat["overall"][flat["from_response"]]
+    all_scores = all_scores[~np.isnan(all_scores)]
     
     # 计算指标
-    if successful_responses > 0:
-        stability_metrics["响应成功率"] = (successful_responses / total_responses) * 100 if total_responses > 0 else 0
+    if success.any():
+        stability_metrics["响应成功率"] = float(success.mean()) * 100
     
-    if all_scores:
-        stability_metrics["平均分"] = sum(all_scores) / len(all_scores)
-        stability_metrics["最高分"] = max(all_scores)
-        stability_metrics["最低分"] = min(all_scores)
+    if all_scores.size:
+        stability_metrics["平均分"] = float(all_scores.mean())
+        stability_metrics["最高分"] = float(all_scores.max())
+        stability_metrics["最低分"] = float(all_scores.min())
         
         # 计算方差
-        if len(all_scores) > 1:
-            mean = stability_metrics["平均分"]
-            variance = sum((x - mean) ** 2 for x in all_scores) / len(all_scores)
-            stability_metrics["分数方差"] = variance
+        if all_scores.size > 1:
+            stability_metrics["分数方差"] = float(all_scores.var())
         
         # 计算稳定性指数 (介于0-100之间，越高越稳定)
         score_range = stability_metrics["最高分"] - stability_metrics["最低分"]
@@ -137,17 +200,30 @@ def analyze_response_stability(results):
     return stability_metrics
 
 def create_dimension_radar_chart(dimension_scores_list, labels, title="维度表现对比"):
-    """创建维度雷达图"""
-    fig = go.Figure()
-    
-    # 添加每个数据集的雷达图
-    for i, dimensions in enumerate(dimension_scores_list):
-        fig.add_trace(go.Scatterpolar(
-            r=list(dimensions.values()),
-            theta=list(dimensions.keys()),
+    """创建维度雷达图，相同输入在重新运行页面时直接复用已构建的图表"""
+    return _build_dimension_radar_chart(
+        tuple(tuple(dimensions.items()) for dimensions in dimension_scores_list),
+        tuple(labels),
+        title
+    )
+
+# 图表对象可变，使用 cache_data 缓存：每次返回反序列化的副本，各会话修改图表（如 update_layout）互不影响
+@st.cache_data(max_entries=CHART_CACHE_ENTRIES, show_spinner=False)
+def _build_dimension_radar_chart(dimension_items, labels, title):
+    dimension_scores_list = [dict(items) for items in dimension_items]
+    # 各数据集的维度顺序一致，维度列表只构建一次，所有轨迹共用
+    theta = list(dimension_scores_list[0]) if dimension_scores_list else []
+    
+    # 一次性构建所有数据集的雷达图轨迹，避免逐条 add_trace 时的重复校验和复制
+    fig = go.Figure(data=[
+        go.Scatterpolar(
+            r=[dimensions.get(dim, 0) for dim in theta],
+            theta=theta,
             fill='toself',
-            name=labels[i]
-        ))
+            name=label
+        )
+        for dimensions, label in zip(dimension_scores_list, labels)
+    ])
     
     fig.update_layout(
         polar=dict(
@@ -163,7 +239,11 @@ def create_dimension_radar_chart(dimension_scores_list, labels, title="维度表
     return fig
 
 def create_score_bar_chart(scores, labels, title="平均得分对比"):
-    """创建得分条形图"""
+    """创建得分条形图，相同输入在重新运行页面时直接复用已构建的图表"""
+    return _build_score_bar_chart(tuple(scores), tuple(labels), title)
+
+@st.cache_data(max_entries=CHART_CACHE_ENTRIES, show_spinner=False)
+def _build_score_bar_chart(scores, labels, title):
     fig = px.bar(
         x=labels, 
         y=scores,
@@ -174,9 +254,10 @@ def create_score_bar_chart(scores, labels, title="平均得分对比"):
     )
     
     # 添加最佳版本标记
-    if scores:
-        best_index = scores.index(max(scores)) if max(scores) > 0 else -1
-        if best_index >= 0:
+    if len(scores):
+        # 一次遍历取最高分的位置
+        best_index = max(range(len(scores)), key=scores.__getitem__)
+        if scores[best_index] > 0:
             fig.add_annotation(
                 x=labels[best_index],
                 y=scores[best_index],
@@ -190,46 +271,172 @@ def create_score_bar_chart(scores, labels, title="平均得分对比"):
     return fig
 
 async def call_model_with_messages(client, provider, model, system_prompt, user_input, params):
-    """调用模型API并返回响应"""
+    """
+    调用模型API并返回响应
+
+    低温度（输出基本确定）的请求按 (提供商, 模型, 系统提示词, 用户输入, 参数) 精确缓存，
+    相同请求重复调用时直接返回缓存的响应
+    """
     try:
+        cache_key = None
+        if params.get("temperature", 0.7) < CACHEABLE_TEMPERATURE:
+            cache_key = make_request_cache_key(model, provider, f"{system_prompt}\x00{user_input}", params)
+            cached_text = get_cached_response(cache_key)
+            if cached_text is not None:
+                return {"text": cached_text, "model": model, "usage": {}, "cached": True}
+        
         # 使用新的并行执行器实现
         messages = [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_input}
         ]
-        return await execute_model(model, messages=messages, provider=provider, params=params)
+        response = await execute_model(model, messages=messages, provider=provider, params=params)
+        if cache_key and not response.get("error") and response.get("text"):
+            set_cached_response(cache_key, model, response["text"])
+        return response
     except Exception as e:
         return {"error": str(e), "text": "", "usage": {}}
 
 async def evaluate_response(evaluator, response_text, expected_output, criteria, prompt):
     """评估模型响应"""
     try:
-        evaluation = evaluator.evaluate_response_sync(
+        # 直接等待异步评估，评估请求与其他协程的I/O交错执行，不阻塞事件循环
+        return await evaluator.evaluate_response(
             response_text,
             expected_output,
             criteria,
             prompt
         )
-        return evaluation
     except Exception as e:
         return {"error": str(e)}
 
+def response_token_budget(case: dict, max_tokens: int) -> int:
+    """按期望输出的长度估算单个用例回答所需的max_tokens，不超过用户设置的上限；没有期望输出时直接使用上限"""
+    expected_output = case.get("expected_output", "")
+    if not expected_output:
+        return max_tokens
+    return min(max_tokens, max(MIN_RESPONSE_TOKENS, count_tokens(expected_output) * EXPECTED_OUTPUT_TOKEN_FACTOR))
+
+def static_prompt_prefix(template: dict) -> str:
+    """
+    返回模板中第一个 {{变量}} 之前的固定文本
+
+    这部分在所有用例中完全相同，是提供商前缀缓存能够命中的最长公共前缀；
+    变量越靠后，各用例共享的可缓存前缀越长
+    """
+    prompt_template = template.get("template", "")
+    match = TEMPLATE_VAR_PATTERN.search(prompt_template)
+    return prompt_template[:match.start()] if match else prompt_template
+
+def needs_evaluation(case: dict) -> bool:
+    """用例既无评估标准也无期望输出时，评估结果不会计入评分，无需调用评估模型"""
+    return bool(case.get("evaluation_criteria") or case.get("expected_output"))
+
+def make_prompt_renderer(template: dict, test_set: dict) -> Callable[[dict], str]:
+    """
+    返回按用例渲染提示词的函数
+
+    模板变量默认值和测试集全局变量与用例无关，在这里合并一次，逐用例渲染时只需叠加用例变量
+    """
+    prompt_template = template.get("template", "")
+    # 优先级：用例变量 > 测试集全局变量 > 提示词模板中的默认值
+    base_variables = {name: spec.get("default", "") for name, spec in template.get("variables", {}).items()}
+    base_variables.update(test_set.get("variables", {}))
+
+    def substitute(variables: dict) -> str:
+        # 一次扫描替换模板中的全部变量，未提供值的变量保持原样
+        return TEMPLATE_VAR_PATTERN.sub(lambda m: variables.get(m.group(1), m.group(0)), prompt_template)
+
+    # 没有用例变量的用例渲染结果都相同，预先渲染一次供这些用例直接复用
+    base_prompt = substitute(base_variables)
+
+    def render(case: dict) -> str:
+        case_variables = case.get("variables")
+        if not case_variables:
+            return base_prompt
+        return substitute({**base_variables, **case_variables})
+
+    return render
+
 def render_prompt_template(template: dict, test_set: dict, case: dict) -> str:
     """通用模板渲染函数，合并变量并替换模板中的变量"""
-    prompt_template = template.get("template", "")
-    # 合并全局变量和用例变量
-    variables = {**test_set.get("variables", {}), **case.get("variables", {})}
-    # 如果变量未提供，使用提示词模板中的默认值
-    for var_name in template.get("variables", {}):
-        if var_name not in variables:
-            variables[var_name] = template["variables"][var_name].get("default", "")
-    # 替换模板中的变量
-    for var_name, var_value in variables.items():
-        prompt_template = prompt_template.replace(f"{{{{{var_name}}}}}", var_value)
-    return prompt_template
-
-def run_test(template, model, test_set, model_provider=None, repeat_count=1, temperature=0.7, progress_callback: Optional[Callable] = None):
-    """运行测试，使用并行执行器处理并发请求"""
+    return make_prompt_renderer(template, test_set)(case)
+
+def resolve_model_provider(model: str) -> Optional[str]:
+    """根据模型名称确定提供商，找不到返回None"""
+    # get_provider_from_model 已通过缓存的反向索引查找所有提供商（含自定义提供商）的模型列表
+    try:
+        return get_provider_from_model(model)
+    except ValueError:
+        return None
+
+def pack_cases(template: dict, test_set: dict, cases: List[dict], batch_size: int = 5,
+               rendered_prompts: Optional[Dict[str, str]] = None) -> List[Dict]:
+    """
+    将共享同一渲染提示词的测试用例打包，每个请求包含最多 batch_size 个用例
+
+    系统提示词只渲染/发送一次，多个用例的输入以编号形式追加到用户消息中，
+    要求模型以JSON列表返回对应数量的回答。渲染结果依赖用例变量的用例不会被合并。
+
+    Args:
+        rendered_prompts: 可选的预渲染提示词，case_id -> 渲染结果
+
+    Returns:
+        List[Dict]: 每个元素包含 prompt、user_input（打包后的用户消息）和 case_indices
+    """
+    rendered_prompts = rendered_prompts or {}
+    render = make_prompt_renderer(template, test_set)
+    # 按渲染后的提示词分组，保持用例原始顺序
+    groups = {}
+    for case_idx, case in enumerate(cases):
+        prompt = rendered_prompts.get(case.get("id", "")) or render(case)
+        groups.setdefault(prompt, []).append(case_idx)
+
+    packs = []
+    for prompt, indices in groups.items():
+        for start in range(0, len(indices), batch_size):
+            chunk = indices[start:start + batch_size]
+            if len(chunk) == 1:
+                user_input = cases[chunk[0]].get("user_input", "")
+            else:
+                parts = [f"以下共有{len(chunk)}个相互独立的输入，请分别作答。"]
+                for i, case_idx in enumerate(chunk, 1):
+                    parts.append(f"\n\nCase {i}: {cases[case_idx].get('user_input', '')}")
+                parts.append(
+                    f"\n\nRespond with JSON list of {len(chunk)} answers. "
+                    f"请仅返回一个包含{len(chunk)}个字符串的JSON列表，顺序与输入一致，每个元素为对应输入的完整回答。"
+                )
+                user_input = "".join(parts)
+            packs.append({"prompt": prompt, "user_input": user_input, "case_indices": chunk})
+    return packs
+
+def unpack_batch_response(text: str, count: int) -> Optional[List[str]]:
+    """将打包请求的响应解析为每个用例的回答，解析失败或数量不符时返回None"""
+    start = text.find("[")
+    end = text.rfind("]")
+    if start == -1 or end <= start:
+        return None
+    try:
+        answers = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(answers, list) or len(answers) != count:
+        return None
+    return [a if isinstance(a, str) else json.dumps(a, ensure_ascii=False) for a in answers]
+
+def run_test(template, model, test_set, model_provider=None, repeat_count=1, temperature=0.7, max_tokens: int = 1000, progress_callback: Optional[Callable] = None, batch_size: int = 1, use_cache: bool = True, result_callback: Optional[Callable[[Dict], None]] = None,
+             pre_rendered_prompts: Optional[Dict[str, str]] = None, stop_event: Optional[threading.Event] = None, adaptive_max_tokens: bool = False):
+    """运行测试，使用并行执行器处理并发请求
+
+    batch_size > 1 时，共享同一提示词的用例会通过 pack_cases 合并到单次请求中；
+    use_cache 为True时优先读取持久化响应缓存，只对未命中的用例调用模型；只有温度低于 CACHEABLE_TEMPERATURE
+    （输出基本确定）时才读写缓存，较高温度下每次运行都重新采样，重复稳定性测试才有意义；
+    result_callback 在每个用例评估完成后以用例结果调用，便于调用方增量展示和落盘；传入 progress_callback 时
+    在调用线程中随用例完成逐个调用，否则在全部完成后依次调用；
+    pre_rendered_prompts 为 case_id -> 渲染后提示词，多模型测试同一模板时由调用方渲染一次后复用；
+    stop_event 设置后尚未开始的请求和评估都会跳过，已完成的结果照常返回；
+    adaptive_max_tokens 为True时按期望输出长度收紧每个用例的回答上限（不超过 max_tokens），默认每个用例都使用 max_tokens
+    """
     import asyncio
     from utils.evaluator import PromptEvaluator
 
@@ -239,43 +446,98 @@ def run_test(template, model, test_set, model_provider=None, repeat_count=1, tem
         "model_provider": model_provider,
         "test_params": {
             "repeat_count": repeat_count,
-            "temperature": temperature
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "batch_size": batch_size,
+            "adaptive_max_tokens": adaptive_max_tokens,
+            "use_cache": use_cache and temperature < CACHEABLE_TEMPERATURE
         },
         "test_cases": []
     }
     total_cases = len(test_set.get("cases", []))
 
     # 确定提供商
-    if model_provider:
-        provider = model_provider
+    provider = model_provider or resolve_model_provider(model)
+    if not provider:
+        st.error(f"无法确定模型 '{model}' 的提供商")
+        return None
+
+    # 支持 n 参数的提供商一次请求返回 repeat_count 个采样，提示词token只计费一次
+    use_n_sampling = repeat_count > 1 and supports_n_sampling(provider)
+    requests_per_case = 1 if use_n_sampling else repeat_count
+
+    cases = test_set.get("cases", [])
+    rendered_prompts = pre_rendered_prompts or {}
+    if batch_size > 1:
+        packs = pack_cases(template, test_set, cases, batch_size, rendered_prompts)
     else:
-        try:
-            provider = get_provider_from_model(model)
-        except ValueError:
-            from config import get_available_models
-            found = False
-            available_models = get_available_models()
-            for p, models in available_models.items():
-                if model in models:
-                    provider = p
-                    found = True
-                    break
-            if not found:
-                st.error(f"无法确定模型 '{model}' 的提供商")
-                return None
+        render = make_prompt_renderer(template, test_set)
+        packs = [{
+            "prompt": rendered_prompts.get(case.get("id", "")) or render(case),
+            "user_input": case.get("user_input", ""),
+            "case_indices": [case_idx]
+        } for case_idx, case in enumerate(cases)]
+
+    def case_token_cap(case_idx: int) -> int:
+        return response_token_budget(cases[case_idx], max_tokens) if adaptive_max_tokens else max_tokens
+
+    def cache_key(case_idx: int, prompt: str, attempt_no: int) -> str:
+        return make_cache_key(model, provider, temperature, case_token_cap(case_idx), prompt, cases[case_idx].get("user_input", ""), attempt_no)
+
+    # 读取缓存：一个请求包内所有用例的所有重复都命中时才跳过该请求；全部缓存键一次查询
+    cacheable = temperature < CACHEABLE_TEMPERATURE
+    cached_texts = {}
+    if use_cache and cacheable:
+        pack_keys = [{
+            (case_idx, attempt_no): cache_key(case_idx, pack["prompt"], attempt_no)
+            for case_idx in pack["case_indices"]
+            for attempt_no in range(1, repeat_count + 1)
+        } for pack in packs]
+        cached = get_cached_responses(key for keys in pack_keys for key in keys.values())
+        remaining_packs = []
+        for pack, keys in zip(packs, pack_keys):
+            hits = {slot: cached.get(key) for slot, key in keys.items()}
+            if all(text is not None for text in hits.values()):
+                cached_texts.update({key: (pack["prompt"], text) for key, text in hits.items()})
+            else:
+                remaining_packs.append(pack)
+        packs = remaining_packs
+
+    # 所有(用例, 重复)组合的请求一次性并发提交，由执行器按提供商/模型限制并发；
+    # 各请求覆盖的(用例, 重复)次数不同，按已完成请求的比例推进界面进度，不必等全部请求返回
+    pending_attempts = sum(len(pack["case_indices"]) for pack in packs) * repeat_count
+    reported_attempts = 0
+
+    def on_request_done(current, total):
+        nonlocal reported_attempts
+        target = min(pending_attempts * current // total, pending_attempts)
+        while reported_attempts < target:
+            reported_attempts += 1
+            progress_callback()
+
+    # 共享同一固定前缀的请求使用相同的 prompt_cache_key，OpenAI 将其路由到同一前缀缓存，执行器也会把它们排在一起调度
+    prompt_cache_key = make_request_cache_key(model, provider, static_prompt_prefix(template), {})
 
     async def run_all_tests():
         all_requests = []
         
-        # 准备所有请求，整理成适合批处理的格式
-        for case_idx, case in enumerate(test_set.get("cases", [])):
-            case_id = case.get("id", "")
-            prompt_template = render_prompt_template(template, test_set, case)
-            user_input = case.get("user_input", "")
-            
+        # 渲染后提示词和用户输入完全相同的请求包只调用一次，响应分发给所有相同的请求包
+        unique_packs = {}
+        for pack in packs:
+            unique_packs.setdefault((pack["prompt"], pack["user_input"]), []).append(pack["case_indices"])
+        
+        # 准备所有请求，整理成适合批处理的格式（每个请求对应一个或多个用例）
+        for (prompt_template, user_input), case_index_groups in unique_packs.items():
+            # 同一请求的响应分发给所有相同的请求包，回答上限按其中需要最多token的一组计算；
+            # 打包请求的全部回答共享用户设置的最大输出Token，不按用例数放大，避免超出模型的输出上限
+            request_max_tokens = min(max_tokens, max(sum(case_token_cap(i) for i in case_indices) for case_indices in case_index_groups))
             # 为每次尝试创建请求
-            for attempt in range(repeat_count):
-                params = {"temperature": temperature, "max_tokens": 1000}
+            for attempt in range(requests_per_case):
+                params = {"temperature": temperature, "max_tokens": request_max_tokens}
+                if use_n_sampling:
+                    params["n"] = repeat_count
+                if provider == "openai":
+                    params["prompt_cache_key"] = prompt_cache_key
                 
                 # 根据不同提供商准备不同格式的请求
                 request = {
@@ -283,12 +545,8 @@ def run_test(template, model, test_set, model_provider=None, repeat_count=1, tem
                     "provider": provider,
                     "params": params,
                     "context": {
-                        "case_id": case_id,
-                        "case_idx": case_idx,
+                        "case_index_groups": case_index_groups,
                         "attempt": attempt,
-                        "user_input": user_input,
-                        "expected_output": case.get("expected_output", ""),
-                        "evaluation_criteria": case.get("evaluation_criteria", {}),
                         "prompt": prompt_template
                     }
                 }
@@ -301,98 +559,204 @@ def run_test(template, model, test_set, model_provider=None, repeat_count=1, tem
                 
                 all_requests.append(request)
         
-        # 使用并行执行器批量处理请求
-        model_responses = await execute_models(all_requests, progress_callback=lambda current, total: None)
-        
         # 整理测试用例结果
         case_results = {}
-        for response in model_responses:
-            context = response.get("context", {})
-            case_id = context.get("case_id", "")
-            case_idx = context.get("case_idx", -1)
-            attempt = context.get("attempt", 0)
+        # 成功的响应在到达后立即送入评估队列，评估与尚未完成的模型调用重叠执行
+        eval_queue = asyncio.Queue()
+        evaluator = PromptEvaluator()
+        # 在调用线程中运行时，用例的全部响应评估完毕即回调，调用方可以实时展示
+        emit_live = result_callback is not None and progress_callback is not None
+        emitted_case_ids = set()
+        
+        def emit_if_complete(case_id):
+            case_result = case_results[case_id]
+            responses = case_result["responses"]
+            if (not emit_live or case_id in emitted_case_ids or len(responses) < repeat_count
+                    or any(resp.get("_eval_input") for resp in responses)):
+                return
+            emitted_case_ids.add(case_id)
+            responses.sort(key=lambda r: r["attempt"])
+            result_callback(case_result)
+        
+        def add_response(case_idx, prompt, response_data):
+            case = cases[case_idx]
+            case_id = case.get("id", "")
             
             # 如果这是新的测试用例，创建结果字典
             if case_id not in case_results:
                 case_results[case_id] = {
                     "case_id": case_id,
-                    "case_description": test_set.get("cases", [])[case_idx].get("description", "") if case_idx >= 0 else "",
-                    "prompt": context.get("prompt", ""),
-                    "user_input": context.get("user_input", ""),
-                    "expected_output": context.get("expected_output", ""),
+                    "case_description": case.get("description", ""),
+                    "prompt": prompt,
+                    "user_input": case.get("user_input", ""),
+                    "expected_output": case.get("expected_output", ""),
                     "responses": []
                 }
             
-            # 处理响应结果
-            if "error" not in response and response.get("text"):
-                response_data = {
-                    "attempt": attempt + 1,
-                    "response": response.get("text", ""),
-                    "error": None,
-                    "usage": response.get("usage", {}),
-                    "evaluation": None,
-                    "_eval_input": {
-                        "response_text": response.get("text", ""),
-                        "expected_output": context.get("expected_output", ""),
-                        "criteria": context.get("evaluation_criteria", {}),
-                        "prompt": context.get("prompt", "")
-                    }
-                }
-            else:
-                response_data = {
-                    "attempt": attempt + 1,
-                    "response": response.get("text", ""),
-                    "error": response.get("error", "模型未返回内容"),
-                    "usage": response.get("usage", {}),
-                    "evaluation": None,
-                    "_eval_input": None
+            if not response_data["error"] and needs_evaluation(case):
+                response_data["_eval_input"] = {
+                    "response_text": response_data["response"],
+                    "expected_output": case.get("expected_output", ""),
+                    "criteria": case.get("evaluation_criteria", {}),
+                    "prompt": prompt,
+                    "case_id": case_id
                 }
+                eval_queue.put_nowait(response_data)
             
-            # 添加响应并触发 UI 回调（不同于并行执行器的内部进度回调）
             case_results[case_id]["responses"].append(response_data)
+            emit_if_complete(case_id)
+        
+        async def evaluate_queued():
+            """持续取出已到达的响应批量评估，直到收到结束标记"""
+            finished = False
+            while not finished:
+                batch = [await eval_queue.get()]
+                while not eval_queue.empty():
+                    batch.append(eval_queue.get_nowait())
+                if batch[-1] is None:
+                    finished = True
+                    batch.pop()
+                if not batch:
+                    continue
+                if stop_event is not None and stop_event.is_set():
+                    # 已取消：不再评估，保留模型响应
+                    eval_results = [None] * len(batch)
+                else:
+                    eval_results = await evaluator.run_evaluation_async([{
+                        "model_response": resp["_eval_input"]["response_text"], # 传递实际的模型响应
+                        "expected_output": resp["_eval_input"]["expected_output"],
+                        "criteria": resp["_eval_input"]["criteria"],
+                        "prompt": resp["_eval_input"]["prompt"] # 传递对应的提示词
+                    } for resp in batch])
+                # 更新评估结果
+                completed_case_ids = set()
+                for resp, eval_result in zip(batch, eval_results):
+                    resp["evaluation"] = eval_result
+                    completed_case_ids.add(resp["_eval_input"]["case_id"])
+                    del resp["_eval_input"] # 清理临时数据
+                for case_id in completed_case_ids:
+                    emit_if_complete(case_id)
+        
+        eval_task = asyncio.create_task(evaluate_queued())
+        
+        # 缓存命中的响应
+        for (case_idx, attempt_no), (prompt, text) in cached_texts.items():
             if progress_callback:
                 progress_callback()
+            add_response(case_idx, prompt, {
+                "attempt": attempt_no,
+                "response": text,
+                "error": None,
+                "usage": {},
+                "cached": True,
+                "evaluation": None,
+                "_eval_input": None
+            })
+        
+        def handle_response(response):
+            """整理单个模型响应，拆分到对应用例并送入评估队列"""
+            context = response.get("context", {})
+            # 相同请求包的各组用例共用这一个响应，各组用例数相同
+            case_index_groups = context.get("case_index_groups", [])
+            pack_size = len(case_index_groups[0]) if case_index_groups else 0
+            attempt = context.get("attempt", 0)
+            prompt = context.get("prompt", "")
+            
+            # 使用 n 参数时一个响应包含多个采样，展开为多次尝试
+            if use_n_sampling:
+                texts = response.get("texts") or [response.get("text", "")]
+                texts = (texts + [""] * repeat_count)[:repeat_count]
+            else:
+                texts = [response.get("text", "")]
+            
+            for sample_idx, text in enumerate(texts):
+                # 打包请求的响应需拆分为每个用例的回答
+                if pack_size > 1:
+                    answers = unpack_batch_response(text, pack_size) if text else None
+                    pack_error = None if answers else "批处理响应解析失败"
+                    answers = answers or [""] * pack_size
+                else:
+                    answers = [text]
+                    pack_error = None
+                
+                attempt_no = attempt + sample_idx + 1
+                for group_idx, case_indices in enumerate(case_index_groups):
+                    for pos, (case_idx, answer) in enumerate(zip(case_indices, answers)):
+                        # 批量采样/打包/去重请求的用量只记录在第一个结果上，避免重复统计
+                        usage = response.get("usage", {}) if sample_idx == 0 and group_idx == 0 and pos == 0 else {}
+                        
+                        # 处理响应结果
+                        if "error" not in response and not pack_error and answer:
+                            error = None
+                            if cacheable:
+                                set_cached_response(cache_key(case_idx, prompt, attempt_no), model, answer)
+                        else:
+                            error = response.get("error") or pack_error or "模型未返回内容"
+                        
+                        add_response(case_idx, prompt, {
+                            "attempt": attempt_no,
+                            "response": answer or text,
+                            "error": error,
+                            "usage": usage,
+                            "evaluation": None,
+                            "_eval_input": None
+                        })
+        
+        # 使用并行执行器批量处理请求，每个请求完成即整理其响应
+        model_task = asyncio.create_task(execute_models(
+            all_requests,
+            progress_callback=on_request_done if progress_callback else None,
+            result_callback=handle_response,
+            stop_event=stop_event
+        )) if all_requests else None
+        try:
+            if model_task:
+                # 评估任务只会在出错时先于模型调用结束，此时立即抛出，不再等待剩余的模型调用
+                done, _ = await asyncio.wait({model_task, eval_task}, return_when=asyncio.FIRST_EXCEPTION)
+                if eval_task in done:
+                    eval_task.result()
+                model_task.result()
+            # 所有响应已入队，等待剩余评估完成
+            eval_queue.put_nowait(None)
+            await eval_task
+        except BaseException:
+            # 运行被打断（回调中抛出异常、脚本停止或重新运行）：取消尚未完成的模型调用和评估，而不是继续等待它们
+            tasks = [task for task in (model_task, eval_task) if task and not task.done()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
         
-        # 返回结果列表，按原始用例索引排序
+        # 返回结果列表，按原始用例索引排序；响应按到达顺序收集，这里恢复按尝试序号排列
         sorted_results = []
         for case_idx, case in enumerate(test_set.get("cases", [])):
             case_id = case.get("id", "")
             if case_id in case_results:
+                case_results[case_id]["responses"].sort(key=lambda r: r["attempt"])
                 sorted_results.append(case_results[case_id])
         
-        return sorted_results
+        return sorted_results, emitted_case_ids
             
-    # 创建新的事件循环执行测试
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    all_case_results = loop.run_until_complete(run_all_tests())
-    
-    # 处理评估：收集需要评估的响应
-    eval_inputs = []
-    eval_response_refs = []
-    for case in all_case_results:
-        for resp in case["responses"]:
-            if resp.get("_eval_input"):
-                eval_inputs.append(resp["_eval_input"])
-                eval_response_refs.append(resp)
-    
-    # 并行执行评估
-    if eval_inputs:
-        evaluator = PromptEvaluator()
-        # 传递包含所有评估所需信息的任务列表
-        eval_results = evaluator.run_evaluation(
-            evaluation_tasks=[{
-                "model_response": item["response_text"], # 传递实际的模型响应
-                "expected_output": item["expected_output"],
-                "criteria": item["criteria"],
-                "prompt": item["prompt"] # 传递对应的提示词
-            } for item in eval_inputs]
-        )
-        # 更新评估结果
-        for resp, eval_result in zip(eval_response_refs, eval_results):
-            resp["evaluation"] = eval_result
-            del resp["_eval_input"] # 清理临时数据
+    if progress_callback is not None:
+        # 进度回调会操作Streamlit组件，需要在调用线程中使用独立的事件循环执行
+        loop = asyncio.new_event_loop()
+        try:
+            all_case_results, emitted_case_ids = loop.run_until_complete(run_all_tests())
+        finally:
+            close_private_loop(loop)
+    else:
+        # 在共享的后台事件循环上执行
+        all_case_results, emitted_case_ids = run_coro_sync(run_all_tests())
+    
+    # 未能在运行中回调的用例在这里补充回调
+    if result_callback:
+        for case_result in all_case_results:
+            if case_result["case_id"] not in emitted_case_ids:
+                result_callback(case_result)
     
+    # 本次运行新写入的缓存立即落盘
+    if cacheable:
+        flush_llm_cache()
     results["test_cases"] = all_case_results
     return results
 
@@ -400,22 +764,9 @@ def regenerate_expected_output(case: dict, template: dict, model: str, provider:
     """使用AI重新生成期望输出，使用并行执行器"""
     try:
         # 如果未指定提供商，从模型名称推断
+        provider = provider or resolve_model_provider(model)
         if not provider:
-            try:
-                provider = get_provider_from_model(model)
-            except ValueError:
-                # 尝试在所有提供商中查找模型
-                from config import get_available_models
-                found = False
-                available_models = get_available_models()
-                for p, models in available_models.items():
-                    if model in models:
-                        provider = p
-                        found = True
-                        break
-                
-                if not found:
-                    return {"error": f"无法确定模型 '{model}' 的提供商"}
+            return {"error": f"无法确定模型 '{model}' 的提供商"}
         
         # 获取测试用例输入
         user_input = case.get("user_input", "")
@@ -449,8 +800,33 @@ def regenerate_expected_output(case: dict, template: dict, model: str, provider:
     except Exception as e:
         return {"error": f"生成期望输出时发生错误: {str(e)}"}
 
-def generate_evaluation_criteria(case_description, user_input, expected_output):
-    """使用AI生成测试用例的评估标准，使用并行执行器"""
+def _parse_criteria_result(result: Dict) -> Dict:
+    """将评估标准生成请求的响应整理为 {"criteria": ...}，失败时附带 error 并回退到默认标准"""
+    if "error" in result:
+        return {"error": result["error"], "criteria": dict(DEFAULT_EVALUATION_CRITERIA)}
+    
+    # 提取并解析JSON：复用通用解析函数（orjson优先，失败时修复常见格式错误后再解析）
+    response_text = result.get("text", "")
+    criteria, error = parse_json_response(response_text)
+    if error or not isinstance(criteria, dict):
+        return {
+            "error": "无法解析生成的评估标准",
+            "raw_response": response_text,
+            "criteria": dict(DEFAULT_EVALUATION_CRITERIA)
+        }
+    return {"criteria": criteria}
+
+def generate_evaluation_criteria_batch(cases: List[Dict], progress_callback: Optional[Callable[[int, int], None]] = None) -> List[Dict]:
+    """
+    为多个测试用例并发生成评估标准
+
+    Args:
+        cases: 用例列表，每个用例需包含 description、user_input、expected_output
+        progress_callback: 进度回调函数，参数为(已完成数, 总数)
+
+    Returns:
+        List[Dict]: 与 cases 顺序对应的结果，每个结果包含 criteria，失败时附带 error
+    """
     try:
         # 获取配置的评估模型
         config = load_config()
@@ -459,76 +835,41 @@ def generate_evaluation_criteria(case_description, user_input, expected_output):
         
         # 获取系统模板
         from config import get_system_template
-        criteria_generator_template = get_system_template("criteria_generator")
+        criteria_template = get_system_template("criteria_generator").get("template", "")
         
-        # 使用模板替换变量
-        criteria_generation_prompt = criteria_generator_template.get("template", "")\
-            .replace("{{case_description}}", case_description)\
-            .replace("{{user_input}}", user_input)\
-            .replace("{{expected_output}}", expected_output)
-
         # 设置参数
         params = {
             "temperature": 0.2,
             "max_tokens": 1000
         }
         
-        # 使用并行执行器的同步方法
-        result = execute_model_sync(
-            evaluator_model, 
-            prompt=criteria_generation_prompt,
-            provider=provider, 
-            params=params
-        )
-        
-        if "error" in result:
-            return {
-                "error": result["error"],
-                "criteria": {
-                    "accuracy": "评估响应与期望输出的匹配程度",
-                    "completeness": "评估响应是否包含所有必要信息",
-                    "relevance": "评估响应与提示词的相关性",
-                    "clarity": "评估响应的清晰度和可理解性"
-                }
-            }
-        
-        # 处理响应文本，提取JSON
-        response_text = result.get("text", "")
-        
-        # 清理可能的前后缀文本
-        if "```json" in response_text:
-            response_text = response_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in response_text:
-            response_text = response_text.split("```")[1].split("```")[0].strip()
+        # 每个用例一个请求，由并行执行器统一并发执行
+        requests = [{
+            "model": evaluator_model,
+            "provider": provider,
+            "prompt": criteria_template
+                .replace("{{case_description}}", case.get("description", ""))
+                .replace("{{user_input}}", case.get("user_input", ""))
+                .replace("{{expected_output}}", case.get("expected_output", "")),
+            "params": params
+        } for case in cases]
         
-        # 解析JSON
-        try:
-            criteria = json.loads(response_text)
-            return {
-                "criteria": criteria
-            }
-        except json.JSONDecodeError:
-            return {
-                "error": "无法解析生成的评估标准",
-                "raw_response": response_text,
-                "criteria": {
-                    "accuracy": "评估响应与期望输出的匹配程度",
-                    "completeness": "评估响应是否包含所有必要信息",
-                    "relevance": "评估响应与提示词的相关性",
-                    "clarity": "评估响应的清晰度和可理解性"
-                }
-            }
+        responses = execute_models_sync(requests, progress_callback=progress_callback) if requests else []
+        return [_parse_criteria_result(response) for response in responses]
     
     except Exception as e:
-        return {
+        return [{
             "error": f"生成评估标准时出错: {str(e)}",
-            "criteria": {
-                "accuracy": "评估响应与期望输出的匹配程度",
-                "completeness": "评估响应是否包含所有必要信息",
-                "relevance": "评估响应与提示词的相关性",
-                "clarity": "评估响应的清晰度和可理解性"
-            }
-        }
+            "criteria": dict(DEFAULT_EVALUATION_CRITERIA)
+        } for _ in cases]
+
+def generate_evaluation_criteria(case_description, user_input, expected_output):
+    """使用AI生成测试用例的评估标准，使用并行执行器"""
+    return generate_evaluation_criteria_batch([{
+        "description": case_description,
+        "user_input": user_input,
+        "expected_output": expected_output
+    }])[0]
 
 def save_optimized_template(template: dict, opt_prompt: dict, index: int = 0) -> str:
     """保存优化后的提示词为新模板，返回新模板名称"""
@@ -39,6 +39,9 @@ DEFAULT_EVALUATION_PARAMS = {
     "max_tokens": 1500
 }
 
+# 合并评估时单次请求最多包含的评估任务数
+DEFAULT_EVALUATION_BATCH_SIZE = 5
+
 # JSON处理常量
 JSON_CODE_BLOCK_PATTERNS = [
     ("```json", "```"),
@@ -1,17 +1,20 @@
-import json
+import re
+import copy
 import asyncio
+import orjson
 from typing import Dict, List, Optional, Any
 from models.api_clients import get_client, get_provider_from_model
 from config import load_config, get_api_key, get_system_template
 from models.token_counter import count_tokens
 # Import the new parallel executor
-from utils.parallel_executor import execute_model, execute_models, execute_model_sync, execute_models_sync
+from utils.parallel_executor import execute_model, execute_models, execute_model_sync, execute_models_sync, run_coro_sync
 # Import new constants and helpers
 from utils.constants import (
     DEFAULT_EVALUATION_CRITERIA, 
     DEFAULT_NO_SAMPLE_EVALUATION_CRITERIA,
     DEFAULT_WITH_SAMPLE_EVALUATION_CRITERIA,
-    DEFAULT_EVALUATION_PARAMS
+    DEFAULT_EVALUATION_PARAMS,
+    DEFAULT_EVALUATION_BATCH_SIZE
 )
 from utils.helpers import (
     parse_json_response, 
@@ -19,6 +22,9 @@ from utils.helpers import (
     calculate_prompt_efficiency
 )
 
+# 匹配测试目的中的"请生成N个"数量描述
+GENERATE_COUNT_RE = re.compile(r"请生成\d+个")
+
 class PromptEvaluator:
     """提示词评估引擎"""
     def __init__(self, evaluator_model=None):
@@ -56,7 +62,7 @@ class PromptEvaluator:
             .replace("{{prompt}}", prompt)\
             .replace("{{model_response}}", model_response)\
             .replace("{{expected_output}}", expected_output)\
-            .replace("{{evaluation_criteria}}", json.dumps(criteria, ensure_ascii=False, indent=2))
+            .replace("{{evaluation_criteria}}", orjson.dumps(criteria, option=orjson.OPT_INDENT_2).decode())
         
         try:
             # 使用并行执行器进行模型调用
@@ -180,7 +186,7 @@ class PromptEvaluator:
             .replace("{{prompt}}", prompt)\
             .replace("{{model_response}}", model_response)\
             .replace("{{expected_output}}", expected_output)\
-            .replace("{{evaluation_criteria}}", json.dumps(criteria, ensure_ascii=False, indent=2))
+            .replace("{{evaluation_criteria}}", orjson.dumps(criteria, option=orjson.OPT_INDENT_2).decode())
         
         try:
             # 使用并行执行器的同步版本
@@ -312,10 +318,9 @@ class PromptEvaluator:
                 if left <= 0:
                     return []
                 # 每个请求生成一个测试用例
-                import re
                 purpose = test_purpose
                 # 用正确的正则替换"请生成N个"部分
-                purpose, n_sub = re.subn(r"请生成\d+个", f"请生成{batch_count}个", purpose)
+                purpose, n_sub = GENERATE_COUNT_RE.subn(f"请生成{batch_count}个", purpose)
                 if n_sub == 0:
                     # 如果原本没有数量描述，直接加
                     purpose = f"{purpose}，请生成{batch_count}个高质量测试用例，覆盖不同场景和边界。"
@@ -442,28 +447,22 @@ class PromptEvaluator:
         # 使用asyncio运行异步函数
         import asyncio
         try:
-            # 尝试获取当前事件循环
-            try:
-                loop = asyncio.get_event_loop()
-                if loop.is_closed():
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-            except RuntimeError:
-                # 如果没有事件循环，创建一个新的
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-            
-            # 运行异步函数
-            result = loop.run_until_complete(
-                self.generate_test_cases_async(
-                    model, 
-                    test_purpose, 
-                    example_case, 
-                    target_count, 
-                    progress_callback
-                )
+            coro = self.generate_test_cases_async(
+                model, 
+                test_purpose, 
+                example_case, 
+                target_count, 
+                progress_callback
             )
-            return result
+            if progress_callback is not None:
+                # 进度回调可能操作Streamlit组件，需要在调用线程中使用独立的事件循环执行
+                loop = asyncio.new_event_loop()
+                try:
+                    return loop.run_until_complete(coro)
+                finally:
+                    loop.close()
+            # 在共享的后台事件循环上执行
+            return run_coro_sync(coro)
         except Exception as e:
             import traceback
             traceback.print_exc()
@@ -564,28 +563,22 @@ class PromptEvaluator:
         # 使用asyncio运行异步函数
         import asyncio
         try:
-            # 尝试获取当前事件循环
-            try:
-                loop = asyncio.get_event_loop()
-                if loop.is_closed():
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-            except RuntimeError:
-                # 如果没有事件循环，创建一个新的
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-            
-            # 运行异步函数
-            result = loop.run_until_complete(
-                self.generate_test_cases_batch_async(
-                    model, 
-                    test_purposes, 
-                    example_case, 
-                    target_count_per_purpose, 
-                    progress_callback
-                )
+            coro = self.generate_test_cases_batch_async(
+                model, 
+                test_purposes, 
+                example_case, 
+                target_count_per_purpose, 
+                progress_callback
             )
-            return result
+            if progress_callback is not None:
+                # 进度回调可能操作Streamlit组件，需要在调用线程中使用独立的事件循环执行
+                loop = asyncio.new_event_loop()
+                try:
+                    return loop.run_until_complete(coro)
+                finally:
+                    loop.close()
+            # 在共享的后台事件循环上执行
+            return run_coro_sync(coro)
         except Exception as e:
             import traceback
             traceback.print_exc()
@@ -604,6 +597,31 @@ class PromptEvaluator:
                 for task in evaluation_tasks
             ]
         
+        # 多次重复常得到只有空白差异的相同响应：按规范化后的评估内容去重，每组只调用一次评估模型
+        unique_tasks = []
+        task_slots = []
+        slot_by_key = {}
+        for task in evaluation_tasks:
+            key = (
+                " ".join(task.get("model_response", "").split()),
+                task.get("expected_output", ""),
+                orjson.dumps(task.get("criteria", {}), option=orjson.OPT_SORT_KEYS),
+                task.get("prompt", "")
+            )
+            if key not in slot_by_key:
+                slot_by_key[key] = len(unique_tasks)
+                unique_tasks.append(task)
+            task_slots.append(slot_by_key[key])
+        if len(unique_tasks) < len(evaluation_tasks):
+            unique_results = await self.run_evaluation_async(unique_tasks)
+            seen_slots = set()
+            results = []
+            for slot in task_slots:
+                # 重复的任务使用评估结果的副本，避免多个响应共享同一个字典
+                results.append(copy.deepcopy(unique_results[slot]) if slot in seen_slots else unique_results[slot])
+                seen_slots.add(slot)
+            return results
+        
         # 准备并行请求
         requests = []
         for task in evaluation_tasks:
@@ -618,7 +636,7 @@ class PromptEvaluator:
                 .replace("{{prompt}}", prompt)\
                 .replace("{{model_response}}", model_response)\
                 .replace("{{expected_output}}", expected_output)\
-                .replace("{{evaluation_criteria}}", json.dumps(criteria, ensure_ascii=False, indent=2))
+                .replace("{{evaluation_criteria}}", orjson.dumps(criteria, option=orjson.OPT_INDENT_2).decode())
             
             # 添加请求到批处理队列
             requests.append({
@@ -723,20 +741,102 @@ class PromptEvaluator:
             
             return results
 
+    def _build_evaluation_prompt(self, task: Dict) -> str:
+        """使用评估模板构建单个任务的评估提示词"""
+        template = self.evaluator_template.get("template", "")
+        return template\
+            .replace("{{prompt}}", task.get("prompt", ""))\
+            .replace("{{model_response}}", task.get("model_response", ""))\
+            .replace("{{expected_output}}", task.get("expected_output", ""))\
+            .replace("{{evaluation_criteria}}", orjson.dumps(task.get("criteria", {}), option=orjson.OPT_INDENT_2).decode())
+    
+    @staticmethod
+    def _unpack_batch_evaluation(text: str, count: int) -> Optional[List[Dict]]:
+        """将合并评估的响应解析为每个任务的评估结果，解析失败或数量不符时返回None"""
+        start = text.find("[")
+        end = text.rfind("]")
+        if start == -1 or end <= start:
+            return None
+        try:
+            items = orjson.loads(text[start:end + 1])
+        except orjson.JSONDecodeError:
+            return None
+        if not isinstance(items, list) or len(items) != count or not all(isinstance(item, dict) for item in items):
+            return None
+        return items
+    
+    async def run_evaluation_batched_async(self, evaluation_tasks: List[Dict],
+                                           batch_size: int = DEFAULT_EVALUATION_BATCH_SIZE) -> List[Dict]:
+        """
+        合并评估：每个请求包含最多 batch_size 个评估任务，要求评估模型以JSON列表返回各任务的结果
+        
+        N 个任务只需 ⌈N/batch_size⌉ 次评估调用；合并响应无法解析的任务回退到 run_evaluation_async 逐个评估
+        """
+        if self.use_local_evaluation or batch_size <= 1 or len(evaluation_tasks) <= 1:
+            return await self.run_evaluation_async(evaluation_tasks)
+        
+        chunks = [evaluation_tasks[i:i + batch_size] for i in range(0, len(evaluation_tasks), batch_size)]
+        requests = []
+        for chunk in chunks:
+            parts = [f"以下共有{len(chunk)}个相互独立的评估任务，请逐一完成。"]
+            for i, task in enumerate(chunk, 1):
+                parts.append(f"\n\n### 评估任务 {i}\n{self._build_evaluation_prompt(task)}")
+            parts.append(
+                f"\n\n请仅返回一个包含{len(chunk)}个JSON对象的JSON列表，顺序与评估任务一致，"
+                f"每个元素为对应任务要求的完整评估结果。"
+            )
+            params = dict(DEFAULT_EVALUATION_PARAMS)
+            params["max_tokens"] = DEFAULT_EVALUATION_PARAMS["max_tokens"] * len(chunk)
+            requests.append({
+                "model": self.evaluator_model,
+                "provider": self.provider,
+                "prompt": "".join(parts),
+                "params": params
+            })
+        
+        try:
+            responses = await execute_models(requests)
+        except Exception as e:
+            print(f"合并评估失败: {str(e)}，回退到逐个评估")
+            return await self.run_evaluation_async(evaluation_tasks)
+        
+        results = [None] * len(evaluation_tasks)
+        fallback_indices = []
+        offset = 0
+        for chunk, response in zip(chunks, responses):
+            items = None
+            if "text" in response and not response.get("error"):
+                items = self._unpack_batch_evaluation(response.get("text", ""), len(chunk))
+            if items is None:
+                fallback_indices.extend(range(offset, offset + len(chunk)))
+            else:
+                for i, (task, eval_data) in enumerate(zip(chunk, items)):
+                    # 合并请求的usage包含多个任务，按单个任务的提示词计算token数
+                    prompt_tokens = count_tokens(task.get("prompt", ""))
+                    eval_data["prompt_info"] = {
+                        "token_count": prompt_tokens,
+                    }
+                    if "scores" in eval_data and "prompt_efficiency" not in eval_data["scores"]:
+                        eval_data["scores"]["prompt_efficiency"] = calculate_prompt_efficiency(prompt_tokens)
+                        if "overall_score" in eval_data:
+                            scores = eval_data["scores"]
+                            eval_data["overall_score"] = int(sum(scores.values()) / len(scores))
+                    results[offset + i] = eval_data
+            offset += len(chunk)
+        
+        if fallback_indices:
+            fallback_results = await self.run_evaluation_async([evaluation_tasks[i] for i in fallback_indices])
+            for i, result in zip(fallback_indices, fallback_results):
+                results[i] = result
+        
+        return results
+    
     def run_evaluation(self, evaluation_tasks: List[Dict]) -> List[Dict]:
         """同步批量评估，自动调度事件循环，支持并发"""
         import asyncio
         try:
-            # 创建一个新的事件循环，不尝试重用现有循环
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            
-            try:
-                result = loop.run_until_complete(self.run_evaluation_async(evaluation_tasks))
-                return result
-            finally:
-                # 不关闭事件循环，后续操作可能还需要使用
-                pass
+            # 在共享的后台事件循环上执行
+            return run_coro_sync(self.run_evaluation_async(evaluation_tasks))
         except Exception as e:
             import traceback
             print(f"批量评估遇到错误: {str(e)}")
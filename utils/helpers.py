@@ -6,8 +6,13 @@ import json
 import re
 from typing import Dict, Any, Optional, List, Tuple, Callable
 
+import orjson
+
 from .constants import JSON_CODE_BLOCK_PATTERNS, DEFAULT_EVALUATION_CRITERIA
 
+# 匹配对象或数组末尾多余的逗号（如 {"key": "value",} ）
+TRAILING_COMMA_RE = re.compile(r',\s*([}\]])')
+
 EFFICIENCY_CONFIG = {
     "ideal_token_count": 500,  # 期望的token数，对应高分
     "barely_pass_token_count": 1500  # 勉强及格的token数，对应低分
@@ -56,8 +61,7 @@ def fix_json_errors(json_text: str) -> str:
         json_text += '"'
     
     # 2. 移除尾部的逗号（如 {"key": "value",} ）
-    json_text = re.sub(r',\s*}', '}', json_text)
-    json_text = re.sub(r',\s*]', ']', json_text)
+    json_text = TRAILING_COMMA_RE.sub(r'\1', json_text)
     
     # 3. 修复缺少的大括号或中括号
     open_braces = json_text.count('{')
@@ -90,11 +94,20 @@ def parse_json_response(text: str) -> Tuple[Dict[str, Any], Optional[str]]:
         # 提取JSON文本
         json_text = extract_json_from_text(text)
         
+        # 格式正确的JSON直接解析，无需修复
+        try:
+            return orjson.loads(json_text), None
+        except orjson.JSONDecodeError:
+            pass
+        
         # 修复常见的JSON错误
         json_text = fix_json_errors(json_text)
         
-        # 尝试解析JSON
-        result = json.loads(json_text)
+        # 尝试解析JSON，最后允许字符串中出现未转义的控制字符（如换行），减少因此触发的重试
+        try:
+            return orjson.loads(json_text), None
+        except orjson.JSONDecodeError:
+            result = json.loads(json_text, strict=False)
         return result, None
         
     except json.JSONDecodeError as e:
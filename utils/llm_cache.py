@@ -0,0 +1,145 @@
+"""
+模型响应持久化缓存模块
+
+以 (模型, 提供商, 温度, 最大token数, 系统提示词, 用户输入, 重复序号) 或 (模型, 提供商, 提示词, 调用参数)
+为键缓存模型响应，相同配置重复运行时直接返回缓存结果，不再调用API。
+使用标准库 sqlite3 存储在数据目录下，无需额外依赖；进程内共用一个连接，写入批量提交，条目数超出上限时淘汰最旧的缓存。
+"""
+
+import atexit
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+import orjson
+
+from config import DATA_DIR
+
+# 缓存数据库路径
+LLM_CACHE_DB = DATA_DIR / "llm_cache.sqlite"
+
+# 最多保留的缓存条目数，超出时按写入时间淘汰最旧的条目
+LLM_CACHE_MAX_ENTRIES = 50000
+# 写入先进入内存缓冲，累计到一定条数或距上次落盘超过一定时间（秒）后在一个事务中批量写入
+WRITE_BATCH_SIZE = 64
+WRITE_FLUSH_INTERVAL = 2.0
+
+_lock = threading.Lock()
+# 进程内共用一个连接（由 _lock 串行化访问），避免每次读写都重新打开数据库
+_conn: Optional[sqlite3.Connection] = None
+# 尚未落盘的写入：key -> (model, response, created_at)
+_pending: Dict[str, tuple] = {}
+_last_flush = time.monotonic()
+
+
+def _connection() -> sqlite3.Connection:
+    """获取共用的缓存数据库连接，首次调用时打开并建表（调用方需持有 _lock）"""
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(LLM_CACHE_DB, timeout=30, check_same_thread=False)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("PRAGMA synchronous=NORMAL")
+        _conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, response TEXT, created_at REAL)"
+        )
+        _conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_created_at ON responses (created_at)")
+        _conn.commit()
+    return _conn
+
+
+def _flush_locked() -> None:
+    """将缓冲中的写入一次性提交，并淘汰超出容量上限的最旧条目（调用方需持有 _lock）"""
+    global _last_flush
+    _last_flush = time.monotonic()
+    if not _pending:
+        return
+    conn = _connection()
+    rows = [(key, model, response, created_at) for key, (model, response, created_at) in _pending.items()]
+    _pending.clear()
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO responses (key, model, response, created_at) VALUES (?, ?, ?, ?)",
+            rows
+        )
+        conn.execute(
+            "DELETE FROM responses WHERE key IN ("
+            "SELECT key FROM responses ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+            (LLM_CACHE_MAX_ENTRIES,)
+        )
+
+
+def make_cache_key(model: str, provider: str, temperature: float, max_tokens: int, prompt: str, user_input: str, repeat_index: int = 0) -> str:
+    """
+    生成缓存键
+
+    prompt 为作为 system 消息发送的渲染后提示词，与用户输入一起决定请求内容；
+    同名模型在不同提供商、不同 max_tokens 下的输出不同，因此都计入键中。
+    温度大于0时每次重复的结果不同，通过 repeat_index 为每次重复分配独立的缓存槽位；
+    温度为0时所有重复共享同一个槽位。
+    """
+    if not temperature:
+        repeat_index = 0
+    raw = f"{model}|{provider}|{temperature}|{max_tokens}|{repeat_index}|{prompt}|{user_input}"
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=32).hexdigest()
+
+
+def make_request_cache_key(model: str, provider: str, prompt: str, params: Dict) -> str:
+    """按单次请求的完整内容（模型、提供商、提示词、调用参数）生成缓存键"""
+    raw = f"{model}|{provider}|{prompt}|".encode("utf-8") + orjson.dumps(params, default=str, option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(raw, digest_size=32).hexdigest()
+
+
+def get_cached_response(key: str) -> Optional[str]:
+    """读取缓存的响应文本，未命中时返回None"""
+    return get_cached_responses([key]).get(key)
+
+
+def get_cached_responses(keys: Iterable[str]) -> Dict[str, str]:
+    """批量读取缓存的响应文本，返回命中的 key -> 响应；一次查询代替逐条读取"""
+    keys = list(dict.fromkeys(keys))
+    found = {}
+    with _lock:
+        missing = []
+        for key in keys:
+            if key in _pending:
+                found[key] = _pending[key][1]
+            else:
+                missing.append(key)
+        conn = _connection()
+        # 分块查询，避免超出 sqlite 的参数数量上限
+        for start in range(0, len(missing), 500):
+            chunk = missing[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            found.update(conn.execute(
+                f"SELECT key, response FROM responses WHERE key IN ({placeholders})", chunk
+            ).fetchall())
+    return found
+
+
+def set_cached_response(key: str, model: str, response: str) -> None:
+    """写入响应文本到缓存；先进入内存缓冲，批量落盘，调用方（常在事件循环中）不必等待每次提交"""
+    with _lock:
+        _pending[key] = (model, response, time.time())
+        if len(_pending) >= WRITE_BATCH_SIZE or time.monotonic() - _last_flush >= WRITE_FLUSH_INTERVAL:
+            _flush_locked()
+
+
+def flush_llm_cache() -> None:
+    """立即将缓冲中的写入落盘"""
+    with _lock:
+        _flush_locked()
+
+
+def clear_llm_cache() -> None:
+    """清空全部缓存的响应"""
+    with _lock:
+        _pending.clear()
+        conn = _connection()
+        with conn:
+            conn.execute("DELETE FROM responses")
+
+
+atexit.register(flush_llm_cache)
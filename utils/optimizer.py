@@ -8,7 +8,7 @@ from models.api_clients import get_client, get_provider_from_model
 from config import load_config, get_system_template
 from utils.common import render_prompt_template
 # 导入新的并行执行器
-from utils.parallel_executor import execute_model, execute_models, execute_model_sync, execute_models_sync
+from utils.parallel_executor import execute_model, execute_models, execute_model_sync, execute_models_sync, run_coro_sync
 # 导入新的常量和工具函数
 from utils.constants import (
     DEFAULT_EVALUATION_CRITERIA,
@@ -22,6 +22,9 @@ from utils.helpers import (
     ProgressTracker
 )
 
+# 推测式优化每轮并发尝试所用的温度（略有差异以增加结果多样性）
+SPECULATIVE_TEMPERATURES = (0.9, 0.8, 1.0)
+
 class PromptOptimizer:
     """提示词自动优化器"""
     def __init__(self, optimization_retries=3):  # Added optimization_retries
@@ -35,7 +38,13 @@ class PromptOptimizer:
         self.optimizer_template = get_system_template("optimizer")
         self.problem_analyzer_template = get_system_template("problem_analyzer")  # 新增
     
-    async def optimize_prompt(self, original_prompt: str, test_results: List[Dict], optimization_strategy: str = "balanced") -> Dict:
+    async def optimize_prompt(self, original_prompt: str, test_results: List[Dict], optimization_strategy: str = "balanced", speculative: bool = False) -> Dict:
+        """
+        基于测试结果优化提示词
+
+        speculative 为 True 时只需要一个优化提示词：每轮并发发起多次温度略有差异的尝试，
+        采用最先返回的有效结果，用于对延迟敏感的自动迭代优化
+        """
         # --- 修复类型问题 ---
         if isinstance(original_prompt, dict):
             # 你可以根据实际结构选择合适的字段
@@ -78,89 +87,95 @@ class PromptOptimizer:
 
         print(f"[调试-优化器] 已准备基础优化提示词，长度: {len(base_optimization_prompt)} 字符")
 
-        all_optimized_prompts = []
-        max_single_prompt_retries = self.optimization_retries 
-        
-        for i in range(3): # 调用3次以获取3个独立的优化提示词
-            print(f"[调试-优化器] 开始第 {i+1}/3 次提示词生成尝试...")
-            retry_count = 0
-            current_prompt_generated = False
-            while retry_count < max_single_prompt_retries and not current_prompt_generated:
-                print(f"[调试-优化器] 第 {i+1}/3 次生成 - 尝试 {retry_count + 1}/{max_single_prompt_retries}...")
-                try:
-                    call_params = dict(DEFAULT_GENERATION_PARAMS)
-                    call_params["temperature"] = 0.9
-                    call_params["max_tokens"] = 8000 # 修改 max_tokens
-
-                    print(f"[调试-优化器] 调用LLM进行第 {i+1} 次优化。参数: {call_params}")
-                    result = await execute_model(
-                        self.optimizer_model,
-                        prompt=base_optimization_prompt,
-                        provider=self.provider,
-                        params=call_params 
-                    )
-                    
-                    opt_text = result.get("text", "")
-                    raw_response_text = opt_text
-                    request_id = result.get("id", "N/A") # 假设execute_model返回ID
-                    print(f"[调试-优化器] LLM调用 {request_id} (尝试 {retry_count + 1}) 返回响应，长度: {len(opt_text)} 字符. 原始响应: '{raw_response_text[:500]}...' ")
+        max_single_prompt_retries = self.optimization_retries
+        last_response = {"text": ""}  # 最后一次的原始响应
 
-                    current_parsed_result, error = parse_json_response(opt_text)
-                    
-                    if error:
-                        error_message = f"JSON解析失败: {error}. 原始文本: '{raw_response_text[:500]}...'"
-                        print(f"[错误-优化器] {error_message}")
-                        retry_count += 1
-                        if "空响应内容" in error or "未能生成优化提示词" in error or "JSON解析失败" in error:
-                            print(f"[警告-优化器] 第 {i+1}/3 次生成 - 尝试 {retry_count}/{max_single_prompt_retries} 失败: {error_message}，准备重试...")
-                            if retry_count < max_single_prompt_retries:
-                                await asyncio.sleep(1)
-                            continue
-                        else: # 不可重试的JSON解析错误
-                            break 
-                    
-                    if not current_parsed_result or "optimized_prompt" not in current_parsed_result or not current_parsed_result["optimized_prompt"]:
-                        error_message = f"优化结果未包含有效的optimized_prompt. 解析结果: {current_parsed_result}"
-                        print(f"[错误-优化器] {error_message}")
-                        retry_count += 1
-                        print(f"[警告-优化器] 第 {i+1}/3 次生成 - 尝试 {retry_count}/{max_single_prompt_retries} 失败: {error_message}，准备重试...")
-                        if retry_count < max_single_prompt_retries:
-                            await asyncio.sleep(1)
-                        continue
-                    
-                    if current_parsed_result["optimized_prompt"]:
-                        all_optimized_prompts.append(current_parsed_result["optimized_prompt"])
-                        current_prompt_generated = True
-                        print(f"[调试-优化器] 第 {i+1}/3 次提示词生成成功。")
-                        break # 当前单个提示词生成成功，跳出重试循环
-                    else:
-                        error_message = f"优化结果未包含有效的optimized_prompt. 解析结果: {current_parsed_result}"
-                        print(f"[错误-优化器] {error_message}")
-                        retry_count += 1
-                        print(f"[警告-优化器] 第 {i+1}/3 次生成 - 尝试 {retry_count}/{max_single_prompt_retries} 失败: {error_message}，准备重试...")
-                        if retry_count < max_single_prompt_retries:
-                             await asyncio.sleep(1)
-                        continue
-
-                except Exception as e:
-                    error_message = f"第 {i+1}/3 次优化API调用失败: {str(e)}"
-                    print(f"[错误-优化器] {error_message}")
-                    import traceback
-                    print(traceback.format_exc())
-                    retry_count += 1
-                    print(f"[警告-优化器] 第 {i+1}/3 次生成 - 尝试 {retry_count}/{max_single_prompt_retries} 失败: {error_message}，准备重试...")
-                    if retry_count < max_single_prompt_retries:
-                        await asyncio.sleep(1)
-                    continue
-            
-            if not current_prompt_generated:
-                 print(f"[警告-优化器] 第 {i+1}/3 次提示词生成在 {max_single_prompt_retries} 次尝试后失败。")
+        async def generate_once(label: str, temperature: float):
+            """调用一次LLM生成优化提示词，成功返回optimized_prompt，失败返回None"""
+            try:
+                call_params = dict(DEFAULT_GENERATION_PARAMS)
+                call_params["temperature"] = temperature
+                call_params["max_tokens"] = 8000 # 修改 max_tokens
+
+                print(f"[调试-优化器] 调用LLM进行{label}。参数: {call_params}")
+                result = await execute_model(
+                    self.optimizer_model,
+                    prompt=base_optimization_prompt,
+                    provider=self.provider,
+                    params=call_params
+                )
+
+                opt_text = result.get("text", "")
+                last_response["text"] = opt_text
+                request_id = result.get("id", "N/A") # 假设execute_model返回ID
+                print(f"[调试-优化器] LLM调用 {request_id} ({label}) 返回响应，长度: {len(opt_text)} 字符. 原始响应: '{opt_text[:500]}...' ")
+
+                current_parsed_result, error = parse_json_response(opt_text)
+                if error:
+                    print(f"[错误-优化器] {label} JSON解析失败: {error}. 原始文本: '{opt_text[:500]}...'")
+                    return None
+
+                if not current_parsed_result or not current_parsed_result.get("optimized_prompt"):
+                    print(f"[错误-优化器] {label} 优化结果未包含有效的optimized_prompt. 解析结果: {current_parsed_result}")
+                    return None
+
+                return current_parsed_result["optimized_prompt"]
+
+            except Exception as e:
+                print(f"[错误-优化器] {label} 优化API调用失败: {str(e)}")
+                import traceback
+                print(traceback.format_exc())
+                return None
+
+        async def generate_with_retries(i: int):
+            """串行重试，生成第 i 个优化提示词"""
+            for retry_count in range(max_single_prompt_retries):
+                optimized = await generate_once(f"第 {i+1}/3 次生成 - 尝试 {retry_count + 1}/{max_single_prompt_retries}", 0.9)
+                if optimized:
+                    print(f"[调试-优化器] 第 {i+1}/3 次提示词生成成功。")
+                    return optimized
+                if retry_count + 1 < max_single_prompt_retries:
+                    await asyncio.sleep(1)
+            print(f"[警告-优化器] 第 {i+1}/3 次提示词生成在 {max_single_prompt_retries} 次尝试后失败。")
+            return None
+
+        async def generate_speculative():
+            """每轮以略有差异的温度并发发起多次尝试，采用最先返回的有效结果并取消其余请求"""
+            for wave in range(max_single_prompt_retries):
+                tasks = {
+                    asyncio.ensure_future(generate_once(f"推测生成 第 {wave + 1}/{max_single_prompt_retries} 轮 #{j + 1}", temperature))
+                    for j, temperature in enumerate(SPECULATIVE_TEMPERATURES)
+                }
+                pending = tasks
+                try:
+                    while pending:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            optimized = task.result()
+                            if optimized:
+                                print(f"[调试-优化器] 推测生成第 {wave + 1} 轮获得有效提示词。")
+                                return optimized
+                finally:
+                    for task in pending:
+                        task.cancel()
+                print(f"[警告-优化器] 推测生成第 {wave + 1}/{max_single_prompt_retries} 轮全部失败。")
+            return None
+
+        if speculative:
+            total_attempts = max_single_prompt_retries * len(SPECULATIVE_TEMPERATURES)
+            optimized = await generate_speculative()
+            all_optimized_prompts = [optimized] if optimized else []
+        else:
+            # 3 个优化提示词相互独立，并发生成
+            total_attempts = 3 * max_single_prompt_retries
+            generated = await asyncio.gather(*(generate_with_retries(i) for i in range(3)))
+            all_optimized_prompts = [p for p in generated if p]
 
         if not all_optimized_prompts:
-            print(f"[错误-优化器] 在 {3 * max_single_prompt_retries} 次总尝试后仍未能成功优化任何提示词。返回默认提示。")
+            print(f"[错误-优化器] 在 {total_attempts} 次总尝试后仍未能成功优化任何提示词。返回默认提示。")
             return {
-                "error": f"在 {3 * max_single_prompt_retries} 次总尝试后优化失败",
-                "raw_response": raw_response_text, # 最后一次的原始响应
+                "error": f"在 {total_attempts} 次总尝试后优化失败",
+                "raw_response": last_response["text"], # 最后一次的原始响应
                 "optimized_prompts": [{
                     "strategy": "默认优化（所有尝试失败）",
                     "problem_addressed": "无法通过LLM生成优化版本",
@@ -172,7 +187,7 @@ class PromptOptimizer:
         print(f"[调试-优化器] 总共生成 {len(all_optimized_prompts)} 个优化后的提示词。")
         return {"optimized_prompts": all_optimized_prompts}
 
-    def optimize_prompt_sync(self, original_prompt: str, test_results: List[Dict], optimization_strategy: str = "balanced") -> Dict:
+    def optimize_prompt_sync(self, original_prompt: str, test_results: List[Dict], optimization_strategy: str = "balanced", speculative: bool = False) -> Dict:
         """同步版本的优化函数（包装异步函数）"""
         # --- 修复类型问题 ---
         if isinstance(original_prompt, dict):
@@ -182,20 +197,10 @@ class PromptOptimizer:
 
         print(f"[调试-优化器-同步] 开始优化提示词，策略: {optimization_strategy}")
         
-        # 使用统一的事件循环管理方法
         try:
-            loop = asyncio.get_event_loop()
-            if loop.is_closed():
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-        except RuntimeError:
-            # 如果没有事件循环，创建一个新的
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        
-        try:
-            result = loop.run_until_complete(self.optimize_prompt(
-                original_prompt, test_results, optimization_strategy
+            # 在共享的后台事件循环上执行
+            result = run_coro_sync(self.optimize_prompt(
+                original_prompt, test_results, optimization_strategy, speculative=speculative
             ))
             
             # 检查结果是否有效
@@ -224,31 +229,19 @@ class PromptOptimizer:
                     "prompt": original_prompt_str + "\n\n请确保你的回答全面、准确、简洁，并完全解决用户的需求。"
                 }]
             }
-        # 注意：不在这里关闭事件循环，因为它可能会被其他代码继续使用
 
     def zero_shot_optimize_prompt_sync(self, task_desc: str, task_goal: str, constraints: str = "") -> Dict:
         """同步：0样本优化主流程"""
         print(f"[调试-优化器-同步] 开始0样本优化，目标: {task_goal}")
         
-        # 使用统一的事件循环管理方法
-        try:
-            loop = asyncio.get_event_loop()
-            if loop.is_closed():
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-        except RuntimeError:
-            # 如果没有事件循环，创建一个新的
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            
         try:
-            result = loop.run_until_complete(self.zero_shot_optimize_prompt(task_desc, task_goal, constraints))
+            # 在共享的后台事件循环上执行
+            result = run_coro_sync(self.zero_shot_optimize_prompt(task_desc, task_goal, constraints))
             return result
         except Exception as e:
             import traceback
             traceback.print_exc()
             return {"error": f"0样本优化过程出错: {str(e)}"}
-        # 注意：不在这里关闭事件循环，因为它可能会被其他代码继续使用
 
     async def zero_shot_optimize_prompt(self, task_desc: str, task_goal: str, constraints: str = "") -> Dict:
         """异步：0样本优化主流程"""
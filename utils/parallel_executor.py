@@ -1,12 +1,114 @@
 import asyncio
+import atexit
+import threading
 from typing import List, Dict, Any, Optional, Union, Callable, Tuple
 import time
 import sys
+import random
+import re
 from tqdm import tqdm  # 添加tqdm进度条支持
 
-from models.api_clients import get_client, get_provider_from_model
+from models.api_clients import get_client, get_provider_from_model, is_retryable_exception
 from config import get_concurrency_limit, load_config
 
+# 非Windows平台使用uvloop作为事件循环实现，降低大量并发请求时的调度开销
+# 共享后台循环以及 run_test 等处通过 asyncio.new_event_loop() 创建的事件循环都会使用该策略
+if sys.platform != "win32":
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
+# 单个请求遇到限流、服务端故障等临时错误时的最大尝试次数和指数退避的基础等待时间（秒）
+REQUEST_MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 1.0
+# 单个请求（含全部重试）的总耗时上限（秒），超过后不再发起新的重试
+RETRY_TIME_BUDGET = 60.0
+
+# 客户端未标注 retryable 时的兜底判断：错误信息开头或 "Error code:"/"status" 之后的状态码，以及限流、过载的固定措辞；
+# 只匹配完整的状态码，"max_tokens 1500" 之类的参数错误不会被误判
+TRANSIENT_ERROR_RE = re.compile(
+    r"(?:^|error code:?\s*|status(?:\s*code)?:?\s*)(?:429|50[0234])\b"
+    r"|\brate[ _]limit|\btoo many requests\b|\boverloaded\b",
+    re.IGNORECASE
+)
+
+
+def _is_transient_error(response: Dict) -> bool:
+    """
+    判断失败的响应是否属于可重试的临时错误
+
+    客户端按异常类型和状态码设置的 retryable 标记优先；没有标记时按错误信息中的状态码和固定措辞判断
+    """
+    if "retryable" in response:
+        return bool(response["retryable"])
+    return TRANSIENT_ERROR_RE.search(str(response.get("error", ""))) is not None
+
+
+# 同步包装函数共用的后台事件循环，首次使用时在守护线程中启动，进程退出时关闭
+_LOOP = None
+_LOOP_THREAD = None
+_LOOP_LOCK = threading.Lock()
+
+
+def _get_shared_loop() -> asyncio.AbstractEventLoop:
+    """获取（必要时启动）共享的后台事件循环"""
+    global _LOOP, _LOOP_THREAD
+    with _LOOP_LOCK:
+        if _LOOP is None or _LOOP.is_closed():
+            _LOOP = asyncio.new_event_loop()
+            _LOOP_THREAD = threading.Thread(target=_LOOP.run_forever, name="shared-event-loop", daemon=True)
+            _LOOP_THREAD.start()
+        return _LOOP
+
+
+def _close_shared_loop():
+    """进程退出时停止并关闭共享事件循环"""
+    with _LOOP_LOCK:
+        if _LOOP is None or _LOOP.is_closed():
+            return
+        _LOOP.call_soon_threadsafe(_LOOP.stop)
+        _LOOP_THREAD.join(timeout=5)
+        if not _LOOP.is_running():
+            _LOOP.close()
+
+
+atexit.register(_close_shared_loop)
+
+
+def run_coro_sync(coro):
+    """
+    在共享的后台事件循环上运行协程并阻塞等待结果，避免每次同步调用都创建和销毁事件循环
+
+    协程在后台线程中执行，其中不能调用Streamlit等依赖当前脚本线程的接口；
+    也不能在共享循环内部（即其他协程中）调用本函数，否则会死锁
+    """
+    loop = _get_shared_loop()
+    if threading.current_thread() is _LOOP_THREAD:
+        coro.close()
+        raise RuntimeError("不能在共享事件循环内部同步等待协程")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+def close_private_loop(loop: asyncio.AbstractEventLoop) -> None:
+    """
+    关闭调用线程中临时创建的事件循环
+
+    运行被异常打断（如Streamlit停止/重新运行脚本）时循环上可能还有未完成的请求任务，
+    先取消并等待它们退出，避免任务在关闭后被销毁、HTTP连接未释放
+    """
+    try:
+        pending = asyncio.all_tasks(loop)
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.run_until_complete(loop.shutdown_asyncgens())
+    finally:
+        loop.close()
+
+
 class ParallelModelExecutor:
     """
     并行模型执行器，用于处理多个模型API请求的并发执行
@@ -28,10 +130,6 @@ class ParallelModelExecutor:
         self.default_timeout = 180
         # 控制台进度显示选项
         self.show_progress = show_progress
-        # 进度计数器
-        self.completed_count = 0
-        self.total_count = 0
-        self.progress_bar = None
     
     def _get_client(self, provider: str):
         """获取缓存的API客户端实例"""
@@ -86,32 +184,45 @@ class ParallelModelExecutor:
         # 设置超时
         timeout = timeout or self.default_timeout
         
-        try:
-            # 创建任务并设置超时
-            if messages is not None:
-                task = asyncio.create_task(client.generate_with_messages(messages, model, params))
-            else:
-                task = asyncio.create_task(client.generate(prompt, model, params))
-            
-            # 等待任务完成，或超时
-            response = await asyncio.wait_for(task, timeout=timeout)
-            return response
+        # 临时错误按指数退避（加随机抖动）重试，其余错误立即返回；超时不重试，总耗时超出预算后也不再重试
+        started = time.monotonic()
+        for attempt in range(REQUEST_MAX_ATTEMPTS):
+            try:
+                # 创建任务并设置超时
+                if messages is not None:
+                    task = asyncio.create_task(client.generate_with_messages(messages, model, params))
+                else:
+                    task = asyncio.create_task(client.generate(prompt, model, params))
+                
+                # 等待任务完成，或超时
+                response = await asyncio.wait_for(task, timeout=timeout)
+                
+            except asyncio.TimeoutError:
+                response = {
+                    "error": f"请求超时 (>{timeout}秒)",
+                    "retryable": False,
+                    "model": model
+                }
+            except Exception as e:
+                response = {
+                    "error": str(e),
+                    "retryable": is_retryable_exception(e),
+                    "model": model
+                }
             
-        except asyncio.TimeoutError:
-            return {
-                "error": f"请求超时 (>{timeout}秒)",
-                "model": model
-            }
-        except Exception as e:
-            return {
-                "error": str(e),
-                "model": model
-            }
+            if not response.get("error") or attempt == REQUEST_MAX_ATTEMPTS - 1 or not _is_transient_error(response):
+                return response
+            delay = RETRY_BASE_DELAY * 2 ** attempt + random.random() * 0.25
+            if time.monotonic() - started + delay > RETRY_TIME_BUDGET:
+                return response
+            await asyncio.sleep(delay)
     
     async def execute_batch(self, 
                           requests: List[Dict], 
                           semaphore_by_provider: bool = True,
-                          progress_callback: Optional[Callable[[int, int], None]] = None) -> List[Dict]:
+                          progress_callback: Optional[Callable[[int, int], None]] = None,
+                          result_callback: Optional[Callable[[Dict], None]] = None,
+                          stop_event: Optional[threading.Event] = None) -> List[Dict]:
         """
         批量执行多个请求
         
@@ -119,17 +230,19 @@ class ParallelModelExecutor:
             requests: 请求列表，每个请求是包含model、prompt/messages等参数的字典
             semaphore_by_provider: 是否按提供商分别限制并发
             progress_callback: 进度回调函数，参数为(当前完成数, 总数)
+            result_callback: 每个请求完成时以其响应（含context）调用，便于调用方在其余请求完成前开始后续处理
+            stop_event: 设置后尚未开始的请求不再调用模型，直接返回取消错误
             
         Returns:
             响应结果列表，顺序与请求列表对应
         """
-        # 设置总请求数
-        self.total_count = len(requests)
-        self.completed_count = 0
-        
-        # 如果需要显示进度，创建进度条
-        if self.show_progress:
-            self.progress_bar = tqdm(total=self.total_count, desc="执行并行请求", file=sys.stdout)
+        # 进度计数和控制台进度条属于本次调用：同一执行器上可能同时运行多个批次（如模型调用与评估重叠），
+        # 共享计数会让各批次的进度回调互相干扰
+        progress = {
+            "completed": 0,
+            "total": len(requests),
+            "bar": tqdm(total=len(requests), desc="执行并行请求", file=sys.stdout) if self.show_progress else None
+        }
         
         # 分组请求以便按提供商限制并发
         if semaphore_by_provider:
@@ -159,34 +272,33 @@ class ParallelModelExecutor:
                 for req in group["requests"]:
                     model = req.get("model")
                     semaphore = group["semaphore"].get(model)
-                    tasks.append(self._execute_with_semaphore(semaphore, req, progress_callback))
-                    
-            # 执行所有任务
-            results = await asyncio.gather(*tasks)
-            
-            # 关闭进度条
-            if self.progress_bar:
-                self.progress_bar.close()
-                
-            return results
+                    tasks.append(self._execute_with_semaphore(semaphore, req, progress, progress_callback, result_callback, stop_event))
         else:
             # 使用单一全局信号量
             concurrency = self.global_concurrency_limit or 5  # 默认全局并发为5
             semaphore = asyncio.Semaphore(concurrency)
             
-            tasks = [self._execute_with_semaphore(semaphore, req, progress_callback) for req in requests]
-            results = await asyncio.gather(*tasks)
-            
-            # 关闭进度条
-            if self.progress_bar:
-                self.progress_bar.close()
-                
-            return results
+            tasks = [self._execute_with_semaphore(semaphore, req, progress, progress_callback, result_callback, stop_event) for req in requests]
+        
+        # 执行所有任务；任一任务抛出异常（如回调中的脚本中断）或整体被取消时取消其余请求，不再继续调用模型
+        tasks = [asyncio.ensure_future(task) for task in tasks]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            if progress["bar"]:
+                progress["bar"].close()
     
     async def _execute_with_semaphore(self, 
                                     semaphore: asyncio.Semaphore, 
                                     request: Dict, 
-                                    progress_callback: Optional[Callable] = None) -> Dict:
+                                    progress: Dict,
+                                    progress_callback: Optional[Callable] = None,
+                                    result_callback: Optional[Callable[[Dict], None]] = None,
+                                    stop_event: Optional[threading.Event] = None) -> Dict:
         """使用信号量执行请求"""
         # 提取请求参数
         model = request.get("model")
@@ -203,15 +315,18 @@ class ParallelModelExecutor:
             # 记录开始时间
             start_time = time.time()
             
-            # 执行请求
-            response = await self.execute_single(
-                model=model,
-                prompt=prompt,
-                messages=messages,
-                provider=provider,
-                params=params,
-                timeout=timeout
-            )
+            # 执行请求；已取消时排队中的请求直接跳过
+            if stop_event is not None and stop_event.is_set():
+                response = {"error": "请求已取消", "text": "", "usage": {}}
+            else:
+                response = await self.execute_single(
+                    model=model,
+                    prompt=prompt,
+                    messages=messages,
+                    provider=provider,
+                    params=params,
+                    timeout=timeout
+                )
             
             # 记录完成时间
             end_time = time.time()
@@ -221,17 +336,20 @@ class ParallelModelExecutor:
             if context:
                 response["context"] = context
             
-            # 更新进度
-            self.completed_count += 1
+            # 更新本批次的进度
+            progress["completed"] += 1
             
             # 更新控制台进度条
-            if self.progress_bar:
-                self.progress_bar.update(1)
-                self.progress_bar.set_description(f"执行并行请求 [{self.completed_count}/{self.total_count}]")
+            if progress["bar"]:
+                progress["bar"].update(1)
+                progress["bar"].set_description(f"执行并行请求 [{progress['completed']}/{progress['total']}]")
             
             # 调用进度回调
             if progress_callback:
-                progress_callback(self.completed_count, self.total_count)
+                progress_callback(progress["completed"], progress["total"])
+            
+            if result_callback:
+                result_callback(response)
                 
             return response
     
@@ -250,19 +368,21 @@ class ParallelModelExecutor:
         Returns:
             响应结果列表，顺序与请求列表对应
         """
-        # 创建新的事件循环
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        # 进度回调可能操作Streamlit组件，必须在调用线程中执行，此时使用独立的事件循环
+        if progress_callback is not None:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            
+            try:
+                # 执行异步方法并等待完成
+                return loop.run_until_complete(
+                    self.execute_batch(requests, semaphore_by_provider, progress_callback)
+                )
+            finally:
+                # 取消残留任务并关闭事件循环
+                close_private_loop(loop)
         
-        try:
-            # 执行异步方法并等待完成
-            results = loop.run_until_complete(
-                self.execute_batch(requests, semaphore_by_provider, progress_callback)
-            )
-            return results
-        finally:
-            # 关闭事件循环
-            loop.close()
+        return run_coro_sync(self.execute_batch(requests, semaphore_by_provider))
 
     def execute_single_sync(self, 
                           model: str, 
@@ -280,23 +400,76 @@ class ParallelModelExecutor:
         Returns:
             模型响应结果字典
         """
-        # 创建新的事件循环
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        try:
-            # 执行异步方法并等待完成
-            result = loop.run_until_complete(
-                self.execute_single(model, prompt, messages, provider, params, timeout)
-            )
-            return result
-        finally:
-            # 关闭事件循环
-            loop.close()
+        # 在共享的后台事件循环上执行，避免每次调用都创建事件循环
+        return run_coro_sync(self.execute_single(model, prompt, messages, provider, params, timeout))
 
 # 创建默认执行器实例，方便直接导入使用
 default_executor = ParallelModelExecutor()
 
+
+class RequestBatcher:
+    """
+    动态请求合批器
+
+    调用方逐个提交请求，合批器在 max_delay 秒的时间窗口内（或攒满 max_batch_size 个请求时）
+    将同一事件循环上所有调用方的请求合并为一次 execute_batch 调度，
+    共享按提供商/模型的并发限制，请求的 context 随响应原样返回
+    """
+
+    def __init__(self, executor: ParallelModelExecutor, max_batch_size: int = 32, max_delay: float = 0.05):
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        # 每个事件循环各自攒批：事件循环 -> {"requests", "futures", "timer"}
+        self._pending = {}
+        # 持有调度任务的引用，避免任务在完成前被回收
+        self._tasks = set()
+
+    async def submit(self, request: Dict) -> Dict:
+        """提交单个请求并等待其响应"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending.setdefault(loop, {"requests": [], "futures": [], "timer": None})
+        pending["requests"].append(request)
+        pending["futures"].append(future)
+
+        if len(pending["requests"]) >= self.max_batch_size:
+            self._flush(loop)
+        elif pending["timer"] is None:
+            pending["timer"] = loop.call_later(self.max_delay, self._flush, loop)
+        return await future
+
+    def _flush(self, loop: asyncio.AbstractEventLoop):
+        """将当前攒下的请求作为一批调度执行"""
+        pending = self._pending.pop(loop, None)
+        if not pending:
+            return
+        if pending["timer"] is not None:
+            pending["timer"].cancel()
+        task = loop.create_task(self._dispatch(pending["requests"], pending["futures"]))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, requests: List[Dict], futures: List[asyncio.Future]):
+        """
+        执行一批请求并将响应分发给各个调用方
+
+        同一 prompt_cache_key（共享系统提示词）的请求排在一起调度，受并发限制排队时
+        相同前缀的请求连续发出，便于提供商的前缀缓存命中
+        """
+        order = sorted(range(len(requests)), key=lambda i: (requests[i].get("params") or {}).get("prompt_cache_key") or "")
+        try:
+            results = await self.executor.execute_batch([requests[i] for i in order])
+        except Exception as e:
+            results = [{"error": str(e), "model": requests[i].get("model")} for i in order]
+        for i, result in zip(order, results):
+            if not futures[i].done():
+                futures[i].set_result(result)
+
+
+# 默认合批器，使用独立的执行器以免与 default_executor 的进度计数互相干扰
+default_batcher = RequestBatcher(ParallelModelExecutor(show_progress=False))
+
 # 方便的函数封装，使调用更简单
 async def execute_model(model: str, 
                        prompt: str = None, 
@@ -315,9 +488,11 @@ def execute_model_sync(model: str,
     return default_executor.execute_single_sync(model, prompt, messages, provider, params)
 
 async def execute_models(requests: List[Dict], 
-                      progress_callback: Optional[Callable] = None) -> List[Dict]:
+                      progress_callback: Optional[Callable] = None,
+                      result_callback: Optional[Callable[[Dict], None]] = None,
+                      stop_event: Optional[threading.Event] = None) -> List[Dict]:
     """异步执行多个模型请求的便捷函数"""
-    return await default_executor.execute_batch(requests, progress_callback=progress_callback)
+    return await default_executor.execute_batch(requests, progress_callback=progress_callback, result_callback=result_callback, stop_event=stop_event)
 
 def execute_models_sync(requests: List[Dict], 
                       progress_callback: Optional[Callable] = None) -> List[Dict]:
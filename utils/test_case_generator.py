@@ -1,8 +1,8 @@
-import asyncio
 from typing import Dict, Any, Callable, Optional
 
 from models.api_clients import get_client
 from utils.common import render_prompt_template, regenerate_expected_output
+from utils.parallel_executor import run_coro_sync
 from utils.evaluator import PromptEvaluator
 # Import new utility functions and constants
 from utils.constants import DEFAULT_GENERATION_PARAMS
@@ -40,10 +40,6 @@ def generate_ai_expected_output(
     if batch_mode:
         # 批量模式使用异步API直接调用
         try:
-            # 创建一个新的事件循环
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            
             # 获取客户端
             client = get_client(provider)
             
@@ -60,15 +56,13 @@ def generate_ai_expected_output(
                 {"role": "system", "content": prompt_template},
                 {"role": "user", "content": user_input}
             ]
-            response = loop.run_until_complete(client.generate_with_messages(
+            # 在共享的后台事件循环上执行，不再为每个用例创建事件循环
+            response = run_coro_sync(client.generate_with_messages(
                 messages,
                 model,
                 params
             ))
             
-            # 关闭循环
-            loop.close()
-            
             # 获取生成的文本
             model_output = response.get("text", "")
             
@@ -286,12 +280,8 @@ def generate_test_cases_for_prompt(
         if progress_tracker:
             progress_tracker.update(0, "正在生成用户输入...")
             
-        # 创建一个新的事件循环
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        # 生成用户输入
-        inputs_result = loop.run_until_complete(generate_user_inputs(test_purpose, count))
+        # 生成用户输入（在共享的后台事件循环上执行）
+        inputs_result = run_coro_sync(generate_user_inputs(test_purpose, count))
         
         if "error" in inputs_result:
             if progress_tracker: